@@ -0,0 +1,809 @@
+import sys
+import argparse
+import json
+import time
+import subprocess
+from datetime import datetime
+from pathlib import Path
+from main import load_config
+from synthetic import SyntheticPick, ArrivalPicker
+
+def read_pick_csv(pick_csv):
+    """
+    Load a pick CSV (trace_id, start_time, peak_time, end_time, peak_value,
+    phase) into SeisBench Pick objects.
+    """
+    import csv
+    from obspy import UTCDateTime
+    from seisbench.util import Pick
+    picks = []
+    with open(pick_csv, 'r') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for trace_id, start_time, peak_time, end_time, peak_value, phase in reader:
+            picks.append(Pick(trace_id, UTCDateTime(start_time), UTCDateTime(end_time),
+                              UTCDateTime(peak_time), float(peak_value), phase))
+    return picks
+
+def bench_gamma_partition(args):
+    """
+    Single gamma association call against the partitioned path on the same picks.
+    """
+    from core.pick_store import read_picks
+    from modules.aso_gamma import Aso_gamma
+    from modules.eikonal_cache import load_eikonal, gamma_utils
+    from modules.gamma_partition import associate_partitioned, compare_associations
+
+    config = load_config(args.config)
+    aso = Aso_gamma(config, [])
+    if args.picks is not None and args.picks.suffix == '.csv':
+        aso.picks = read_pick_csv(args.picks)
+    else:
+        aso.picks = read_picks(args.picks or aso.pick_store, days=aso.date_list)
+    picks, stations, gamma_config, _ = aso.gamma_inputs()
+    gamma_config["eikonal"] = load_eikonal(gamma_config["eikonal"], aso.eikonal_cache_dir, aso.eikonal_cache_size)
+
+    t0 = time.perf_counter()
+    _, single = gamma_utils().association(picks.copy(), stations, dict(gamma_config), 0, gamma_config["method"])
+    t1 = time.perf_counter()
+    _, partitioned = associate_partitioned(picks.copy(), stations, dict(gamma_config), gamma_config["method"],
+                                           args.window, args.overlap, args.processes)
+    t2 = time.perf_counter()
+
+    report = {"picks": len(picks), "window": args.window, "overlap": args.overlap,
+              "single_s": t1 - t0, "partitioned_s": t2 - t1}
+    report.update(compare_associations(single, partitioned, len(picks)))
+    return report
+
+def bench_pick_table(args):
+    """
+    Pick table construction of run_gamma_association: list of dicts with
+    row-wise apply against the columnar path, on synthetic picks.
+    """
+    import numpy as np
+    import pandas as pd
+    from obspy import UTCDateTime
+    from modules.aso_gamma import extract_substring, picks_to_arrays, pick_table
+
+    rng = np.random.default_rng(42)
+    n = args.n_picks
+    trace_ids = [f"TW.S{i:03d}.00.HH" for i in range(300)]
+    t0 = UTCDateTime(2024, 4, 2)
+    offsets = np.sort(rng.uniform(0, 86400 * 2, n))
+    picks = [SyntheticPick(trace_ids[i], t0 + float(dt), float(pv), ph)
+             for i, dt, pv, ph in zip(rng.integers(0, 300, n), offsets, rng.uniform(0.3, 1, n), rng.choice(['P', 'S'], n))]
+
+    t1 = time.perf_counter()
+    legacy = []
+    for p in picks:
+        legacy.append({"id": p.trace_id, "timestamp": p.peak_time.datetime, "prob": p.peak_value, "type": p.phase.lower()})
+    legacy = pd.DataFrame(legacy)
+    legacy['id'] = legacy['id'].apply(extract_substring)
+    t2 = time.perf_counter()
+    columnar = pick_table(*picks_to_arrays(picks))
+    t3 = time.perf_counter()
+
+    same = (legacy['id'].equals(columnar['id']) and legacy['type'].equals(columnar['type'])
+            and np.allclose(legacy['prob'], columnar['prob']))
+    return {"picks": n, "legacy_s": t2 - t1, "columnar_s": t3 - t2, "speedup": (t2 - t1) / (t3 - t2), "identical": bool(same)}
+
+def bench_pick_store(args):
+    """
+    Write and load args.n_picks synthetic picks through the per-day pick
+    store and through a pick CSV, then a one hour, 30 station query.
+    """
+    import csv
+    import tempfile
+    import numpy as np
+    from obspy import UTCDateTime
+    from core.pick_store import PickWriter, read_picks, store_path
+    from modules.aso_gamma import picks_to_arrays, pick_table, store_pick_table
+
+    rng = np.random.default_rng(42)
+    n = args.n_picks
+    days = ['20240402', '20240403']
+    trace_ids = [f"TW.S{i:03d}.00.HH" for i in range(300)]
+    tmp = Path(tempfile.mkdtemp(prefix='aq_picks_'))
+    picks = []
+    for i, day in enumerate(days):
+        t0 = UTCDateTime(day)
+        offsets = np.sort(rng.uniform(0, 86400, n // len(days)))
+        picks.append([SyntheticPick(trace_ids[k], t0 + float(dt), float(pv), ph, t0 + float(dt) - 0.5, t0 + float(dt) + 0.5)
+                      for k, dt, pv, ph in zip(rng.integers(0, 300, len(offsets)), offsets,
+                                               rng.uniform(0.3, 1, len(offsets)), rng.choice(['P', 'S'], len(offsets)))])
+
+    t = time.perf_counter()
+    for day, day_picks in zip(days, picks):
+        with PickWriter(store_path(tmp, day)) as writer:
+            for k in range(0, len(day_picks), 10000):
+                writer.append(day_picks[k:k + 10000])
+    write_store = time.perf_counter() - t
+    t = time.perf_counter()
+    with open(tmp / 'picks.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['trace_id', 'start_time', 'peak_time', 'end_time', 'peak_value', 'phase'])
+        for day_picks in picks:
+            for p in day_picks:
+                writer.writerow([p.trace_id, p.start_time, p.peak_time, p.end_time, p.peak_value, p.phase])
+    write_csv = time.perf_counter() - t
+
+    t = time.perf_counter()
+    from_store = store_pick_table(read_picks(tmp))
+    load_store = time.perf_counter() - t
+    t = time.perf_counter()
+    from_csv = pick_table(*picks_to_arrays(read_pick_csv(tmp / 'picks.csv')))
+    load_csv = time.perf_counter() - t
+    t = time.perf_counter()
+    query = read_picks(tmp, starttime=UTCDateTime(days[1]) + 3600, endtime=UTCDateTime(days[1]) + 7200,
+                       stations=[f"S{i:03d}" for i in range(30)])
+    load_query = time.perf_counter() - t
+
+    same = (from_store['id'].equals(from_csv['id']) and from_store['type'].equals(from_csv['type'])
+            and np.allclose(from_store['prob'], from_csv['prob'], atol=1e-6)
+            # the CSV keeps microseconds, the store nanoseconds
+            and bool(((from_store['timestamp'] - from_csv['timestamp']).abs() <= np.timedelta64(1, 'us')).all()))
+    return {"picks": n, "store_write_s": write_store, "csv_write_s": write_csv,
+            "store_load_s": load_store, "csv_load_s": load_csv, "load_speedup": load_csv / load_store,
+            "query_picks": len(query), "query_s": load_query,
+            "store_MB": sum(path.stat().st_size for path in tmp.glob('*.h5')) / 1e6,
+            "csv_MB": (tmp / 'picks.csv').stat().st_size / 1e6, "identical": bool(same)}
+
+def match_picks(reference, candidate, tolerance=0.1):
+    """
+    Share of reference picks found again (same trace, phase, peak within
+    tolerance seconds) and of candidate picks that match a reference pick.
+    """
+    from collections import defaultdict
+    times = defaultdict(list)
+    for p in candidate:
+        times[(p.trace_id, p.phase)].append(p.peak_time)
+    found = sum(any(abs(t - p.peak_time) <= tolerance for t in times[(p.trace_id, p.phase)]) for p in reference)
+    return {"reference_picks": len(reference), "candidate_picks": len(candidate),
+            "recall": found / max(len(reference), 1), "precision": min(found, len(candidate)) / max(len(candidate), 1)}
+
+def bench_cpu_picker(args):
+    """
+    PhaseNet on CPU as run_phasenet used to call it against the CPU
+    inference mode (threads, TorchScript, autotuned batch size), on
+    args.n_traces synthetic traces of args.window seconds.
+    """
+    import copy
+    import numpy as np
+    import torch
+    import seisbench.models as sbm
+    from obspy import Stream, Trace, UTCDateTime
+    from core.cpu_picker import configure_threads, prepare_cpu_picker
+
+    try:
+        picker = sbm.PhaseNet.from_pretrained("original")
+        weights = "original"
+    except Exception:
+        # no access to the model repository, compare on random weights
+        torch.manual_seed(0)
+        picker = sbm.PhaseNet(phases="PSN")
+        weights = "random"
+    picker.eval()
+
+    rng = np.random.default_rng(42)
+    t0 = UTCDateTime(2024, 4, 2)
+    npts = int(args.window * 100)
+    n_stations = max(args.n_traces // 3, 1)
+    stream = Stream()
+    for i in range(n_stations):
+        data = rng.standard_normal((3, npts)).astype(np.float32)
+        # a few P/S wavelet pairs on top of the noise
+        for onset in rng.uniform(0, args.window - 30, max(int(args.window // 600), 1)):
+            k = int(onset * 100)
+            for lag, amp in [(0, 20), (int(rng.uniform(300, 1500)), 40)]:
+                n = min(200, npts - k - lag)
+                if n > 0:
+                    data[:, k + lag:k + lag + n] += amp * np.sin(np.arange(n) / 3.0) * np.exp(-np.arange(n) / 40.0)
+        for comp, trace in zip('ZNE', data):
+            stream += Trace(trace, header={'network': 'TW', 'station': f'S{i:03d}', 'location': '00',
+                                           'channel': f'HH{comp}', 'sampling_rate': 100.0, 'starttime': t0})
+    station_hours = n_stations * args.window / 3600
+
+    reference_threads = torch.get_num_threads()
+    t = time.perf_counter()
+    reference = picker.classify(stream, batch_size=256).picks
+    reference_s = time.perf_counter() - t
+    reference_annotations = picker.annotate(stream, batch_size=256)
+
+    threads = configure_threads(args.processes)
+    tuned, batch_size = prepare_cpu_picker(copy.deepcopy(picker), jit=True, batch_size='auto')
+    t = time.perf_counter()
+    candidate = tuned.classify(stream, batch_size=batch_size).picks
+    candidate_s = time.perf_counter() - t
+    candidate_annotations = tuned.annotate(stream, batch_size=batch_size)
+    max_diff = max(float(np.max(np.abs(a.data - b.data)))
+                   for a, b in zip(sorted(reference_annotations, key=lambda tr: tr.id),
+                                   sorted(candidate_annotations, key=lambda tr: tr.id)))
+
+    report = {"weights": weights, "station_hours": station_hours, "reference_threads": reference_threads,
+              "threads": threads[0], "interop_threads": threads[1], "batch_size": batch_size,
+              "reference_s": reference_s, "cpu_mode_s": candidate_s,
+              "reference_station_hours_per_s": station_hours / reference_s,
+              "cpu_mode_station_hours_per_s": station_hours / candidate_s,
+              "speedup": reference_s / candidate_s, "max_probability_diff": max_diff}
+    report.update(match_picks(reference, candidate))
+    return report
+
+def import_seconds(statement, repeats=3):
+    import subprocess
+    import sys
+    best = float('inf')
+    for _ in range(repeats):
+        t = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], check=True, capture_output=True, cwd=Path(__file__).parent)
+        best = min(best, time.perf_counter() - t)
+    return best
+
+def bench_import_time(args):
+    """
+    Cold start of the CLI and of the modules a stage or its workers import,
+    each in a fresh interpreter (best of three), against the bare interpreter.
+    """
+    report = {"interpreter_s": import_seconds("pass")}
+    report["cli_s"] = import_seconds("import main")
+    for stage, module in [("filter_merge", "core.initializer"), ("merge_worker", "core.merge_engine"),
+                          ("convert", "modules.aso_gamma"), ("relocate", "modules.h3dd"),
+                          ("pick", "core.cpu_picker; import seisbench.models"),
+                          ("associate", "modules.aso_gamma; from modules.eikonal_cache import gamma_utils; gamma_utils()")]:
+        report[f"{stage}_s"] = import_seconds(f"import {module}")
+    return report
+
+def bench_waveform_store(args):
+    """
+    Read throughput of the SAC-per-file layout against the per-day HDF5
+    archive, for whole days and for a window of args.window seconds.
+    """
+    import tempfile
+    import numpy as np
+    from obspy import Trace, UTCDateTime, read
+    from core.waveform_store import DayStore, read_window
+
+    rng = np.random.default_rng(42)
+    t0 = UTCDateTime(2024, 4, 2)
+    tmp = Path(tempfile.mkdtemp(prefix='aq_store_'))
+    sac_files = []
+    with DayStore(tmp / 'waveforms.h5') as store:
+        for i in range(args.n_traces):
+            tr = Trace(rng.standard_normal(int(86400 * 100)).astype(np.float32),
+                       header={'network': 'TW', 'station': f'S{i // 3:03d}', 'location': '00',
+                               'channel': 'HH' + 'ZNE'[i % 3], 'sampling_rate': 100.0, 'starttime': t0})
+            sac_files.append(tmp / f'{tr.id}.D.2024.093')
+            tr.write(str(sac_files[-1]), format='SAC')
+            store.add([tr], sac_files[-1].name)
+    mbytes = args.n_traces * 86400 * 100 * 4 / 1e6
+    w0, w1 = t0 + 43200, t0 + 43200 + args.window
+
+    timings = {}
+    t = time.perf_counter()
+    for sp in sac_files:
+        read(sp)
+    timings['sac_day_s'] = time.perf_counter() - t
+    t = time.perf_counter()
+    read_window(tmp / 'waveforms.h5')
+    timings['hdf5_day_s'] = time.perf_counter() - t
+    t = time.perf_counter()
+    for sp in sac_files:
+        read(sp, starttime=w0, endtime=w1)
+    timings['sac_window_s'] = time.perf_counter() - t
+    t = time.perf_counter()
+    read_window(tmp / 'waveforms.h5', w0, w1)
+    timings['hdf5_window_s'] = time.perf_counter() - t
+
+    report = {"traces": args.n_traces, "window_s": args.window, "day_MB": mbytes}
+    report.update(timings)
+    for key in ['sac_day', 'hdf5_day', 'sac_window', 'hdf5_window']:
+        report[f'{key}_traces_per_s'] = args.n_traces / timings[f'{key}_s']
+    report['sac_day_MB_per_s'] = mbytes / timings['sac_day_s']
+    report['hdf5_day_MB_per_s'] = mbytes / timings['hdf5_day_s']
+    return report
+
+def bench_station_registry(args):
+    """
+    GaMMA station setup (pandas projection and the dense-matrix
+    estimate_eps) against the station registry, built and from its cache,
+    on args.n_traces synthetic stations.
+    """
+    import tempfile
+    import numpy as np
+    import pandas as pd
+    from pyproj import Proj
+    from gamma.utils import estimate_eps
+    import core.station_registry as station_registry
+
+    rng = np.random.default_rng(42)
+    tmp = Path(tempfile.mkdtemp(prefix='aq_stations_'))
+    n = args.n_traces
+    pd.DataFrame({'net': 'TW', 'station': [f'S{i:05d}' for i in range(n)],
+                  'lon': np.round(rng.uniform(121.2, 122.2, n), 4), 'lat': np.round(rng.uniform(23.5, 24.5, n), 4),
+                  'elevation_m': np.round(rng.uniform(0, 3000, n), 1)}).to_csv(tmp / 'stations.csv', index=False)
+
+    t = time.perf_counter()
+    stations = pd.read_csv(tmp / 'stations.csv', usecols=['station', 'lon', 'lat', 'elevation_m'])
+    stations.rename(columns={"station": "id", "lon": "longitude", "lat": "latitude"}, inplace=True)
+    proj = Proj("+proj=sterea +lon_0=121.7 +lat_0=24.0 +units=km")
+    stations["x(km)"], stations["y(km)"] = proj(longitude=stations["longitude"].to_numpy(), latitude=stations["latitude"].to_numpy())
+    stations["z(km)"] = -stations["elevation_m"].to_numpy() / 1e3
+    eps_reference = estimate_eps(stations, 6.0)
+    reference_s = time.perf_counter() - t
+
+    timings = {}
+    for name in ['build', 'cached']:
+        station_registry.loaded.clear()
+        t = time.perf_counter()
+        registry = station_registry.load_registry(tmp / 'stations.csv', cache_dir=tmp / 'cache')
+        eps = registry.estimate_eps(6.0)
+        timings[f'{name}_s'] = time.perf_counter() - t
+    t = time.perf_counter()
+    for xyz in registry.xyz[:1000]:
+        registry.within(*xyz, 20.0)
+    within_s = (time.perf_counter() - t) / min(n, 1000)
+
+    report = {"stations": n, "reference_s": reference_s, "eps_reference": eps_reference, "eps": eps,
+              "within_20km_query_s": within_s}
+    report.update(timings)
+    return report
+
+def bench_magnitude(args):
+    """
+    Magnitude stage of the run in --config against cutting and simulating
+    every window through ObsPy, on the first --n-picks windows for the
+    ObsPy path, extrapolated to all windows.
+    """
+    import numpy as np
+    import pandas as pd
+    from obspy import read, UTCDateTime
+    from modules.magnitude import Magnitude, pz_table, WOOD_ANDERSON, HORIZONTAL
+
+    config = load_config(args.config)
+    mag = Magnitude(config)
+    t = time.perf_counter()
+    mag.run_magnitude(args.processes)
+    engine_s = time.perf_counter() - t
+    amps = pd.read_csv(mag.amplitude_csv)
+
+    windows = mag.magnitude_windows()
+    pz = pz_table(mag.pz_path)
+    sample = windows.head(args.n_picks)
+    reference = []
+    t = time.perf_counter()
+    for row in sample.itertuples(index=False):
+        data_dir = mag.output_base_dir / 'data' / row.day / 'data_final'
+        for path in sorted(data_dir.glob(f'*.{row.station}.*')):
+            st = read(path, starttime=UTCDateTime(row.start), endtime=UTCDateTime(row.start) + mag.settings['window'])
+            for tr in st:
+                if tr.stats.channel[-1] not in HORIZONTAL or (row.station, tr.stats.channel) not in pz:
+                    continue
+                paz = pz[(row.station, tr.stats.channel)]
+                nyquist = tr.stats.sampling_rate / 2
+                tr.data = tr.data.astype(np.float64)
+                tr.detrend('linear')
+                tr.taper(0.05, type='hann')
+                tr.simulate(paz_remove={'zeros': paz['zeros'], 'poles': paz['poles'], 'gain': 1.0, 'sensitivity': paz['constant']},
+                            paz_simulate={'zeros': WOOD_ANDERSON['zeros'], 'poles': WOOD_ANDERSON['poles'], 'gain': WOOD_ANDERSON['gain'], 'sensitivity': 1.0},
+                            water_level=mag.settings['water_level'], pre_filt=(0.05, 0.1, 0.8 * nyquist, 0.9 * nyquist),
+                            taper=False, simulate_sensitivity=False)
+                reference.append((row.event_index, row.station, tr.stats.channel, np.abs(tr.data).max() * 1000))
+    reference_s = time.perf_counter() - t
+    reference = pd.DataFrame(reference, columns=['event_index', 'station', 'channel', 'amp_reference'])
+    matched = reference.merge(amps, on=['event_index', 'station', 'channel'])
+    ratio = matched['amp_mm'] / matched['amp_reference']
+
+    return {"events": int(windows['event_index'].nunique()), "windows": len(windows), "amplitudes": len(amps),
+            "engine_s": engine_s, "engine_windows_per_s": len(windows) / engine_s,
+            "reference_windows": len(sample), "reference_s": reference_s,
+            "reference_windows_per_s": len(sample) / reference_s,
+            "speedup": (len(windows) / engine_s) / (len(sample) / reference_s),
+            "max_amplitude_rel_diff": float(np.max(np.abs(ratio - 1))) if len(ratio) else None}
+
+def bench_focal(args):
+    """
+    First-motion kernel on --n-picks synthetic P windows, in one batch
+    against row by row, and the focal stage of the run in --config if given.
+    """
+    import numpy as np
+    from modules.focal import Focal, first_motion
+
+    rng = np.random.default_rng(42)
+    n, sampling_rate, pre, post = args.n_picks, 100.0, 0.5, 0.5
+    i_pick, npts = int(pre * sampling_rate), int((pre + post) * sampling_rate)
+    truth = np.where(rng.random(n) < 0.5, 1, -1)
+    amplitude = 10 ** rng.uniform(0, 2, n)
+    t = np.arange(npts - i_pick) / sampling_rate
+    windows = rng.standard_normal((n, npts))
+    windows[:, i_pick:] += (truth * amplitude)[:, None] * np.sin(2 * np.pi * 3 * t) * np.exp(-t / 0.3)
+    # picks off by up to 3 samples either way
+    windows = np.stack([np.roll(w, s) for w, s in zip(windows, rng.integers(-3, 4, n))])
+
+    tolerance = 5
+    t0 = time.perf_counter()
+    polarity, quality, snr = first_motion(windows, i_pick, tolerance)
+    batch_s = time.perf_counter() - t0
+    m = min(n, 5000)
+    t0 = time.perf_counter()
+    for w in windows[:m]:
+        first_motion(w[None, :], i_pick, tolerance)
+    row_s = (time.perf_counter() - t0) * n / m
+
+    known = polarity != 0
+    report = {"picks": n, "batch_s": batch_s, "batch_picks_per_s": n / batch_s, "row_by_row_s": row_s,
+              "speedup": row_s / batch_s, "coverage": float(known.mean()),
+              "accuracy": float((polarity[known] == truth[known]).mean()),
+              "impulsive_accuracy": float((polarity[quality == 'I'] == truth[quality == 'I']).mean())}
+    if args.config:
+        focal = Focal(load_config(args.config))
+        t0 = time.perf_counter()
+        focal.run_polarity(args.processes)
+        report["stage_s"] = time.perf_counter() - t0
+        report["stage_picks"] = len(focal.p_picks())
+        report["stage_picks_per_s"] = report["stage_picks"] / report["stage_s"]
+    return report
+
+def bench_catalog(args):
+    """
+    Build the catalog of --n-picks synthetic GaMMA events (four picks each,
+    one in ten relocated by h3dd), then time its queries and exports against
+    scanning gamma_events.csv with pandas.
+    """
+    import os
+    import tempfile
+    import numpy as np
+    import pandas as pd
+    from modules.aso_gamma import h3dd_event_line
+    from modules.catalog import Catalog
+
+    rng = np.random.default_rng(42)
+    tmp = Path(tempfile.mkdtemp(prefix='aq_catalog_'))
+    n = args.n_picks
+    pd.DataFrame({'net': 'TW', 'station': [f'S{i:03d}' for i in range(50)], 'lon': rng.uniform(121.2, 122.2, 50),
+                  'lat': rng.uniform(23.5, 24.5, 50), 'elevation_m': 0.0}).to_csv(tmp / 'stations.csv', index=False)
+    config = {"waveform_dir": str(tmp), "name_of_eq_sequence": "catalog", "analyze_range": "20240402-20240402",
+              "station_path": str(tmp / 'stations.csv'), "1D_velocity_model": "", "3D_velocity_model": "",
+              "association_method": "gamma"}
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    try:
+        catalog = Catalog(config)
+        gamma_dir = catalog.output_base_dir / 'GaMMA'
+        gamma_dir.mkdir(parents=True, exist_ok=True)
+        t0 = pd.Timestamp('2024-04-02')
+        origin = t0 + pd.to_timedelta(np.sort(rng.uniform(0, 365 * 86400, n)), unit='s')
+        events = pd.DataFrame({'time': origin.strftime('%Y-%m-%dT%H:%M:%S.%f').str[:-3], 'magnitude': 999, 'gamma_score': 10.0,
+                               'event_index': np.arange(n), 'longitude': rng.uniform(121.2, 122.2, n),
+                               'latitude': rng.uniform(23.5, 24.5, n), 'depth_km': rng.uniform(0, 40, n)})
+        events.to_csv(catalog.gamma_events, index=False)
+        k = np.repeat(np.arange(n), 4)
+        pd.DataFrame({'station_id': [f'S{i:03d}' for i in rng.integers(0, 50, len(k))],
+                      'phase_time': (origin[k] + pd.to_timedelta(rng.uniform(1, 20, len(k)), unit='s')).strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                      'phase_score': 0.9, 'phase_type': np.tile(['p', 'p', 's', 's'], n), 'event_index': k}).to_csv(catalog.gamma_picks, index=False)
+        catalog.h3dd_catalog.parent.mkdir(parents=True, exist_ok=True)
+        with open(catalog.h3dd_catalog, 'w') as f:
+            for e in events.iloc[::10].itertuples(index=False):
+                f.write(h3dd_event_line(pd.Timestamp(e.time) + pd.Timedelta(seconds=0.3), e.longitude + 0.01, e.latitude, e.depth_km))
+
+        t = time.perf_counter()
+        cat = catalog.build_catalog()
+        build_s = time.perf_counter() - t
+        queries = {
+            "time_range": lambda: cat.query('2024-06-01', '2024-06-08'),
+            "box": lambda: cat.query(lon=(121.5, 121.6), lat=(23.9, 24.0)),
+            "box_time_magnitude": lambda: cat.query('2024-06-01', '2024-09-01', lon=(121.5, 121.6), lat=(23.9, 24.0), depth=(0, 20)),
+            "within_10km": lambda: cat.within(121.7, 24.0, 10.0),
+            "nearest_10": lambda: cat.nearest(121.7, 24.0, 10),
+        }
+        report = {"events": n, "build_s": build_s}
+        cat.spatial_index()
+        for name, query in queries.items():
+            t = time.perf_counter()
+            rows = query()
+            report[f"{name}_ms"] = (time.perf_counter() - t) * 1000
+            report[f"{name}_rows"] = len(rows[1] if isinstance(rows, tuple) else rows)
+        t = time.perf_counter()
+        df = pd.read_csv(catalog.gamma_events)
+        df = df[(df['longitude'] >= 121.5) & (df['longitude'] <= 121.6) & (df['latitude'] >= 23.9) & (df['latitude'] <= 24.0)]
+        report["csv_scan_box_ms"] = (time.perf_counter() - t) * 1000
+        rows = cat.query('2024-06-01', '2024-07-01')
+        t = time.perf_counter()
+        cat.to_csv(tmp / 'export.csv', rows)
+        report["export_csv_events_per_s"] = len(rows) / (time.perf_counter() - t)
+        t = time.perf_counter()
+        cat.to_h3dd(tmp / 'export.dat_ch', rows)
+        report["export_h3dd_events_per_s"] = len(rows) / (time.perf_counter() - t)
+    finally:
+        os.chdir(cwd)
+    return report
+
+def bench_realtime(args):
+    """
+    Watch mode fed by a dropper thread writing a 60 s SAC chunk of every
+    channel each --drop-interval seconds, with synthetic events picked by
+    ArrivalPicker; reports the event recall and the latency from a file
+    arriving to its event being appended to the catalog.
+    """
+    import os
+    import tempfile
+    import threading
+    import numpy as np
+    import pandas as pd
+    from obspy import Trace, UTCDateTime
+    from pyproj import Proj
+    from modules.realtime import RealtimeWatcher
+
+    rng = np.random.default_rng(42)
+    tmp = Path(tempfile.mkdtemp(prefix='aq_realtime_'))
+    t0 = UTCDateTime(2024, 4, 2)
+    chunk, n_chunks = 60, max(int(args.window // 60), 4)
+    n_stations = max(args.n_traces // 3, 8)
+    stations = pd.DataFrame({'net': 'TW', 'station': [f'S{i:03d}' for i in range(n_stations)],
+                             'lon': rng.uniform(121.4, 122.0, n_stations), 'lat': rng.uniform(23.7, 24.3, n_stations),
+                             'elevation_m': 0.0})
+    stations.to_csv(tmp / 'stations.csv', index=False)
+    with open(tmp / 'vel_1d.csv', 'w') as f:
+        f.write("0,6.0,3.43\n60,6.0,3.43\n")
+    proj = Proj("+proj=sterea +lon_0=121.7 +lat_0=24.0 +units=km")
+    sx, sy = proj(longitude=stations['lon'].to_numpy(), latitude=stations['lat'].to_numpy())
+
+    # one event every 90-150 s, the last ones far enough from the end to be complete
+    origins = np.cumsum(rng.uniform(90, 150, n_chunks))
+    origins = t0.timestamp + origins[origins < chunk * n_chunks - 240]
+    arrivals = {sta: [] for sta in stations['station']}
+    for origin in origins:
+        x, y, z = rng.uniform(-25, 25), rng.uniform(-25, 25), rng.uniform(5, 15)
+        dist = np.sqrt((sx - x)**2 + (sy - y)**2 + z**2)
+        for sta, d in zip(stations['station'], dist):
+            arrivals[sta] += [(origin + d / 6.0, 'P'), (origin + d / 3.43, 'S')]
+
+    day_dir = tmp / 'raw' / t0.strftime('%Y%m%d')
+    day_dir.mkdir(parents=True)
+    config = {"waveform_dir": str(tmp / 'raw'), "name_of_eq_sequence": "realtime", "analyze_range": f"{t0.strftime('%Y%m%d')}-{t0.strftime('%Y%m%d')}",
+              "station_path": str(tmp / 'stations.csv'), "1D_velocity_model": str(tmp / 'vel_1d.csv'), "3D_velocity_model": "",
+              "association_method": "gamma", "watch_interval": args.drop_interval / 4, "watch_max_lag": 0, "pick_overlap": 30,
+              "max_travel_time": 60, "eikonal_cache_dir": str(tmp / 'eikonal_cache')}
+
+    def drop(k):
+        for sta in stations['station']:
+            for comp in 'ZNE':
+                tr = Trace(rng.standard_normal(chunk * 20).astype(np.float32),
+                           header={'network': 'TW', 'station': sta, 'location': '00', 'channel': f'HH{comp}',
+                                   'sampling_rate': 20.0, 'starttime': t0 + k * chunk})
+                path = day_dir / f'{tr.id}.D.2024.093.{k:04d}'
+                tmp_path = path.with_name(f'.{path.name}.tmp')
+                tr.write(str(tmp_path), format='SAC')
+                os.replace(tmp_path, path)
+
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    try:
+        drop(0)
+        watcher = RealtimeWatcher(config, picker=ArrivalPicker(arrivals))
+        watcher.create_directory_structure()
+        watcher.horizon = t0.timestamp
+        stop = threading.Event()
+        def dropper():
+            for k in range(1, n_chunks):
+                time.sleep(args.drop_interval)
+                drop(k)
+            stop.set()
+        thread = threading.Thread(target=dropper)
+        t = time.perf_counter()
+        thread.start()
+        watcher.start()
+        cycles = []
+        while True:
+            done = stop.is_set()
+            c = time.perf_counter()
+            watcher.cycle()
+            cycles.append(time.perf_counter() - c)
+            if done:
+                break
+            time.sleep(max(0.0, watcher.interval - cycles[-1]))
+        wall = time.perf_counter() - t
+        thread.join()
+        latency = pd.read_csv(watcher.realtime_dir / 'latency.csv')
+        events = pd.read_csv(watcher.gamma_events)
+    finally:
+        os.chdir(cwd)
+
+    emitted = np.array([UTCDateTime(e).timestamp for e in events['time']])
+    matched = np.abs(origins[:, None] - emitted[None, :]) <= 2.0 if len(emitted) else np.zeros((len(origins), 0), dtype=bool)
+    return {"stations": n_stations, "chunks": n_chunks, "chunk_s": chunk, "drop_interval_s": args.drop_interval,
+            "events_true": len(origins), "events_emitted": len(events), "recall": float(matched.any(axis=1).mean()),
+            "precision": float(matched.any(axis=0).mean()) if len(emitted) else 0.0,
+            "wall_s": wall, "cycles": len(cycles), "cycle_p50_s": float(np.median(cycles)), "cycle_max_s": float(np.max(cycles)),
+            "latency_p50_s": float(latency['latency_s'].median()), "latency_p90_s": float(latency['latency_s'].quantile(0.9)),
+            "latency_max_s": float(latency['latency_s'].max())}
+
+def bench_pipeline(args):
+    """
+    Every stage that runs without a picker model on a synthetic dataset
+    (see synthetic.py) of --n-stations stations with mixed HH/BH/EH/HN
+    channels split into --segments files and --n-events events:
+    filter_single_equip, the per-day merging worker (stage named after it)
+    against merge_waveform, the pick store read and GaMMA setup of
+    run_gamma_association (eikonal tables solved and then cached),
+    gamma2h3dd and the h3dd chunk workspaces run with a stub h3dd, and the
+    catalog build. Stages are measured with RunMetrics; the run JSON is
+    kept under the dataset's metrics directory.
+    """
+    import os
+    import shutil
+    import tempfile
+    from core.initializer import Initializer, merging
+    from core.metrics import RunMetrics, add_items
+    from core.pick_store import read_picks
+    from core.scheduler import run_tasks
+    from modules.aso_gamma import Aso_gamma
+    from modules.catalog import Catalog
+    from modules.eikonal_cache import load_eikonal
+    from modules.h3dd import H3dd
+    from synthetic import write_dataset
+
+    tmp = Path(tempfile.mkdtemp(prefix='aq_pipeline_'))
+    t = time.perf_counter()
+    config, summary = write_dataset(tmp, args.n_stations, args.n_events, args.days, args.seconds, args.segments)
+    generate_s = time.perf_counter() - t
+    config["n_workers"] = args.processes or os.cpu_count()
+
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    try:
+        init = Initializer(config)
+        metrics = RunMetrics(init.output_base_dir / 'metrics')
+        with metrics.stage('init'):
+            init.create_directory_structure()
+        stations = init.load_stations().stations
+        with metrics.stage('filter'):
+            init.filter_single_equip()
+        with metrics.stage('merging'):
+            run_tasks(merging, [(day, (day, stations, init.output_base_dir, 'sac'), 1) for day in init.date_list], init.n_workers)
+        for day in init.date_list:
+            shutil.rmtree(init.output_base_dir / 'data' / day / 'data_final')
+        with metrics.stage('merge'):
+            init.merge_waveform()
+
+        aso = Aso_gamma(config, picks=[])
+        shutil.copytree(tmp / 'truth' / 'picks', aso.pick_store, dirs_exist_ok=True)
+        for cached in ['cold', 'cached']:
+            with metrics.stage(f'associate_setup_{cached}'):
+                aso.picks = read_picks(aso.pick_store, days=aso.date_list, stations=aso.load_stations().stations)
+                picks, _, gamma_config, _ = aso.gamma_inputs()
+                load_eikonal(gamma_config["eikonal"], aso.eikonal_cache_dir, aso.eikonal_cache_size)
+                add_items(len(picks))
+
+        for name in ['gamma_events.csv', 'gamma_picks.csv']:
+            shutil.copy(tmp / 'truth' / 'GaMMA' / name, aso.output_base_dir / 'GaMMA' / name)
+        with metrics.stage('convert'):
+            aso.gamma2h3dd()
+        h3dd = H3dd(config)
+        with metrics.stage('relocate'):
+            h3dd.run_h3dd_parallel(config.get('cut_off_dist', 3))
+        with metrics.stage('catalog'):
+            Catalog(config).build_catalog()
+        metrics.close()
+    finally:
+        os.chdir(cwd)
+
+    report = dict(summary, generate_s=generate_s, workers=config["n_workers"], metrics_dir=str(metrics.metrics_dir))
+    for record in metrics.stages:
+        stage = record['stage']
+        report[f'{stage}_s'] = record['wall_s']
+        report[f'{stage}_cpu_s'] = record['cpu_s'] + record['task_cpu_s']
+        report[f'{stage}_items'] = record['items']
+        if record['items']:
+            report[f'{stage}_items_per_s'] = record['items'] / max(record['wall_s'], 1e-9)
+        report[f'{stage}_max_rss_mb'] = max(record['max_rss_mb'], record['task_max_rss_mb'])
+    return report
+
+BENCHMARKS = {
+    "gamma_partition": bench_gamma_partition,
+    "pick_table": bench_pick_table,
+    "pick_store": bench_pick_store,
+    "cpu_picker": bench_cpu_picker,
+    "import_time": bench_import_time,
+    "waveform_store": bench_waveform_store,
+    "realtime": bench_realtime,
+    "station_registry": bench_station_registry,
+    "magnitude": bench_magnitude,
+    "focal": bench_focal,
+    "catalog": bench_catalog,
+    "pipeline": bench_pipeline,
+}
+
+# arguments that set the size of the synthetic data, reports are only compared at equal scale
+SCALE_ARGS = ['n_picks', 'n_traces', 'n_stations', 'n_events', 'days', 'seconds', 'segments', 'window', 'overlap', 'processes']
+
+def git_version():
+    """
+    git describe of the checkout the benchmark runs from, 'unknown' outside a repository.
+    """
+    try:
+        out = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=Path(__file__).parent,
+                             capture_output=True, text=True, timeout=30)
+    except (OSError, subprocess.SubprocessError):
+        return 'unknown'
+    return out.stdout.strip() or 'unknown'
+
+def compare_reports(report, baseline_path, tolerance=0.2, min_seconds=0.05):
+    """
+    Compare the timings of a report with the last report of the same
+    benchmark and scale in a JSON-lines file written with --output. Keys
+    ending in _per_s are rates (higher is better), other keys ending in _s
+    are durations (lower is better); durations under min_seconds in both
+    reports are too short to compare.
+    :return: Version of the baseline or None when there is none, and a list
+        of (key, baseline, current, ratio, regressed)
+    """
+    baseline = None
+    with open(baseline_path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            previous = json.loads(line)
+            if previous.get('benchmark') == report['benchmark'] and previous.get('scale') == report['scale']:
+                baseline = previous
+    if baseline is None:
+        return None, []
+    rows = []
+    for key, value in report.items():
+        old = baseline.get(key)
+        if not key.endswith('_s') or isinstance(value, bool) or not isinstance(value, (int, float)) \
+                or not isinstance(old, (int, float)) or old <= 0:
+            continue
+        ratio = value / old
+        if key.endswith('_per_s'):
+            regressed = ratio < 1 / (1 + tolerance)
+        else:
+            if max(value, old) < min_seconds:
+                continue
+            regressed = ratio > 1 + tolerance
+        rows.append((key, old, value, ratio, regressed))
+    return baseline.get('version', 'unknown'), rows
+
+def main():
+    parser = argparse.ArgumentParser(description="AutoQuake benchmarks")
+    parser.add_argument('name', choices=sorted(BENCHMARKS), help='Benchmark to run')
+    parser.add_argument('--config', type=Path, help='Path to configuration JSON file')
+    parser.add_argument('--picks', type=Path, help='Pick store directory or pick CSV')
+    parser.add_argument('--window', type=float, default=3600, help='Association or read window in seconds')
+    parser.add_argument('--overlap', type=float, default=120, help='Association window overlap in seconds')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes')
+    parser.add_argument('--n-picks', type=int, default=1_000_000, help='Number of synthetic picks')
+    parser.add_argument('--n-traces', type=int, default=30, help='Number of synthetic day-long traces')
+    parser.add_argument('--drop-interval', type=float, default=2.0, help='Seconds between two waveform chunks of the realtime benchmark')
+    parser.add_argument('--n-stations', type=int, default=50, help='Number of synthetic stations of the pipeline benchmark')
+    parser.add_argument('--n-events', type=int, default=500, help='Number of synthetic events of the pipeline benchmark')
+    parser.add_argument('--days', type=int, default=1, help='Number of synthetic days of the pipeline benchmark')
+    parser.add_argument('--seconds', type=float, default=600, help='Seconds of synthetic waveforms per day of the pipeline benchmark')
+    parser.add_argument('--segments', type=int, default=3, help='Files every synthetic channel-day is split into')
+    parser.add_argument('--output', type=Path, help='Append the JSON report to this file')
+    parser.add_argument('--baseline', type=Path, help='JSON-lines reports to compare against, exits with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative slowdown counted as a regression')
+    args = parser.parse_args()
+
+    report = BENCHMARKS[args.name](args)
+    report["benchmark"] = args.name
+    report["version"] = git_version()
+    report["created"] = datetime.now().isoformat(timespec='seconds')
+    report["scale"] = {key: getattr(args, key) for key in SCALE_ARGS}
+    print(json.dumps(report, indent=2))
+    regressed = False
+    if args.baseline and args.baseline.is_file():
+        version, rows = compare_reports(report, args.baseline, args.tolerance)
+        if version is None:
+            print(f"no {args.name} report at this scale in {args.baseline}")
+        else:
+            print(f"against {version}:")
+            for key, old, value, ratio, worse in rows:
+                print(f"  {key:<40} {old:>12.4g} -> {value:>12.4g}  x{ratio:.2f}{'  REGRESSION' if worse else ''}")
+            regressed = any(worse for *_, worse in rows)
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+    if regressed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
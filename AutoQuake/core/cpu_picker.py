@@ -0,0 +1,115 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+BATCH_CANDIDATES = (32, 64, 128, 256, 512, 1024)
+
+def configure_threads(intra_op=None, inter_op=None):
+    """
+    Size the torch thread pools of a CPU node.
+    :param intra_op: Threads splitting a single operator, defaults to all cores
+    :param inter_op: Threads running independent operators; torch only
+        accepts this once per process, before any parallel work
+    :return: (intra_op, inter_op) in effect
+    """
+    torch.set_num_threads(intra_op or os.cpu_count())
+    if inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError:
+            pass
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+def available_memory():
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+def window_bytes(picker):
+    """
+    Upper bound of the activation memory of one input window: the outputs
+    of every layer of a single-window forward pass, added up.
+    """
+    sizes = []
+    hooks = [module.register_forward_hook(lambda m, i, o: sizes.append(o.numel() * o.element_size()))
+             for module in picker.modules() if not list(module.children())]
+    try:
+        with torch.no_grad():
+            picker(torch.zeros(1, len(picker.component_order), picker.in_samples))
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return sum(sizes)
+
+def script_picker(picker):
+    """
+    Run the forward pass of a SeisBench picker as a traced and frozen
+    TorchScript graph; freezing folds the BatchNorm layers into the
+    convolutions. classify/annotate keep working on the picker itself.
+    """
+    picker.eval()
+    example = torch.zeros(1, len(picker.component_order), picker.in_samples)
+    with torch.no_grad():
+        traced = torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.trace(picker, example)))
+    def forward(x, logits=False):
+        return traced(x)
+    picker.forward = forward
+    return picker
+
+def autotune_batch_size(picker, per_window, memory_fraction=0.25, candidates=BATCH_CANDIDATES, repeats=2):
+    """
+    Time the forward pass on the candidate batch sizes that fit in
+    memory_fraction of the available memory and keep the fastest.
+    :param per_window: Bytes needed per window, see window_bytes
+    :return: batch size, {batch size: windows/s}
+    """
+    limit = max(1, int(available_memory() * memory_fraction / per_window))
+    sizes = [b for b in candidates if b <= limit] or [limit]
+    rates = {}
+    for batch_size in sizes:
+        x = torch.randn(batch_size, len(picker.component_order), picker.in_samples)
+        with torch.no_grad():
+            picker(x)
+            t0 = time.perf_counter()
+            for _ in range(repeats):
+                picker(x)
+        rates[batch_size] = batch_size * repeats / (time.perf_counter() - t0)
+    return max(rates, key=rates.get), rates
+
+def prepare_cpu_picker(picker, jit=False, batch_size='auto', memory_fraction=0.25):
+    """
+    CPU inference mode of a SeisBench picker.
+    :param jit: Run the forward pass as TorchScript, see script_picker
+    :param batch_size: Fixed batch size or 'auto' for autotune_batch_size
+    :return: picker, batch size
+    """
+    picker.eval()
+    per_window = window_bytes(picker)
+    if jit:
+        picker = script_picker(picker)
+    if batch_size == 'auto':
+        batch_size, rates = autotune_batch_size(picker, per_window, memory_fraction)
+        print(f"picker batch size {batch_size} ({', '.join(f'{b}: {r:.0f}' for b, r in rates.items())} windows/s)")
+    return picker, int(batch_size)
+
+def prefetch(func, items):
+    """
+    Yield func(item) for every item, computing the next one in a
+    background thread while the caller works on the current one, so that
+    reading and resampling waveforms overlaps with inference.
+    """
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = None
+        for item in items:
+            future = pool.submit(func, item)
+            if pending is not None:
+                yield pending.result()
+            pending = future
+        if pending is not None:
+            yield pending.result()
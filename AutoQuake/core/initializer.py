@@ -1,116 +1,50 @@
 import os
-import glob
+import gc
 from pathlib import Path
+import time
 import shutil
 import logging
-import multiprocessing as mp
-from obspy import read
+from collections import Counter
+from functools import partial
+from obspy import read, UTCDateTime
 from obspy.core.stream import Stream
-import seisbench.models as sbm
-import torch
-from core.utils import date_range, get_sta_list
+from core.utils import date_range
+from core.waveform_index import DEFAULT_CHANNEL_PRIORITY, scan_day_dir, select_channels, link_file, write_sac, remove_stale, read_sac_window
+from core.waveform_store import STORE_NAME, DayStore, read_index, read_window
+from core.scheduler import run_tasks, write_timings
+from core.merge_engine import plan_day, merge_station
+from core.manifest import StageManifest, fingerprint
+from core.pick_store import PICK_DIR, PickWriter, store_path
+from core.metrics import add_items
+from core.station_registry import DEFAULT_CENTER, load_registry
 
-def equip_filter(args):
-    day, station_list, output_base_dir, data_path = args
+def link_station(args):
+    sta, equip, paths, output_base_dir, process_dir_path, link_mode = args
     logging.basicConfig(filename=output_base_dir / 'log' / f'data_single.log', level=logging.INFO, filemode='a')
-    process_dir_path = output_base_dir /'data' / day / 'data_single'
-    process_dir_path.mkdir(parents=True, exist_ok=True)
-    for sta in station_list:
-        logging.info(f"We are in {sta}")
-        station_sac_all = glob.glob(os.path.join(data_path, day, f"*{sta}*"))
-        logging.info(f"station_sac_all:{station_sac_all}")
-        #station_sac_all = (Path(data_path) / day).glob(f"*{sta}*")
-        checkpoint = 0
-        try:
-            # HH
-            for station_sac in station_sac_all:
-                station_equip = os.path.basename(station_sac).split('.')[3][:2]
-                logging.info(f'station_eauip:{station_equip}')
-                if station_equip == 'HH':
-                    checkpoint = 1  # record we have HH
-                    shutil.copy(station_sac, process_dir_path)
-                    logging.info(f"{sta} using HH")
-                else:
-                    logging.info(f"{sta} don't have HH")
-            # BH
-            for station_sac in station_sac_all:
-                if checkpoint == 1:
-                    break
-                station_equip = os.path.basename(station_sac).split('.')[3][:2]
-                logging.info(f'station_eauip:{station_equip}')
-                if station_equip == 'BH':
-                    checkpoint = 2
-                    shutil.copy(station_sac, process_dir_path)
-                    logging.info(f"{sta} using BH")
-                else:
-                    logging.info(f"{sta} don't have BH")
-            # EH
-            for station_sac in station_sac_all:
-                if checkpoint in [1, 2]:
-                    break
-                station_equip = os.path.basename(station_sac).split('.')[3][:2]
-                if station_equip == 'EH':
-                    checkpoint = 3
-                    shutil.copy(station_sac, process_dir_path)
-                    logging.info(f"{sta} using EH")
-                else:
-                    logging.info(f"{sta} don't have EH")
-            # EP
-            for station_sac in station_sac_all:
-                if checkpoint in [1, 2, 3]:
-                    break
-                station_equip = os.path.basename(station_sac).split('.')[3][:2]
-                if station_equip == 'EP':
-                    checkpoint = 4
-                    shutil.copy(station_sac, process_dir_path)
-                    logging.info(f"{sta} using EP")
-                else:
-                    logging.info(f"{sta} don't have EP")
-            # HL
-            for station_sac in station_sac_all:
-                if checkpoint in [1, 2, 3, 4]:
-                    break
-                station_equip = os.path.basename(station_sac).split('.')[3][:2]
-                if station_equip == 'HL':
-                    checkpoint = 5
-                    shutil.copy(station_sac, process_dir_path)
-                    logging.info(f"{sta} using HL")
-                else:
-                    logging.info(f"{sta} don't have HL")
-            # BL
-            for station_sac in station_sac_all:
-                if checkpoint in [1, 2, 3, 4, 5]:
-                    break
-                station_equip = os.path.basename(station_sac).split('.')[3][:2]
-                if station_equip == 'BL':
-                    checkpoint = 6
-                    shutil.copy(station_sac, process_dir_path)
-                    logging.info(f"{sta} using BL")
-                else:
-                    logging.info(f"{sta} don't have BL")
-            # HN
-            for station_sac in station_sac_all:
-                if checkpoint in [1, 2, 3, 4, 5, 6]:
-                    break
-                station_equip = os.path.basename(station_sac).split('.')[3][:2]
-                if station_equip == 'HN':
-                    checkpoint = 7
-                    shutil.copy(station_sac, process_dir_path)
-                    logging.info(f"{sta} using HN")
-                else:
-                    logging.info(f"{sta} don't have HN")
-        except Exception as e:
-            logging.info(f"We don't have {sta} so error {e}")
+    logging.info(f"{sta} using {equip}")
+    for station_sac in paths:
+        link_file(station_sac, process_dir_path, link_mode)
+    add_items(len(paths))
+    return len(paths)
 
 def merging(args):
-    date, station_list, output_base_dir = args
+    date, station_list, output_base_dir, merge_format = args
     logging.basicConfig(filename=output_base_dir / 'log' / f'data_final.log', level=logging.INFO, filemode='a')
     ori_data_dir = output_base_dir / 'data' / date / 'data_single' 
     output_data_dir = output_base_dir / 'data' / date / 'data_final'
     output_data_dir.mkdir(parents=True, exist_ok=True)
+    store = DayStore(output_data_dir / STORE_NAME) if merge_format == 'hdf5' else None
+    try:
+        merge_stations(station_list, ori_data_dir, output_data_dir, store)
+    finally:
+        if store is not None:
+            add_items(len(store.rows))
+            store.close()
+
+def merge_stations(station_list, ori_data_dir, output_data_dir, store=None):
     for station in station_list:
         logging.info(f'we are in {station} now!')
-        data_premerges = list(ori_data_dir.glob(f"*{station}*"))
+        data_premerges = list(ori_data_dir.glob(f"*.{station}.*"))
         if not data_premerges:
             logging.info(f"we did not have {station} data, pass")
             continue
@@ -128,7 +62,7 @@ def merging(args):
         logging.info(f"numeral list is {numeral_list}")
         for equip in equip_list:
             for numeral in numeral_list:
-                num_file = list(ori_data_dir.glob(f'*{station}.{numeral}.{equip}*'))
+                num_file = list(ori_data_dir.glob(f'*.{station}.{numeral}.{equip}*'))
                 logging.info(f'we got {numeral}.{equip} for {len(num_file)}')
                 if len(num_file) > 1:
                     st_add = Stream()
@@ -139,7 +73,10 @@ def merging(args):
                         st_add.merge(fill_value='interpolate')
                     except Exception as e:
                         logging.info(f"{e} happened in {numeral}.{equip}")
-                    st_add.write(os.path.join(output_data_dir, os.path.basename(num_file[0])),format='SAC')
+                    if store is None:
+                        write_sac(st_add, os.path.join(output_data_dir, os.path.basename(num_file[0])))
+                    else:
+                        store.add(st_add, os.path.basename(num_file[0]))
                     logging.info('save your tears for another day')
                 elif len(num_file) == 0:
                     logging.info(f'No data in {numeral}.{equip}')
@@ -147,7 +84,10 @@ def merging(args):
                 else:
                     logging.info('only U')
                     st_ori = read(num_file[0])
-                    st_ori.write(os.path.join(output_data_dir, os.path.basename(num_file[0])),format='SAC')
+                    if store is None:
+                        write_sac(st_ori, os.path.join(output_data_dir, os.path.basename(num_file[0])))
+                    else:
+                        store.add(st_ori, os.path.basename(num_file[0]))
 def add(args):
     output_base_dir, date = args
     stream_path = os.listdir(output_base_dir / date / 'data' / 'data_single')
@@ -156,6 +96,46 @@ def add(args):
         st = read(sp)
         stream_add += st
         
+def day_start(day):
+    return UTCDateTime(f"{day[:4]}-{day[4:6]}-{day[6:]}")
+
+def pick_windows(date_list, window, overlap):
+    """
+    Split the analyze range into fixed windows.
+    Yield (core_start, core_end, read_start, read_end); the read span pads the
+    core span with `overlap` seconds on both sides to avoid edge effects, and a
+    pick is only kept by the window whose core span holds its peak time.
+    """
+    t = day_start(date_list[0])
+    end = day_start(date_list[-1]) + 86400
+    while t < end:
+        core_end = min(t + window, end)
+        yield t, core_end, t - overlap, core_end + overlap
+        t = core_end
+
+def load_window(spans, window, sampling_rate=None):
+    """
+    Read the waveforms of one pick window, resampled to the picker rate.
+    SAC files are sliced through a memory map (see read_sac_window), so each
+    window only reads its own samples from the day-long files.
+    :param spans: list of (path, starttime, endtime, h5 index or None)
+    :param window: (core_start, core_end, read_start, read_end)
+    :return: window, Stream
+    """
+    _, _, read_start, read_end = window
+    stream = Stream()
+    for sp, starttime, endtime, index in spans:
+        if endtime < read_start or starttime > read_end:
+            continue
+        if index is None:
+            stream += read_sac_window(sp, read_start, read_end)
+        else:
+            stream += read_window(sp, read_start, read_end, index=index)
+    if sampling_rate is not None:
+        from seisbench.models import WaveformModel
+        WaveformModel.resample(stream, sampling_rate)
+    return window, stream
+
 class Initializer:
     def __init__(self, config):
         self.config = config
@@ -166,6 +146,20 @@ class Initializer:
         self.station_path = config['station_path']
         self.vel_model_1d = config['1D_velocity_model']
         self.vel_model_3d = config['3D_velocity_model']
+        self.channel_priority = config.get('channel_priority', DEFAULT_CHANNEL_PRIORITY)
+        self.link_mode = config.get('link_mode', 'hardlink')
+        self.merge_format = config.get('merge_format', 'sac')
+        self.n_workers = config.get('n_workers', os.cpu_count())
+        self.manifest = StageManifest(self.output_base_dir / 'manifest.json')
+        self.pick_store = self.output_base_dir / 'phasenet' / PICK_DIR
+        self.picker = None
+        self.pick_batch_size = config.get('pick_batch_size', 256)
+        self.picker_jit = config.get('picker_jit', False)
+        self.torch_threads = config.get('torch_threads')
+        self.torch_interop_threads = config.get('torch_interop_threads')
+        # reading the next pick window during inference doubles the waveforms held in memory
+        self.pick_prefetch = config.get('pick_prefetch', False)
+        self.station_cache_dir = Path(config.get('station_cache_dir', self.current_dir / 'output' / 'station_cache'))
         if not config.get("pz_dir"):
             self.mag_run = False
         else:
@@ -179,7 +173,7 @@ class Initializer:
         self.output_base_dir.mkdir(parents=True, exist_ok=True)
         (self.output_base_dir / "log").mkdir(parents=True, exist_ok=True)
         (self.output_base_dir / "data").mkdir(parents=True, exist_ok=True)
-        #(self.output_base_dir / "phasenet").mkdir(parents=True, exist_ok=True)
+        (self.output_base_dir / "phasenet").mkdir(parents=True, exist_ok=True)
         (self.output_base_dir / "h3dd").mkdir(parents=True, exist_ok=True)
         (self.output_base_dir / "Magnitude").mkdir(parents=True, exist_ok=True)
         (self.output_base_dir / "Focal").mkdir(parents=True, exist_ok=True)
@@ -196,30 +190,101 @@ class Initializer:
         shutil.copy(station_path, self.output_base_dir / "stations.csv")
         
         # generate station format for h3dd
-        with open(self.station_path, 'r') as r:
-            with open(self.output_base_dir / 'h3dd_station_format', 'w') as output:
-                lines = r.readlines()
-                for line in lines:
-                    if line[:3] == 'net':
-                        continue
-                    else:
-                        parts = line.strip().split(',')
-                        new_line = f"{parts[1]} {parts[2]} {parts[3]} {parts[4]} 19010101 21001231\n"
-                        output.write(new_line)
+        self.load_stations().write_h3dd_stations(self.output_base_dir / 'h3dd_station_format')
+    def load_stations(self, center=DEFAULT_CENTER):
+        """
+        Station registry of station_path projected around center (lon, lat), see core.station_registry.
+        """
+        return load_registry(self.station_path, center, cache_dir=self.station_cache_dir)
     def filter_single_equip(self):
+        """
+        Scan each day once, then link the chosen files with one (day, station)
+        task per station, weighted by bytes, across n_workers processes.
+        """
         days = self.date_list
-        station_list = get_sta_list(self.station_path)
-        args = [(day, station_list, self.output_base_dir, self.data_path) for day in days]
-        cores = min(len(days), 10)
-        with mp.Pool(processes=cores) as pool:
-            pool.map(equip_filter, args)
+        station_list = self.load_stations().stations
+        tasks = []
+        todo = {}
+        for day in days:
+            digest = fingerprint(files=[self.station_path], dirs=[Path(self.data_path) / day],
+                                 params=[self.channel_priority, self.link_mode])
+            if self.manifest.is_current(f'filter/{day}', digest):
+                print(f"{day}: channel selection is up to date, skip")
+                continue
+            todo[day] = digest
+            process_dir_path = self.output_base_dir /'data' / day / 'data_single'
+            process_dir_path.mkdir(parents=True, exist_ok=True)
+            t0 = time.perf_counter()
+            index_df = scan_day_dir(os.path.join(self.data_path, day))
+            t1 = time.perf_counter()
+            chosen = select_channels(index_df, station_list, self.channel_priority)
+            t2 = time.perf_counter()
+            print(f"{day}: scanned {len(index_df)} files in {t1 - t0:.3f} s, selected {len(chosen)} in {t2 - t1:.3f} s")
+            stale = remove_stale(process_dir_path, keep=chosen['path'].map(os.path.basename))
+            if stale:
+                print(f"{day}: removed {stale} files of an earlier channel selection")
+            for sta, rows in chosen.groupby('station'):
+                args = (sta, rows['equip'].iloc[0], rows['path'].tolist(), self.output_base_dir, process_dir_path, self.link_mode)
+                tasks.append(((day, sta), args, rows['size'].sum()))
+        results, timings, wall = run_tasks(link_station, tasks, self.n_workers)
+        write_timings(timings, wall, self.output_base_dir / 'log' / 'filter_tasks.csv', 'filter_single_equip')
+        for day, digest in todo.items():
+            self.manifest.record(f'filter/{day}', digest, [self.output_base_dir / 'data' / day / 'data_single'])
     def merge_waveform(self):
+        """
+        Merge the station/location/channel groups of data_single with one
+        task per station-day, weighted by bytes (see core.merge_engine). The HDF5 archive is
+        written by a single process per day, so merge_format 'hdf5' keeps one
+        task per day.
+        """
         days = self.date_list
-        station_list = get_sta_list(self.station_path)
-        args = [(date, station_list, self.output_base_dir) for date in days]
-        cores = min(len(days), 10)
-        with mp.Pool(processes=cores) as pool:
-            pool.map(merging, args)   
+        station_list = self.load_stations().stations
+        log_file = self.output_base_dir / 'log' / 'data_final.log'
+        tasks = []
+        todo = {}
+        for date in days:
+            ori_data_dir = self.output_base_dir / 'data' / date / 'data_single'
+            output_data_dir = self.output_base_dir / 'data' / date / 'data_final'
+            digest = fingerprint(files=[self.station_path], dirs=[ori_data_dir], params=[self.merge_format])
+            if self.manifest.is_current(f'merge/{date}', digest):
+                print(f"{date}: merge is up to date, skip")
+                continue
+            todo[date] = digest
+            output_data_dir.mkdir(parents=True, exist_ok=True)
+            # data_final is rebuilt from data_single as a whole
+            remove_stale(output_data_dir)
+            groups = plan_day(ori_data_dir, station_list)
+            if self.merge_format == 'hdf5':
+                tasks.append((date, (date, station_list, self.output_base_dir, self.merge_format),
+                              sum(g[2] for sta_groups in groups.values() for g in sta_groups)))
+                continue
+            for sta, sta_groups in groups.items():
+                tasks.append(((date, sta), (sta, sta_groups, output_data_dir, self.link_mode, log_file), sum(g[2] for g in sta_groups)))
+        worker = merging if self.merge_format == 'hdf5' else merge_station
+        results, timings, wall = run_tasks(worker, tasks, self.n_workers)
+        write_timings(timings, wall, self.output_base_dir / 'log' / 'merge_tasks.csv', 'merge_waveform')
+        if self.merge_format != 'hdf5' and results:
+            modes = sum((Counter(counts) for counts, _ in results.values()), Counter())
+            n_traces = sum(n for _, n in results.values())
+            print(f"merge_waveform: {n_traces} traces in {wall:.2f} s ({n_traces / max(wall, 1e-9):.1f} traces/s), {dict(modes)}")
+        for date, digest in todo.items():
+            self.manifest.record(f'merge/{date}', digest, [self.output_base_dir / 'data' / date / 'data_final'])
+    def load_picker(self):
+        if self.picker is not None:
+            return self.picker
+        # torch and seisbench take seconds to import, only the pick stage needs them
+        import torch
+        import seisbench.models as sbm
+        from core.cpu_picker import configure_threads, prepare_cpu_picker
+        picker = sbm.PhaseNet.from_pretrained("original")
+        if torch.cuda.is_available():
+            picker.cuda()
+        else:
+            threads = configure_threads(self.torch_threads, self.torch_interop_threads)
+            picker, self.pick_batch_size = prepare_cpu_picker(picker, self.picker_jit, self.pick_batch_size)
+            print(f"CPU picker: {threads[0]} intra-op / {threads[1]} inter-op threads, batch size {self.pick_batch_size}")
+        self.picker = picker
+        return picker
     def run_phasenet(self):
         days = self.date_list
         stream_add = Stream()
@@ -228,12 +293,86 @@ class Initializer:
             for sp in sorted(stream_path):
                 st = read(sp)
                 stream_add += st
-        picker = sbm.PhaseNet.from_pretrained("original")
-        if torch.cuda.is_available():
-            picker.cuda()
-        picks = picker.classify(stream_add, batch_size=256).picks
+        picker = self.load_picker()
+        picks = picker.classify(stream_add, batch_size=self.pick_batch_size).picks
         #picks = picker.classify(stream_add, batch_size=256, P_threshold=0.075, S_threshold=0.1).picks
         return picks
+    def run_phasenet_streaming(self, window=3600, overlap=60, days=None):
+        """
+        Pick the analyze range window by window so that at most one window of
+        waveforms is held in memory. Picks are appended to the day files of
+        the pick store phasenet/picks/<day>.h5 after every window.
+
+        With pick_prefetch the next window is read in a background thread
+        while the current one is picked; reading overlaps with inference but
+        two windows are held in memory, doubling the peak window memory.
+        :param window: Length of a window in seconds
+        :param overlap: Padding in seconds read on each side of a window
+        :param days: Days to pick, the whole analyze range when None
+        :return: Pick store directory, see core.pick_store.read_picks
+
+        With merge_format 'hdf5' the windows are sliced from the day archives
+        in data_final instead of reading SAC files.
+        """
+        days = self.date_list if days is None else days
+        self.pick_store.mkdir(parents=True, exist_ok=True)
+        # the neighbouring days feed the overlap at day boundaries
+        positions = {self.date_list.index(day) for day in days}
+        read_days = [d for i, d in enumerate(self.date_list) if {i - 1, i, i + 1} & positions]
+        # header only, to know which files cover which window
+        spans = []
+        for day in read_days:
+            h5_path = self.output_base_dir / 'data' / day / 'data_final' / STORE_NAME
+            if self.merge_format == 'hdf5' and h5_path.is_file():
+                index = read_index(h5_path)
+                if len(index):
+                    spans.append((h5_path, UTCDateTime(index['starttime'].min()), UTCDateTime(index['endtime'].max()), index))
+                continue
+            for sp in sorted((self.output_base_dir / 'data' / day / 'data_single').glob('*')):
+                for tr in read(sp, headonly=True):
+                    spans.append((sp, tr.stats.starttime, tr.stats.endtime, None))
+                    break
+        from core.cpu_picker import prefetch
+        picker = self.load_picker()
+        load = partial(load_window, spans, sampling_rate=picker.sampling_rate)
+        n_picks = 0
+        for day in days:
+            with PickWriter(store_path(self.pick_store, day)) as writer:
+                windows = pick_windows([day], window, overlap)
+                loaded = prefetch(load, windows) if self.pick_prefetch else map(load, windows)
+                for (core_start, core_end, _, _), stream in loaded:
+                    if len(stream) == 0:
+                        continue
+                    picks = picker.classify(stream, batch_size=self.pick_batch_size).picks
+                    picks = [p for p in picks if core_start <= p.peak_time < core_end]
+                    writer.append(picks)
+                    n_picks += len(picks)
+                    logging.info(f"{core_start} - {core_end}: {len(stream)} traces, {len(picks)} picks")
+                    del stream, picks
+                    gc.collect()
+        add_items(n_picks)
+        print(f"{n_picks} picks written to {self.pick_store}")
+        return self.pick_store
+    def pick_days(self, window=3600, overlap=60):
+        """
+        Pick day by day into the pick store, skipping the days whose
+        waveforms and settings did not change since the last run.
+        :return: Day files of the whole analyze range
+        """
+        day_files = []
+        for i, day in enumerate(self.date_list):
+            day_file = store_path(self.pick_store, day)
+            day_files.append(day_file)
+            # the overlap reads into the neighbouring days
+            sources = [self.output_base_dir / 'data' / d / ('data_final' if self.merge_format == 'hdf5' else 'data_single')
+                       for d in self.date_list[max(i - 1, 0):i + 2]]
+            digest = fingerprint(dirs=sources, params=[window, overlap, self.merge_format])
+            if self.manifest.is_current(f'pick/{day}', digest):
+                print(f"{day}: picks are up to date, skip")
+                continue
+            self.run_phasenet_streaming(window, overlap, days=[day])
+            self.manifest.record(f'pick/{day}', digest, [day_file])
+        return day_files
     '''
     def get_materials(self):
         parent_dir = str(self.output_base_dir)
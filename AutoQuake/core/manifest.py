@@ -0,0 +1,85 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+from pathlib import Path
+
+HASH_LIMIT = 64 * 1024**2
+
+def update_file(sha, path):
+    """
+    Content hash of a file; files above HASH_LIMIT (waveforms) only
+    contribute their size and modification time.
+    """
+    path = Path(path)
+    if not path.exists():
+        sha.update(f"{path}:missing".encode())
+        return
+    stat = path.stat()
+    if path.is_dir():
+        update_dir(sha, path)
+    elif stat.st_size > HASH_LIMIT:
+        sha.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    else:
+        sha.update(str(path).encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024**2), b''):
+                sha.update(block)
+
+def update_dir(sha, path):
+    """
+    Listing hash of a waveform directory: name, size and modification time of every file.
+    """
+    path = Path(path)
+    if not path.is_dir():
+        sha.update(f"{path}:missing".encode())
+        return
+    with os.scandir(path) as entries:
+        listing = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in entries)
+    sha.update(f"{path}:{listing}".encode())
+
+def fingerprint(files=(), dirs=(), params=None):
+    """
+    Hash of the inputs and settings of a stage.
+    :param files: Files hashed by content
+    :param dirs: Directories hashed by their listing
+    :param params: JSON-serialisable settings
+    """
+    sha = hashlib.sha256()
+    for path in files:
+        update_file(sha, path)
+    for path in dirs:
+        update_dir(sha, path)
+    sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+class StageManifest:
+    """
+    output/<name_of_eq_sequence>/manifest.json: for every stage (or stage/day)
+    the fingerprint of its inputs and the outputs it produced.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.stages = {}
+        if self.path.is_file():
+            with open(self.path, 'r') as f:
+                self.stages = json.load(f)
+    def is_current(self, stage, digest):
+        entry = self.stages.get(stage)
+        if entry is None or entry['inputs'] != digest:
+            return False
+        # a stage that produced nothing is never up to date
+        return bool(entry['outputs']) and all(Path(output).exists() for output in entry['outputs'])
+    def record(self, stage, digest, outputs):
+        self.stages[stage] = {
+            'inputs': digest,
+            'outputs': [str(output) for output in outputs],
+            'finished': datetime.now().isoformat(timespec='seconds'),
+        }
+        self.save()
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.stages, f, indent=2)
+        os.replace(tmp, self.path)
@@ -0,0 +1,108 @@
+import os
+import logging
+from collections import Counter
+import numpy as np
+from obspy import read
+from obspy.core.stream import Stream
+from obspy.io.sac import SACTrace
+from core.waveform_index import scan_day_dir, link_file, write_sac
+from core.metrics import add_items
+
+def plan_day(ori_data_dir, station_list):
+    """
+    Group the files of data_single by station, location and channel from a
+    single directory listing.
+    :return: {station: list of (group id, sorted paths, total bytes)}
+    """
+    index = scan_day_dir(ori_data_dir)
+    index = index[index['station'].isin(station_list)]
+    stations = {}
+    for (sta, loc, cha), rows in index.groupby(['station', 'location', 'channel']):
+        stations.setdefault(sta, []).append((f"{sta}.{loc}.{cha}", sorted(rows['path']), int(rows['size'].sum())))
+    return stations
+
+def plan_group(spans):
+    """
+    Decide from the headers alone how a group becomes one trace.
+    :param spans: list of (path, starttime, endtime, sampling rate)
+    :return: ('single' | 'covered' | 'contiguous' | 'merge', path to pass through or None)
+    """
+    if len(spans) == 1:
+        return 'single', spans[0][0]
+    if len({sr for _, _, _, sr in spans}) == 1:
+        spans = sorted(spans, key=lambda span: span[1])
+        start = min(span[1] for span in spans)
+        end = max(span[2] for span in spans)
+        for path, starttime, endtime, _ in spans:
+            if starttime <= start and endtime >= end:
+                return 'covered', path
+        delta = 1.0 / spans[0][3]
+        if all(abs(nxt[1] - (prev[2] + delta)) < 0.5 * delta for prev, nxt in zip(spans, spans[1:])):
+            return 'contiguous', None
+    return 'merge', None
+
+def read_sac(path, headonly=False):
+    """
+    Read a waveform file as a SAC trace through SACTrace, skipping the plugin
+    lookup obspy.read does on every call; other formats go through obspy.read.
+    :param headonly: read the header only, the trace stats stay complete
+    """
+    try:
+        return SACTrace.read(path, headonly=headonly).to_obspy_trace()
+    except Exception:
+        return read(path, headonly=headonly)[0]
+
+def merge_group(group, paths, output_data_dir, link_mode):
+    """
+    Turn one station/location/channel group of data_single into its data_final file.
+    A single file is linked without being read; otherwise the headers decide
+    the mode: a file covering the whole group is linked, and only contiguous
+    segments (concatenated) and the rest (Stream.merge) have their samples read.
+    :return: mode
+    """
+    if len(paths) == 1:
+        link_file(paths[0], output_data_dir, link_mode)
+        logging.info(f"{group}: single, pass through {os.path.basename(paths[0])}")
+        return 'single'
+    spans = []
+    for path in paths:
+        stats = read_sac(path, headonly=True).stats
+        spans.append((path, stats.starttime, stats.endtime, stats.sampling_rate))
+    mode, keep = plan_group(spans)
+    if keep is not None:
+        link_file(keep, output_data_dir, link_mode)
+        logging.info(f"{group}: {mode}, pass through {os.path.basename(keep)}")
+        return mode
+    traces = {path: read_sac(path) for path in paths}
+    spans = sorted(spans, key=lambda span: span[1])
+    output = os.path.join(output_data_dir, os.path.basename(spans[0][0]))
+    if mode == 'contiguous':
+        tr = traces[spans[0][0]]
+        tr.data = np.concatenate([traces[path].data for path, _, _, _ in spans])
+        write_sac(tr, output)
+    else:
+        st_add = Stream([traces[path] for path, _, _, _ in spans])
+        try:
+            st_add.merge(fill_value='interpolate')
+        except Exception as e:
+            # a failed merge can leave the stream empty, keep the segments as they were
+            logging.info(f"{e} happened in {group}")
+            st_add = Stream([traces[path] for path, _, _, _ in spans])
+        write_sac(st_add, output)
+    logging.info(f"{group}: {mode} of {len(paths)} files")
+    return mode
+
+def merge_station(args):
+    """
+    Merge every group of one station-day in a single task.
+    :return: {mode: number of groups}, number of input files
+    """
+    station, groups, output_data_dir, link_mode, log_file = args
+    logging.basicConfig(filename=log_file, level=logging.INFO, filemode='a')
+    modes = Counter()
+    n_files = 0
+    for group, paths, _ in groups:
+        modes[merge_group(group, paths, output_data_dir, link_mode)] += 1
+        n_files += len(paths)
+    add_items(n_files)
+    return dict(modes), n_files
@@ -0,0 +1,163 @@
+import os
+import time
+import json
+import cProfile
+import resource
+import threading
+import multiprocessing as mp
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+
+active_run = None
+worker_queue = None
+items = 0
+
+def io_bytes():
+    """
+    Bytes this process has read and written so far (rchar/wchar of
+    /proc/self/io, page cache hits included); zeros where unavailable.
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            fields = dict(line.split(':') for line in f)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def snapshot():
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    read, written = io_bytes()
+    return time.perf_counter(), ru.ru_utime + ru.ru_stime, read, written
+
+def usage_since(before):
+    wall, cpu, read, written = snapshot()
+    return {
+        'wall_s': wall - before[0],
+        'cpu_s': cpu - before[1],
+        # high-water mark of the process so far, ru_maxrss is in KiB on Linux
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'read_bytes': read - before[2],
+        'write_bytes': written - before[3],
+    }
+
+def add_items(n):
+    """
+    Count items (files, traces, picks, events) handled by the current task or stage.
+    """
+    global items
+    items += n
+
+def init_worker(queue, initializer=None, initargs=()):
+    """
+    Pool initializer: keep the metrics queue of the run, then call the pool's own initializer.
+    """
+    global worker_queue
+    worker_queue = queue
+    if initializer is not None:
+        initializer(*initargs)
+
+def measure(func, stage, key, args):
+    """
+    Run func(args) and put its usage record on the queue of the run.
+    :return: result, record
+    """
+    global items
+    items = 0
+    before = snapshot()
+    result = func(args)
+    record = {'stage': stage, 'task': str(key), 'items': items, 'pid': os.getpid()}
+    record.update(usage_since(before))
+    if worker_queue is not None:
+        worker_queue.put(record)
+    return result, record
+
+def current_queue():
+    return None if active_run is None else active_run.queue
+
+def current_stage():
+    return None if active_run is None else active_run.current
+
+class RunMetrics:
+    """
+    Metrics of one pipeline run. Stages are timed in the parent process,
+    the records of their worker tasks arrive through a multiprocess queue
+    and both are written to <metrics_dir>/run_<id>.json and CSVs after
+    every stage.
+    :param profile: True to dump a cProfile of every stage, or a list of stage names
+    """
+    def __init__(self, metrics_dir, profile=False):
+        global active_run
+        self.metrics_dir = metrics_dir
+        self.metrics_dir.mkdir(parents=True, exist_ok=True)
+        self.profile = profile
+        self.run_id = datetime.now().strftime('%Y%m%dT%H%M%S')
+        self.current = None
+        self.stages = []
+        self.tasks = []
+        self.queue = mp.SimpleQueue()
+        self.flushed = threading.Event()
+        self.listener = threading.Thread(target=self.listen, daemon=True)
+        self.listener.start()
+        active_run = self
+    def listen(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            if record == 'flush':
+                self.flushed.set()
+            else:
+                self.tasks.append(record)
+    def flush(self):
+        # workers put their record before returning the result, so the
+        # marker queues up behind every record of a finished pool
+        self.flushed.clear()
+        self.queue.put('flush')
+        self.flushed.wait()
+    @contextmanager
+    def stage(self, name):
+        global items
+        profiler = None
+        if self.profile is True or (self.profile and name in self.profile):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        self.current = name
+        items = 0
+        n_tasks = len(self.tasks)
+        before = snapshot()
+        try:
+            yield self
+        finally:
+            record = {'stage': name, 'items': items}
+            record.update(usage_since(before))
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.metrics_dir / f'run_{self.run_id}_{name}.prof')
+            self.flush()
+            tasks = self.tasks[n_tasks:]
+            record['tasks'] = len(tasks)
+            record['task_cpu_s'] = sum(task['cpu_s'] for task in tasks)
+            record['task_max_rss_mb'] = max((task['max_rss_mb'] for task in tasks), default=0.0)
+            record['items'] += sum(task['items'] for task in tasks)
+            record['read_bytes'] += sum(task['read_bytes'] for task in tasks)
+            record['write_bytes'] += sum(task['write_bytes'] for task in tasks)
+            self.stages.append(record)
+            self.current = None
+            self.write()
+            print(f"{name}: {record['wall_s']:.2f} s wall, {record['cpu_s'] + record['task_cpu_s']:.2f} s CPU, "
+                  f"{record['items']} items, {record['read_bytes'] / 1e6:.1f} MB read, {record['write_bytes'] / 1e6:.1f} MB written, "
+                  f"peak RSS {max(record['max_rss_mb'], record['task_max_rss_mb']):.0f} MB")
+    def write(self):
+        prefix = self.metrics_dir / f'run_{self.run_id}'
+        with open(f'{prefix}.json', 'w') as f:
+            json.dump({'run_id': self.run_id, 'stages': self.stages, 'tasks': self.tasks}, f, indent=2)
+        pd.DataFrame(self.stages).to_csv(f'{prefix}_stages.csv', index=False)
+        if self.tasks:
+            pd.DataFrame(self.tasks).to_csv(f'{prefix}_tasks.csv', index=False)
+    def close(self):
+        global active_run
+        self.queue.put(None)
+        self.listener.join()
+        if active_run is self:
+            active_run = None
@@ -0,0 +1,152 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import h5py
+from obspy import UTCDateTime
+
+PICK_DIR = 'picks'
+CHUNK_ROWS = 2**16
+COLUMNS = {
+    'trace_code': np.int32,
+    'start_ns': np.int64,
+    'peak_ns': np.int64,
+    'end_ns': np.int64,
+    'prob': np.float32,
+    'phase_code': np.int8,
+}
+
+def store_path(store_dir, day):
+    return Path(store_dir) / f'{day}.h5'
+
+class PickWriter:
+    """
+    Writer of the per-day pick file phasenet/picks/<day>.h5. Every field is a
+    resizable column extended on each append; trace ids and phases are kept
+    once in small lookup tables and referenced by code. On close the rows
+    are sorted by peak time so that readers can cut a time range with a
+    binary search.
+    """
+    def __init__(self, h5_path):
+        self.h5 = h5py.File(h5_path, 'w')
+        for name, dtype in COLUMNS.items():
+            self.h5.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(CHUNK_ROWS,))
+        self.trace_ids = {}
+        self.phases = {}
+        self.n = 0
+    def code(self, table, value):
+        if value not in table:
+            table[value] = len(table)
+        return table[value]
+    def append(self, picks):
+        """
+        :param picks: SeisBench picks, or any object with trace_id,
+            start_time, peak_time, end_time, peak_value and phase
+        """
+        k = len(picks)
+        if k == 0:
+            return
+        values = {
+            'trace_code': [self.code(self.trace_ids, p.trace_id) for p in picks],
+            'start_ns': [p.start_time.ns for p in picks],
+            'peak_ns': [p.peak_time.ns for p in picks],
+            'end_ns': [p.end_time.ns for p in picks],
+            'prob': [p.peak_value for p in picks],
+            'phase_code': [self.code(self.phases, p.phase) for p in picks],
+        }
+        for name, dtype in COLUMNS.items():
+            dset = self.h5[name]
+            dset.resize((self.n + k,))
+            dset[self.n:] = np.asarray(values[name], dtype=dtype)
+        self.n += k
+    def close(self):
+        order = np.argsort(self.h5['peak_ns'][:], kind='stable')
+        for name in COLUMNS:
+            dset = self.h5[name]
+            dset[:] = dset[:][order]
+        self.h5.create_dataset('trace_ids', data=list(self.trace_ids), dtype=h5py.string_dtype())
+        self.h5.create_dataset('phases', data=list(self.phases), dtype=h5py.string_dtype())
+        self.h5.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+def read_day(h5_path, t0=None, t1=None, stations=None):
+    """
+    Read the picks of one day file with peak time in [t0, t1) (ns since
+    epoch) on the given stations. Apart from the peak times, only the rows
+    of the time range are read from disk.
+    """
+    with h5py.File(h5_path, 'r') as h5:
+        trace_ids = h5['trace_ids'].asstr()[:] if 'trace_ids' in h5 else np.array([], dtype=object)
+        phases = h5['phases'].asstr()[:] if 'phases' in h5 else np.array([], dtype=object)
+        peak = h5['peak_ns'][:]
+        i0 = 0 if t0 is None else int(np.searchsorted(peak, t0, side='left'))
+        i1 = len(peak) if t1 is None else int(np.searchsorted(peak, t1, side='left'))
+        columns = {name: h5[name][i0:i1] for name in COLUMNS}
+    trace_ids = np.asarray(trace_ids, dtype=object)
+    station = np.array([trace_id.split('.')[1] if trace_id.count('.') else trace_id for trace_id in trace_ids], dtype=object)
+    if stations is not None:
+        keep = np.isin(station, list(stations))[columns['trace_code']]
+        columns = {name: col[keep] for name, col in columns.items()}
+    codes = columns['trace_code']
+    return pd.DataFrame({
+        'trace_id': trace_ids[codes],
+        'station': station[codes],
+        'start_time': columns['start_ns'].astype('datetime64[ns]'),
+        'peak_time': columns['peak_ns'].astype('datetime64[ns]'),
+        'end_time': columns['end_ns'].astype('datetime64[ns]'),
+        'prob': columns['prob'].astype(np.float64),
+        'phase': np.asarray(phases, dtype=object)[columns['phase_code']],
+    })
+
+def empty_picks():
+    return pd.DataFrame({
+        'trace_id': np.array([], dtype=object), 'station': np.array([], dtype=object),
+        'start_time': np.array([], dtype='datetime64[ns]'), 'peak_time': np.array([], dtype='datetime64[ns]'),
+        'end_time': np.array([], dtype='datetime64[ns]'), 'prob': np.array([], dtype=np.float64),
+        'phase': np.array([], dtype=object),
+    })
+
+def picks_frame(picks):
+    """
+    The read_picks table of in-memory SeisBench picks.
+    """
+    if not picks:
+        return empty_picks()
+    trace_id = np.array([p.trace_id for p in picks], dtype=object)
+    return pd.DataFrame({
+        'trace_id': trace_id,
+        'station': np.array([t.split('.')[1] if t.count('.') else t for t in trace_id], dtype=object),
+        'start_time': np.array([p.start_time.ns for p in picks], dtype=np.int64).astype('datetime64[ns]'),
+        'peak_time': np.array([p.peak_time.ns for p in picks], dtype=np.int64).astype('datetime64[ns]'),
+        'end_time': np.array([p.end_time.ns for p in picks], dtype=np.int64).astype('datetime64[ns]'),
+        'prob': np.array([p.peak_value for p in picks], dtype=np.float64),
+        'phase': np.array([p.phase for p in picks], dtype=object),
+    })
+
+def read_picks(store_dir, days=None, starttime=None, endtime=None, stations=None):
+    """
+    Load picks from the day files of a pick store.
+    :param days: Days (YYYYMMDD) to read, every day file of the store when None
+    :param starttime: UTCDateTime, keep picks peaking at or after it
+    :param endtime: UTCDateTime, keep picks peaking before it
+    :param stations: Optional list of station codes to keep
+    :return: DataFrame with columns trace_id, station, start_time, peak_time, end_time, prob, phase
+    """
+    store_dir = Path(store_dir)
+    paths = sorted(store_dir.glob('*.h5')) if days is None else [store_path(store_dir, day) for day in days]
+    t0 = None if starttime is None else UTCDateTime(starttime).ns
+    t1 = None if endtime is None else UTCDateTime(endtime).ns
+    frames = []
+    for path in paths:
+        if not path.is_file():
+            continue
+        # skip the whole file when its day is outside the time range
+        day = UTCDateTime(path.stem).ns
+        if (t1 is not None and day >= t1) or (t0 is not None and day + 86400 * 10**9 <= t0):
+            continue
+        frames.append(read_day(path, t0, t1, stations))
+    if not frames:
+        return empty_picks()
+    return pd.concat(frames, ignore_index=True)
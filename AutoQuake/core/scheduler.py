@@ -0,0 +1,46 @@
+import os
+import time
+import multiprocessing as mp
+import pandas as pd
+from core.metrics import init_worker, measure, current_queue, current_stage
+
+def timed_call(task):
+    func, stage, key, args = task
+    result, record = measure(func, stage, key, args)
+    return key, result, record
+
+def run_tasks(func, tasks, processes=None, initializer=None, initargs=()):
+    """
+    Hand tasks out one at a time to a process pool, heaviest first, so a
+    single large task does not hold back a whole batch.
+    :param func: Module level worker called as func(args)
+    :param tasks: list of (key, args, weight)
+    :param processes: Number of workers, defaults to all cores
+    :param initializer: Optional pool initializer, called as initializer(*initargs)
+    :return: {key: result}, per-task usage records, wall time in seconds
+    """
+    if not tasks:
+        return {}, [], 0.0
+    weights = {key: weight for key, _, weight in tasks}
+    stage = current_stage() or func.__name__
+    ordered = [(func, stage, key, args) for key, args, _ in sorted(tasks, key=lambda task: -task[2])]
+    processes = min(processes or os.cpu_count(), len(ordered))
+    results, timings = {}, []
+    t0 = time.perf_counter()
+    with mp.Pool(processes=processes, initializer=init_worker, initargs=(current_queue(), initializer, initargs)) as pool:
+        for key, result, record in pool.imap_unordered(timed_call, ordered, chunksize=1):
+            results[key] = result
+            timings.append(dict(record, weight=weights[key]))
+    return results, timings, time.perf_counter() - t0
+
+def write_timings(timings, wall, csv_path, stage):
+    """
+    Save the per-task records and print how much the pool overlapped the work.
+    """
+    if not timings:
+        return
+    df = pd.DataFrame(timings)
+    df.to_csv(csv_path, index=False)
+    busy = df['wall_s'].sum()
+    print(f"{stage}: {len(df)} tasks on {df['pid'].nunique()} workers in {wall:.2f} s "
+          f"(task time {busy:.2f} s, speedup {busy / max(wall, 1e-9):.1f}x, slowest task {df['wall_s'].max():.2f} s)")
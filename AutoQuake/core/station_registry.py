@@ -0,0 +1,152 @@
+import os
+import hashlib
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from pyproj import Proj
+from scipy.spatial import cKDTree
+
+DEFAULT_CENTER = (121.7, 24.0)
+ARRAYS = ['net', 'station', 'lon', 'lat', 'elevation_m', 'x', 'y', 'z', 'h3dd_lines']
+
+loaded = {}
+
+def registry_key(station_path, center):
+    """
+    Hash of the station file contents and the projection centre.
+    """
+    sha = hashlib.sha256()
+    with open(station_path, 'rb') as f:
+        sha.update(f.read())
+    sha.update(np.asarray(center, dtype=np.float64).tobytes())
+    return sha.hexdigest()[:16]
+
+def station_proj(center):
+    return Proj(f"+proj=sterea +lon_0={center[0]} +lat_0={center[1]} +units=km")
+
+class StationRegistry:
+    """
+    Station metadata held as one array per field, with x/y/z (km) in the
+    stereographic projection around `center` as used by GaMMA (z positive
+    down) and a KD-tree over x/y/z for radius and nearest-station queries.
+    Build it with load_registry.
+    """
+    def __init__(self, arrays, center):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.center = tuple(center)
+        self.proj = station_proj(self.center)
+        self.row = {sta: i for i, sta in enumerate(self.station)}
+        self.xyz = np.column_stack([self.x, self.y, self.z])
+        self.tree = cKDTree(self.xyz)
+    @classmethod
+    def from_csv(cls, station_path, center=DEFAULT_CENTER):
+        df = pd.read_csv(station_path)
+        # the h3dd station file keeps the coordinates as written in the csv
+        raw = pd.read_csv(station_path, dtype=str)
+        arrays = {
+            'net': df['net'].astype(str).to_numpy(dtype=object),
+            'station': df['station'].astype(str).to_numpy(dtype=object),
+            'lon': df['lon'].to_numpy(dtype=np.float64),
+            'lat': df['lat'].to_numpy(dtype=np.float64),
+            'elevation_m': df['elevation_m'].to_numpy(dtype=np.float64),
+            'h3dd_lines': (raw['station'] + ' ' + raw['lon'] + ' ' + raw['lat'] + ' ' + raw['elevation_m']
+                           + ' 19010101 21001231\n').to_numpy(dtype=object),
+        }
+        x, y = station_proj(center)(longitude=arrays['lon'], latitude=arrays['lat'])
+        arrays['x'], arrays['y'] = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        arrays['z'] = -arrays['elevation_m'] / 1e3
+        return cls(arrays, center)
+    @property
+    def stations(self):
+        return list(self.station)
+    def __len__(self):
+        return len(self.station)
+    def save(self, path):
+        tmp = Path(path).with_suffix(f'.{os.getpid()}.npz')
+        np.savez(tmp, center=np.asarray(self.center),
+                 **{name: getattr(self, name).astype(str) if getattr(self, name).dtype == object else getattr(self, name)
+                    for name in ARRAYS})
+        os.replace(tmp, path)
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            arrays = {name: npz[name].astype(object) if npz[name].dtype.kind == 'U' else npz[name] for name in ARRAYS}
+            center = tuple(npz['center'])
+        return cls(arrays, center)
+    def project(self, lon, lat):
+        """
+        x/y (km) of coordinates in the projection of the registry.
+        """
+        x, y = self.proj(longitude=np.asarray(lon, dtype=np.float64), latitude=np.asarray(lat, dtype=np.float64))
+        return np.asarray(x), np.asarray(y)
+    def indices(self, stations):
+        """
+        Rows of the given station codes, -1 for unknown codes.
+        """
+        return np.array([self.row.get(sta, -1) for sta in stations], dtype=np.int64)
+    def within(self, x, y, z, radius):
+        """
+        Rows of the stations within radius km of a point, nearest first.
+        """
+        rows = np.asarray(self.tree.query_ball_point([x, y, z], radius), dtype=np.int64)
+        dist = np.linalg.norm(self.xyz[rows] - [x, y, z], axis=1)
+        return rows[np.argsort(dist, kind='stable')]
+    def nearest(self, points, k=1):
+        """
+        Distances (km) and rows of the k nearest stations of every point.
+        :param points: (n, 3) array of x/y/z in km
+        """
+        return self.tree.query(np.atleast_2d(points), k=min(k, len(self)))
+    def neighbour_distance(self, order=2):
+        """
+        Distance of every station to its order-th nearest station at another
+        location, inf for a station without that many.
+        """
+        k = min(len(self), order + 7)
+        while True:
+            dist, _ = self.tree.query(self.xyz, k=k)
+            dist = np.sort(np.where(dist > 0, dist, np.inf).reshape(len(self), -1), axis=1)
+            if order > dist.shape[1]:
+                return np.full(len(self), np.inf)
+            nearest = dist[:, order - 1]
+            # co-located stations hide the distinct ones, look further
+            if np.isfinite(nearest).all() or k == len(self):
+                return nearest
+            k = min(2 * k, len(self))
+    def estimate_eps(self, vp, sigma=2.0):
+        """
+        DBSCAN eps (s) of GaMMA's estimate_eps, which takes the distance to the
+        second nearest station, from the KD-tree instead of the full station
+        distance matrix.
+        """
+        dist = self.neighbour_distance(order=2)
+        return (np.mean(dist) + sigma * np.std(dist)) / vp * 1.5
+    def gamma_frame(self):
+        """
+        Station table of GaMMA: id, longitude, latitude, elevation_m, x(km), y(km), z(km).
+        """
+        return pd.DataFrame({'id': self.station, 'longitude': self.lon, 'latitude': self.lat, 'elevation_m': self.elevation_m,
+                             'x(km)': self.x, 'y(km)': self.y, 'z(km)': self.z})
+    def write_h3dd_stations(self, path):
+        with open(path, 'w') as output:
+            output.write(''.join(self.h3dd_lines))
+
+def load_registry(station_path, center=DEFAULT_CENTER, cache_dir=None):
+    """
+    Station registry of station_path, built once per process and kept in
+    cache_dir under the hash of the file contents and centre.
+    """
+    key = registry_key(station_path, center)
+    if key in loaded:
+        return loaded[key]
+    path = None if cache_dir is None else Path(cache_dir) / f'{key}.npz'
+    if path is not None and path.is_file():
+        registry = StationRegistry.load(path)
+    else:
+        registry = StationRegistry.from_csv(station_path, center)
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            registry.save(path)
+    loaded[key] = registry
+    return registry
@@ -0,0 +1,150 @@
+import os
+import shutil
+import logging
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+DEFAULT_CHANNEL_PRIORITY = ['HH', 'BH', 'EH', 'EP', 'HL', 'BL', 'HN']
+INDEX_COLUMNS = ['path', 'network', 'station', 'location', 'channel', 'equip', 'size']
+
+def parse_sac_name(name):
+    """
+    Parse network/station/location/channel from a waveform filename,
+    e.g. TW.HUAL.00.HHZ.D.2024.093.sac -> ('TW', 'HUAL', '00', 'HHZ').
+    Return None when the name has less than four dot-separated fields.
+    """
+    parts = name.split('.')
+    if len(parts) < 4:
+        return None
+    return parts[0], parts[1], parts[2], parts[3]
+
+def scan_day_dir(day_dir):
+    """
+    List a day directory once and return a table of its waveform files.
+    :param day_dir: Directory holding the raw SAC files of a single day
+    :return: DataFrame with columns path, network, station, location, channel, equip, size (bytes)
+    """
+    rows = []
+    try:
+        entries = os.scandir(day_dir)
+    except FileNotFoundError:
+        logging.info(f"{day_dir} does not exist")
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+    with entries:
+        for entry in entries:
+            # dot files are unfinished writes, see write_sac
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            parsed = parse_sac_name(entry.name)
+            if parsed is None:
+                logging.info(f"skip unparsable file {entry.name}")
+                continue
+            net, sta, loc, cha = parsed
+            rows.append((entry.path, net, sta, loc, cha, cha[:2], entry.stat().st_size))
+    return pd.DataFrame(rows, columns=INDEX_COLUMNS)
+
+def select_channels(index_df, station_list, priority=DEFAULT_CHANNEL_PRIORITY):
+    """
+    Pick the best instrument of every station in a single pass over the index.
+    All files of the highest ranked instrument code available for a station
+    are kept, the other instruments of that station are dropped.
+    :param index_df: Table returned by scan_day_dir
+    :param station_list: Stations to keep
+    :param priority: Instrument codes ordered from most to least preferred
+    :return: Subset of index_df with an extra 'rank' column
+    """
+    rank = {equip: i for i, equip in enumerate(priority)}
+    df = index_df[index_df['station'].isin(station_list)].copy()
+    df['rank'] = df['equip'].map(rank)
+    df = df.dropna(subset=['rank'])
+    best = df.groupby('station')['rank'].transform('min')
+    return df[df['rank'] == best].sort_values(['station', 'path'])
+
+def link_file(src, dst_dir, mode='hardlink'):
+    """
+    Place src into dst_dir without copying the bytes when possible.
+    :param mode: 'hardlink', 'symlink' or 'copy'. A hardlink falls back to a
+        copy when src and dst_dir are not on the same filesystem.
+    """
+    dst = Path(dst_dir) / os.path.basename(src)
+    # dst may be a link to a raw file from an earlier run, never write through it
+    if dst.is_symlink() or dst.exists():
+        dst.unlink()
+    if mode == 'copy':
+        shutil.copy(src, dst)
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+    elif mode == 'hardlink':
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy(src, dst)
+    else:
+        raise ValueError(f"Unknown link mode: {mode}")
+    return dst
+
+def remove_stale(directory, keep=()):
+    """
+    Remove the files of directory whose names are not in keep, so that a
+    rerun with another selection does not leave the outputs of the last one.
+    :return: number of removed files
+    """
+    keep = set(keep)
+    removed = 0
+    for entry in os.scandir(directory):
+        if entry.name not in keep and not entry.is_dir(follow_symlinks=False):
+            os.unlink(entry.path)
+            removed += 1
+    return removed
+
+def write_sac(stream, path):
+    """
+    Write stream as SAC to a temporary file next to path and rename it onto
+    path, so that a hardlink or symlink at path (to a raw file placed by
+    link_file) is replaced instead of written through. A stream of several
+    traces goes to one file per trace, numbered as Stream.write numbers them.
+    :return: list of written paths
+    """
+    from obspy import Trace
+    from obspy.io.sac import SACTrace
+    path = Path(path)
+    traces = [stream] if isinstance(stream, Trace) else list(stream)
+    if len(traces) == 1:
+        paths = [path]
+    else:
+        base, ext = os.path.splitext(path.name)
+        paths = [path.parent / f"{base}{i + 1:02d}{ext}" for i in range(len(traces))]
+    for trace, dst in zip(traces, paths):
+        tmp = dst.parent / f'.{dst.name}.{os.getpid()}.tmp'
+        # SACTrace directly, Stream.write looks the format plugin up on every call
+        SACTrace.from_obspy_trace(trace).write(str(tmp))
+        os.replace(tmp, dst)
+    return paths
+
+SAC_HEADER_BYTES = 632
+
+def read_sac_window(path, starttime, endtime):
+    """
+    Read the samples of a SAC file between starttime and endtime, trimmed as
+    obspy.read(path, starttime=..., endtime=...) trims, through a memory map
+    of the data section so a day-long file is not decoded for every window.
+    Files that are not evenly sampled SAC time series go through obspy.read.
+    :return: Stream
+    """
+    from obspy import Stream, read
+    from obspy.io.sac import SACTrace
+    try:
+        header = SACTrace.read(path, headonly=True)
+    except Exception:
+        header = None
+    if header is None or header.iftype != 'itime' or not header.leven:
+        return read(path, starttime=starttime, endtime=endtime)
+    tr = header.to_obspy_trace()
+    dtype = np.dtype('<f4' if header.byteorder == 'little' else '>f4')
+    tr.data = np.memmap(path, dtype=dtype, mode='r', offset=SAC_HEADER_BYTES, shape=(header.npts,))
+    # Stream.trim drops a trace left empty, as obspy.read does
+    stream = Stream([tr]).trim(starttime, endtime)
+    for tr in stream:
+        tr.data = np.array(tr.data, dtype=np.float32)
+    return stream
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import h5py
+from obspy import Trace, UTCDateTime
+from obspy.core.stream import Stream
+
+STORE_NAME = 'waveforms.h5'
+CHUNK_SAMPLES = 2**16
+INDEX_DTYPE = np.dtype([
+    ('name', h5py.string_dtype()),
+    ('network', h5py.string_dtype()),
+    ('station', h5py.string_dtype()),
+    ('location', h5py.string_dtype()),
+    ('channel', h5py.string_dtype()),
+    ('starttime', np.float64),
+    ('sampling_rate', np.float64),
+    ('npts', np.int64),
+    ('source', h5py.string_dtype()),
+])
+
+class DayStore:
+    """
+    Writer of the per-day HDF5 archive data/<day>/data_final/waveforms.h5.
+    Every trace is a chunked dataset under /waveforms and the metadata of all
+    traces is kept in the /index table, written on close.
+    """
+    def __init__(self, h5_path):
+        self.h5 = h5py.File(h5_path, 'w')
+        self.group = self.h5.create_group('waveforms')
+        self.rows = []
+    def add(self, stream, source=''):
+        for tr in stream:
+            name = tr.id
+            k = 1
+            while name in self.group:
+                name = f"{tr.id}_{k}"
+                k += 1
+            data = np.ascontiguousarray(tr.data)
+            chunks = (min(CHUNK_SAMPLES, len(data)),) if len(data) else None
+            self.group.create_dataset(name, data=data, chunks=chunks)
+            stats = tr.stats
+            self.rows.append((name, stats.network, stats.station, stats.location, stats.channel,
+                              stats.starttime.timestamp, stats.sampling_rate, stats.npts, source))
+    def close(self):
+        self.h5.create_dataset('index', data=np.array(self.rows, dtype=INDEX_DTYPE))
+        self.h5.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+def read_index(h5_path):
+    """
+    Metadata of every trace in a day archive as a DataFrame, with the end time added.
+    """
+    with h5py.File(h5_path, 'r') as h5:
+        index = pd.DataFrame(h5['index'][:])
+    for col in ['name', 'network', 'station', 'location', 'channel', 'source']:
+        index[col] = index[col].str.decode('utf-8')
+    index['endtime'] = index['starttime'] + (index['npts'] - 1) / index['sampling_rate']
+    return index
+
+def read_window(h5_path, starttime=None, endtime=None, stations=None, index=None):
+    """
+    Read a time window of a day archive; only the samples inside the window
+    are read from disk.
+    :param starttime: UTCDateTime, the start of the archive when None
+    :param endtime: UTCDateTime, the end of the archive when None
+    :param stations: Optional list of stations to keep
+    :param index: read_index result, to skip reading the index again
+    :return: obspy Stream
+    """
+    index = read_index(h5_path) if index is None else index
+    t0 = -np.inf if starttime is None else UTCDateTime(starttime).timestamp
+    t1 = np.inf if endtime is None else UTCDateTime(endtime).timestamp
+    rows = index[(index['endtime'] >= t0) & (index['starttime'] <= t1)]
+    if stations is not None:
+        rows = rows[rows['station'].isin(stations)]
+    stream = Stream()
+    with h5py.File(h5_path, 'r') as h5:
+        group = h5['waveforms']
+        for row in rows.itertuples(index=False):
+            i0, i1 = 0, row.npts
+            if t0 > row.starttime:
+                i0 = int(np.ceil((t0 - row.starttime) * row.sampling_rate - 1e-6))
+            if t1 < row.endtime:
+                i1 = int(np.floor((t1 - row.starttime) * row.sampling_rate + 1e-6)) + 1
+            if i1 <= i0:
+                continue
+            header = {'network': row.network, 'station': row.station, 'location': row.location,
+                      'channel': row.channel, 'sampling_rate': row.sampling_rate,
+                      'starttime': UTCDateTime(row.starttime) + i0 / row.sampling_rate}
+            stream += Trace(data=group[row.name][i0:i1], header=header)
+    return stream
@@ -0,0 +1,71 @@
+import numpy as np
+from obspy import read, UTCDateTime
+from obspy.core.stream import Stream
+from core.waveform_index import parse_sac_name
+from core.waveform_store import STORE_NAME, read_index, read_window
+
+def data_final_dirs(output_base_dir, date_list, day, end=None):
+    """
+    data_final of a day, and of the next day in the analyze range when
+    windows run past midnight.
+    :param end: Latest window end (seconds since epoch), the next day is always added when None
+    """
+    i = date_list.index(day)
+    n = 1 if end is not None and end < UTCDateTime(day).timestamp + 86400 else 2
+    return [output_base_dir / 'data' / d / 'data_final' for d in date_list[i:i + n]]
+
+def read_station(data_dirs, station, merge_format='sac', components=None):
+    """
+    Read the channels of one station from the data_final directories once,
+    day files of the same channel merged with gaps left as NaN.
+    :param components: Last letters of the channels to read, e.g. 'Z', all channels when None
+    :return: {channel: (start timestamp, sampling rate, float64 samples)}
+    """
+    def wanted(channel):
+        return components is None or channel[-1] in components
+    stream = Stream()
+    for data_dir in data_dirs:
+        h5_path = data_dir / STORE_NAME
+        if merge_format == 'hdf5' and h5_path.is_file():
+            index = read_index(h5_path)
+            index = index[(index['station'] == station) & index['channel'].map(wanted)]
+            stream += read_window(h5_path, index=index)
+        elif data_dir.is_dir():
+            for path in sorted(data_dir.glob(f'*.{station}.*')):
+                parsed = parse_sac_name(path.name)
+                if parsed is not None and parsed[1] == station and wanted(parsed[3]):
+                    stream += read(path)
+    stream = stream.select(station=station)
+    try:
+        stream.merge(method=1)
+    except Exception:
+        # different sampling rates on one channel, keep the first day
+        stream = Stream([stream.select(channel=cha)[0] for cha in sorted({tr.stats.channel for tr in stream})])
+    traces = {}
+    for tr in stream:
+        data = np.ma.filled(np.ma.asarray(tr.data, dtype=np.float64), np.nan)
+        traces[tr.stats.channel] = (tr.stats.starttime.timestamp, tr.stats.sampling_rate, data)
+    return traces
+
+def cut_windows(data, starttime, sampling_rate, starts, npts):
+    """
+    Cut windows of npts samples out of one trace in a single gather.
+    :param starts: Window start times, seconds since epoch
+    :return: (len(starts), npts) array, and a mask of the windows fully inside the trace without gaps
+    """
+    i0 = np.rint((np.asarray(starts, dtype=np.float64) - starttime) * sampling_rate).astype(np.int64)
+    inside = (i0 >= 0) & (i0 + npts <= len(data))
+    idx = np.clip(i0, 0, max(len(data) - npts, 0))[:, None] + np.arange(npts)
+    windows = data[np.clip(idx, 0, len(data) - 1)] if len(data) else np.full((len(i0), npts), np.nan)
+    valid = inside & ~np.isnan(windows).any(axis=1)
+    return windows, valid
+
+def detrend(windows):
+    """
+    Remove the least-squares line of every row.
+    """
+    n = windows.shape[1]
+    x = np.arange(n) - (n - 1) / 2
+    windows = windows - windows.mean(axis=1, keepdims=True)
+    slope = windows @ x / (x @ x)
+    return windows - slope[:, None] * x
@@ -1,12 +1,23 @@
 import argparse
 import json
-from core.initializer import Initializer
 from pathlib import Path
+from core.initializer import Initializer
+from core.manifest import fingerprint
+from core.metrics import RunMetrics
+
+# torch/seisbench and gamma are only imported by the stages that use them
+STAGES = ['init', 'filter', 'merge', 'pick', 'associate', 'magnitude', 'focal', 'convert', 'relocate', 'catalog']
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="AutoQuake Toolkit")
     parser.add_argument('--config', type=Path, required=True, help='Path to configuration JSON file')
+    parser.add_argument('stages', nargs='*', metavar='stage',
+                        help=f"Stages to run in pipeline order, any of {', '.join(STAGES)}; all of them by default. "
+                             "'watch' alone keeps polling waveform_dir for new data instead")
     args = parser.parse_args()
+    unknown = set(args.stages) - set(STAGES) - {'all', 'watch'}
+    if unknown:
+        parser.error(f"unknown stage: {', '.join(sorted(unknown))}")
     return args
 
 def load_config(config_path):
@@ -14,6 +25,122 @@ def load_config(config_path):
         config = json.load(file)
     return config
 
+def run_init(config):
+    Initializer(config).create_directory_structure()
+
+def run_filter(config):
+    Initializer(config).filter_single_equip()
+
+def run_merge(config):
+    Initializer(config).merge_waveform()
+
+def run_pick(config):
+    Initializer(config).pick_days(config.get('pick_window', 3600), config.get('pick_overlap', 60))
+
+def run_associate(config):
+    # association, only when the picks or its settings changed
+    from core.pick_store import read_picks, store_path
+    from modules.aso_gamma import Aso_gamma
+    aso = Aso_gamma(config, picks=[])
+    pick_files = [store_path(aso.pick_store, day) for day in aso.date_list]
+    gamma_params = {key: config.get(key) for key in ['gamma_window', 'gamma_overlap', 'association_method']}
+    digest = fingerprint(files=pick_files + [aso.station_path, aso.vel_model_1d], params=gamma_params)
+    if aso.manifest.is_current('associate', digest):
+        print("associate is up to date, skip")
+        return
+    aso.picks = read_picks(aso.pick_store, days=aso.date_list, stations=aso.load_stations().stations)
+    aso.run_gamma_association()
+    aso.manifest.record('associate', digest, [aso.gamma_events, aso.gamma_picks])
+
+def run_magnitude(config):
+    # local magnitudes, only with a pz_dir
+    from modules.magnitude import Magnitude
+    mag = Magnitude(config)
+    if not mag.mag_run:
+        print("magnitude: no pz_dir in the config, skip")
+        return
+    digest = fingerprint(files=[mag.gamma_events, mag.gamma_picks, mag.station_path],
+                         dirs=[mag.pz_path] + [mag.output_base_dir / 'data' / day / 'data_final' for day in mag.date_list],
+                         params=[mag.settings, mag.ml_formula, mag.mag_max_dist, mag.merge_format])
+    if mag.manifest.is_current('magnitude', digest):
+        print("magnitude is up to date, skip")
+        return
+    mag.run_magnitude()
+    mag.manifest.record('magnitude', digest, [mag.magnitude_csv, mag.amplitude_csv])
+
+def run_focal(config):
+    # first-motion polarities of the associated P picks
+    from modules.focal import Focal
+    focal = Focal(config)
+    digest = fingerprint(files=[focal.gamma_events, focal.gamma_picks, focal.station_path],
+                         dirs=[focal.output_base_dir / 'data' / day / 'data_final' for day in focal.date_list],
+                         params=[focal.settings, focal.merge_format])
+    if focal.manifest.is_current('focal', digest):
+        print("focal is up to date, skip")
+        return
+    focal.run_polarity()
+    focal.manifest.record('focal', digest, [focal.polarity_csv])
+
+def run_convert(config):
+    # h3dd input
+    from modules.aso_gamma import Aso_gamma
+    aso = Aso_gamma(config, picks=[])
+    cut_off_dist = config.get('cut_off_dist', 3) if config.get('h3dd_partition', False) else None
+    digest = fingerprint(files=[aso.gamma_events, aso.gamma_picks], params=[cut_off_dist, config.get('partition_size', 4000)])
+    if aso.manifest.is_current('convert', digest):
+        print("convert is up to date, skip")
+        return
+    aso.gamma2h3dd(cut_off_dist, config.get('partition_size', 4000))
+    aso.manifest.record('convert', digest, [aso.for_h3dd])
+
+def run_relocate(config):
+    from modules.h3dd import H3dd
+    h3dd = H3dd(config)
+    cut_off_dist = config.get('cut_off_dist', 3)
+    digest = fingerprint(files=[h3dd.h3dd_station, h3dd.vel_model_3d], dirs=[h3dd.for_h3dd_dir],
+                         params=[cut_off_dist, config.get('h3dd_executable')])
+    if h3dd.manifest.is_current('relocate', digest):
+        print("relocate is up to date, skip")
+        return
+    merged = h3dd.run_h3dd_parallel(cut_off_dist)
+    if not merged:
+        print("relocate produced no output, not recorded")
+        return
+    h3dd.manifest.record('relocate', digest, list(merged.values()))
+
+def run_catalog(config):
+    # indexed event catalog of the associated and relocated events
+    from modules.catalog import Catalog
+    catalog = Catalog(config)
+    digest = fingerprint(files=[catalog.gamma_events, catalog.gamma_picks, catalog.magnitude_csv, catalog.h3dd_catalog],
+                         params=[catalog.match_tolerance])
+    if catalog.manifest.is_current('catalog', digest):
+        print("catalog is up to date, skip")
+        return
+    catalog.build_catalog()
+    catalog.manifest.record('catalog', digest, [catalog.catalog_path])
+
+def run_watch(config):
+    # near-real-time mode, runs until interrupted
+    from modules.realtime import RealtimeWatcher
+    watcher = RealtimeWatcher(config)
+    watcher.create_directory_structure()
+    watcher.watch()
+
+RUNNERS = {
+    'init': run_init,
+    'filter': run_filter,
+    'merge': run_merge,
+    'pick': run_pick,
+    'associate': run_associate,
+    'magnitude': run_magnitude,
+    'focal': run_focal,
+    'convert': run_convert,
+    'relocate': run_relocate,
+    'catalog': run_catalog,
+    'watch': run_watch,
+}
+
 def main():
     args = parse_arguments()
     config = load_config(args.config)
@@ -22,13 +149,17 @@ def main():
     for key in required_keys:
         if key not in config:
             raise ValueError(f"Missing required config parameter: {key}")
-    # initialization
-    initializer = Initializer(config)
-    initializer.create_directory_structure()
-    initializer.filter_single_equip()
-    initializer.merge_waveform()
-    parent_dir, station_path, date_list, mag_run, pz_dir, aso_method = initializer.get_materials()
-    print("Initialization complete.")
+    if 'watch' in args.stages:
+        stages = ['watch']
+    elif not args.stages or 'all' in args.stages:
+        stages = STAGES
+    else:
+        stages = [stage for stage in STAGES if stage in args.stages]
+    metrics = RunMetrics(Initializer(config).output_base_dir / 'metrics', profile=config.get('profile_stages', False))
+    for stage in stages:
+        with metrics.stage(stage):
+            RUNNERS[stage](config)
+    metrics.close()
 
 
 if __name__ == "__main__":
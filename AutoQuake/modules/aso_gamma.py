@@ -1,96 +1,159 @@
 #%%
 import os
-import csv
 import json
 import logging
-import multiprocessing as mp
+from collections import defaultdict
 from datetime import datetime
+from pathlib import Path
 import pandas as pd
 import numpy as np
-from pyproj import Proj
 from core.initializer import Initializer
-from gamma.utils import association, estimate_eps
+from core.metrics import add_items
+from core.scheduler import run_tasks
+from modules.eikonal_cache import load_eikonal, gamma_utils
+from modules.gamma_partition import associate_partitioned
+from modules.spatial_partition import gamma_spatial_split
 
 def extract_substring(s):
     parts = s.split('.')
     return parts[1]
 
+def picks_to_arrays(picks):
+    """
+    Pull the fields GaMMA needs out of SeisBench picks into typed arrays.
+    :return: trace_id (object), peak time in ns since epoch (int64), prob (float64), phase (object)
+    """
+    n = len(picks)
+    trace_id = np.fromiter((p.trace_id for p in picks), dtype=object, count=n)
+    peak_ns = np.fromiter((p.peak_time.ns for p in picks), dtype=np.int64, count=n)
+    prob = np.fromiter((p.peak_value for p in picks), dtype=np.float64, count=n)
+    phase = np.fromiter((p.phase for p in picks), dtype=object, count=n)
+    return trace_id, peak_ns, prob, phase
+
+def pick_table(trace_id, peak_ns, prob, phase):
+    """
+    Build the GaMMA pick DataFrame (id, timestamp, prob, type) from columns.
+    Station codes and lower-case phases are derived once per distinct value.
+    """
+    codes, uniques = pd.factorize(trace_id)
+    station = np.array([extract_substring(u) for u in uniques], dtype=object)
+    phase_codes, phase_uniques = pd.factorize(phase)
+    phase_lower = np.array([u.lower() for u in phase_uniques], dtype=object)
+    return pd.DataFrame({
+        "id": station[codes],
+        "timestamp": np.asarray(peak_ns, dtype=np.int64).astype("datetime64[ns]"),
+        "prob": np.asarray(prob, dtype=np.float64),
+        "type": phase_lower[phase_codes],
+    })
+
+def store_pick_table(picks):
+    """
+    Build the GaMMA pick DataFrame from a pick store table, see core.pick_store.read_picks.
+    """
+    return pd.DataFrame({
+        "id": picks["station"].to_numpy(),
+        "timestamp": picks["peak_time"].to_numpy(),
+        "prob": picks["prob"].to_numpy(),
+        "type": picks["phase"].str.lower().to_numpy(),
+    })
+
 def config2csv(config, filename='config_detailed'):
     with open(f'{filename}.csv', 'w') as f:
         for key, value in config.items():
             f.write(f'{key},{value}\n')
 
-def convert_utc_datetime(utc_datetime_str):
+def gamma_sort_split(split_dir, events_csv, chunksize=4000):
     """
-    Converts a UTC datetime string into a datetime object.
-    Modify this function based on the format of your UTCDateTime strings.
+    Sort gamma_events.csv by origin time and write it as chunks of chunksize
+    events, split_dir/gamma_events_<i>.csv, in a single read.
+    :return: Number of chunks
     """
-    return datetime.strptime(utc_datetime_str, '%Y-%m-%dT%H:%M:%S.%f')
-
-def gamma_reorder(ori_csv, reorder_csv):
-    # Open the input CSV file and read its contents
-    with open(ori_csv, 'r') as file:
-        reader = csv.reader(file)
-        header = next(reader)
-        data = list(reader)
-    data.sort(key=lambda row: convert_utc_datetime(row[0]))
-    # Write the sorted data to a new CSV file
-    with open(reorder_csv, 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(header) 
-        writer.writerows(data) 
-
-def gamma_chunk_split(split_dir, reorder_csv):
     split_dir.mkdir(parents=True, exist_ok=True)
-    for i, chunk in enumerate(pd.read_csv(reorder_csv, chunksize=4000)):
-        chunk.to_csv(split_dir / f'gamma_events_{i}.csv',index=False)
+    for old in split_dir.glob('gamma_events_*.csv'):
+        old.unlink()
+    events = pd.read_csv(events_csv)
+    origin = pd.to_datetime(events['time'], format='%Y-%m-%dT%H:%M:%S.%f')
+    events = events.iloc[np.argsort(origin.to_numpy(), kind='stable')]
+    chunk_num = 0
+    for chunk_num, start in enumerate(range(0, len(events), chunksize), start=1):
+        events.iloc[start:start + chunksize].to_csv(split_dir / f'gamma_events_{chunk_num - 1}.csv', index=False)
+    return chunk_num
+
+def load_picks_by_event(gamma_picks):
+    """
+    Read gamma_picks.csv once and group the associated picks by event_index.
+    :param gamma_picks: Path to gamma_picks.csv
+    :return: {event_index: [(station, phase_type, minute, second), ...]}, picks kept in file order
+    """
+    picks_by_event = defaultdict(list)
+    with open(gamma_picks, 'r') as picks_read:
+        for p_line in picks_read:
+            if p_line[0] == 's':
+                continue
+            part = p_line.split(',')
+            picks_index = part[-2]
+            if picks_index == '-1':
+                continue
+            sta = part[0].split('.')[1] if '.' in part[0] else part[0]
+            pick_time = datetime.strptime(part[1], '%Y-%m-%dT%H:%M:%S.%f')
+            wss = round(pick_time.second + pick_time.microsecond / 1000000, 2)
+            picks_by_event[picks_index].append((sta, part[3], pick_time.minute, wss))
+    return dict(picks_by_event)
+
+def init_transform(picks_by_event):
+    # picks are loaded once in the parent and shared by every transform worker
+    global shared_picks
+    shared_picks = picks_by_event
+
+def h3dd_event_line(utc_time, lon, lat, depth):
+    """
+    Header line of an event in the h3dd catalog format.
+    """
+    ymd = utc_time.strftime('%Y%m%d')
+    hh = utc_time.hour
+    mm = utc_time.minute
+    ss = round(utc_time.second + utc_time.microsecond / 1000000, 2)
+    lon_int = int(lon)
+    lon_deg = (lon - lon_int)*60
+    lat_int = int(lat)
+    lat_deg = (lat - lat_int)*60
+    depth = round(depth,2)
+    return f"{ymd:>9}{hh:>2}{mm:>2}{ss:>6.2f}{lat_int:2}{lat_deg:0>5.2f}{lon_int:3}{lon_deg:0>5.2f}{depth:>6.2f}\n"
+
+def h3dd_pick_line(sta, wt, pick_minute, wss, mm):
+    """
+    Phase line of a pick in the h3dd catalog format, mm is the origin minute of its event.
+    The phase wt is 'P' or 'S' in either case, GaMMA keeps it lowercase.
+    """
+    if mm == 59 and pick_minute == 0: # modify
+        wmm = int(60)
+    else:
+        wmm = pick_minute
+    wei = '1.00'
+    if wt.upper() == 'P':
+        return f"{' ':1}{sta:<4}{'0.0':>6}{'0':>4}{'0':>4}{wmm:>4}{wss:>6.2f}{'0.01':>5}{wei:>5}{'0.00':>6}{'0.00':>5}{'0.00':>5}\n"
+    return f"{' ':1}{sta:<4}{'0.0':>6}{'0':>4}{'0':>4}{wmm:>4}{'0.00':>6}{'0.00':>5}{'0.00':>5}{wss:>6.2f}{'0.01':>5}{wei:>5}\n"
 
 def transform(args):
-    index, picks, split_dir, output_dir = args
+    index, split_dir, output_dir = args
     logging.basicConfig(filename='trans.log',level=logging.INFO,filemode='a')
-    gamma_picks = picks
     gamma_events = os.path.join(split_dir, f'gamma_events_{index}.csv')
+    output_file = output_dir / f'gamma_events_{index}.dat_ch'
     logging.info(f'we are in gamma_events_{index}') 
+    buffer = []
     with open(gamma_events,'r') as f:
-        lines = f.readlines()
-        for line in lines:
+        for line in f:
             if line[0] != 't':
                 item = line.split(',')
                 utc_time = datetime.strptime(item[0], '%Y-%m-%dT%H:%M:%S.%f')
-                ymd = utc_time.strftime('%Y%m%d')
-                hh = utc_time.hour
-                mm = utc_time.minute
-                ss = round(utc_time.second + utc_time.microsecond / 1000000, 2)
-                lon_int = int(float(item[-3]))
-                lon_deg = (float(item[-3]) - lon_int)*60
-                lat_int = int(float(item[-2]))
-                lat_deg = (float(item[-2]) - lat_int)*60
-                depth = round(float(item[-1]),2)
                 event_index = item[9]
-                output_file = output_dir / f'gamma_events_{index}.dat_ch'
-                with open(output_file,'a') as r:
-                    r.write(f"{ymd:>9}{hh:>2}{mm:>2}{ss:>6.2f}{lat_int:2}{lat_deg:0>5.2f}{lon_int:3}{lon_deg:0>5.2f}{depth:>6.2f}\n")
-                with open(gamma_picks,'r') as picks_read:
-                    picks_lines = picks_read.readlines()
-                    for p_line in picks_lines:
-                        if p_line[0] != 's':
-                            picks_index = p_line.split(',')[-2]
-                            if event_index == picks_index:
-                                part = p_line.split(',')
-                                wt = part[3]
-                                sta = part[0].split('.')[1]
-                                pick_time = datetime.strptime(part[1], '%Y-%m-%dT%H:%M:%S.%f')
-                                if mm == 59 and pick_time.minute == 0: # modify
-                                    wmm = int(60)
-                                else:
-                                    wmm = pick_time.minute
-                                wss = round(pick_time.second + pick_time.microsecond / 1000000, 2)
-                                wei = '1.00'
-                                with open(output_file,'a') as r:
-                                    if wt == 'P':
-                                        r.write(f"{' ':1}{sta:<4}{'0.0':>6}{'0':>4}{'0':>4}{wmm:>4}{wss:>6.2f}{'0.01':>5}{wei:>5}{'0.00':>6}{'0.00':>5}{'0.00':>5}\n")
-                                    else:
-                                        r.write(f"{' ':1}{sta:<4}{'0.0':>6}{'0':>4}{'0':>4}{wmm:>4}{'0.00':>6}{'0.00':>5}{'0.00':>5}{wss:>6.2f}{'0.01':>5}{wei:>5}\n")
+                buffer.append(h3dd_event_line(utc_time, float(item[-3]), float(item[-2]), float(item[-1])))
+                add_items(1)
+                for sta, wt, pick_minute, wss in shared_picks.get(event_index, ()):
+                    buffer.append(h3dd_pick_line(sta, wt, pick_minute, wss, utc_time.minute))
+    if buffer:
+        with open(output_file,'w') as r:
+            r.write(''.join(buffer))
     logging.info(f'gamma_event_{index} transform is done')
 
 class Aso_gamma(Initializer):
@@ -98,30 +161,24 @@ class Aso_gamma(Initializer):
         super().__init__(config)
         self.picks =picks
         self.gamma_events = self.output_base_dir / 'GaMMA' / 'gamma_events.csv'
-        self.gamma_order = self.output_base_dir / 'GaMMA' / 'gamma_events_order.csv'
         self.gamma_picks = self.output_base_dir / 'GaMMA' / 'gamma_picks.csv'
         self.split_dir = self.output_base_dir / 'GaMMA' / 'split_dir'
         self.for_h3dd = self.output_base_dir / 'GaMMA' / 'for_h3dd'
         self.for_h3dd.mkdir(parents=True, exist_ok=True)
-    def run_gamma_association(self):
-        region = self.output_base_dir / 'GaMMA'
-        station_csv = self.output_base_dir / "stations.csv"
-            
-        pick_df = []
-        for p in self.picks:
-            pick_df.append({
-                "id": p.trace_id,
-                "timestamp": p.peak_time.datetime,
-                "prob": p.peak_value,
-                "type": p.phase.lower()
-            })
-        pick_df = pd.DataFrame(pick_df)
-        pick_df['id'] = pick_df['id'].apply(extract_substring)
-
-        col_to_keep = ['station', 'lon', 'lat', 'elevation_m']
-        stations = pd.read_csv(station_csv, usecols=col_to_keep)
-        stations.rename(columns={"station": "id"}, inplace=True)
-        
+        self.eikonal_cache_dir = Path(config.get('eikonal_cache_dir', self.current_dir / 'output' / 'eikonal_cache'))
+        self.eikonal_cache_size = config.get('eikonal_cache_size_mb', 2048) * 1024**2
+        self.gamma_window = config.get('gamma_window')
+        self.gamma_overlap = config.get('gamma_overlap', 120)
+    def gamma_inputs(self):
+        """
+        Build the pick table, the station table and the GaMMA config.
+        :return: picks, stations, config, proj
+        """
+        if isinstance(self.picks, pd.DataFrame):
+            pick_df = store_pick_table(self.picks)
+        else:
+            pick_df = pick_table(*picks_to_arrays(self.picks))
+
         #
         config = {}
         x0 = 121.7
@@ -134,9 +191,10 @@ class Aso_gamma(Initializer):
         config["xlim_degree"] = (2 * xmin - x0, 2 * xmax - x0)
         config["ylim_degree"] = (2 * ymin - y0, 2 * ymax - y0)
 
-        proj = Proj(f"+proj=sterea +lon_0={config['center'][0]} +lat_0={config['center'][1]} +units=km")
-        stations[["x(km)", "y(km)"]] = stations.apply(lambda x: pd.Series(proj(longitude=x.longitude, latitude=x.latitude)), axis=1)
-        stations["z(km)"] = stations["elevation_m"].apply(lambda x: -x/1e3)
+        # projected once per station file and centre, see core.station_registry
+        registry = self.load_stations(config["center"])
+        stations = registry.gamma_frame()
+        proj = registry.proj
 
         config["use_dbscan"] = True
         config["use_amplitude"] = False
@@ -159,7 +217,7 @@ class Aso_gamma(Initializer):
             (None, None),  
         )
 
-        config["dbscan_eps"] = estimate_eps(stations, config["vel"]["p"]) 
+        config["dbscan_eps"] = registry.estimate_eps(config["vel"]["p"])
         config["dbscan_min_samples"] = 3
 
         velocity_model = pd.read_csv(self.vel_model_1d, names=["zz", "vp", "vs"])
@@ -177,20 +235,32 @@ class Aso_gamma(Initializer):
         config["max_sigma22"] = 1.0 
         config["max_sigma12"] = 1.0 
         #
+        picks = pick_df
         if config["use_amplitude"]:
             picks = pick_df[pick_df["amp"] != -1]
+        return picks, stations, config, proj
+    def run_gamma_association(self):
+        region = self.output_base_dir / 'GaMMA'
+        picks, stations, config, proj = self.gamma_inputs()
+        add_items(len(picks))
 
         for k, v in config.items():
             print(f"{k}: {v}")
         config2csv(config, filename=region / 'config')
+        config["eikonal"] = load_eikonal(config["eikonal"], self.eikonal_cache_dir, self.eikonal_cache_size)
 
         event_idx0 = 0 
         assignments = []
-        events, assignments = association(picks, stations, config, event_idx0, config["method"])
+        if self.gamma_window:
+            # overlapping time windows associated in parallel, then stitched
+            events, assignments = associate_partitioned(picks, stations, config, config["method"],
+                                                        self.gamma_window, self.gamma_overlap, config["ncpu"], event_idx0)
+        else:
+            events, assignments = gamma_utils().association(picks, stations, config, event_idx0, config["method"])
         event_idx0 += len(events)
 
         events = pd.DataFrame(events)
-        events[["longitude","latitude"]] = events.apply(lambda x: pd.Series(proj(longitude=x["x(km)"], latitude=x["y(km)"], inverse=True)), axis=1)
+        events["longitude"], events["latitude"] = proj(longitude=events["x(km)"].to_numpy(), latitude=events["y(km)"].to_numpy(), inverse=True)
         events["depth_km"] = events["z(km)"]
         events.to_csv(region / "gamma_events.csv", index=False, 
                         float_format="%.3f",
@@ -201,17 +271,35 @@ class Aso_gamma(Initializer):
         picks.rename(columns={"id": "station_id", "timestamp": "phase_time", "type": "phase_type", "prob": "phase_score", "amp": "phase_amplitude"}, inplace=True)
         picks.to_csv(region / "gamma_picks.csv", index=False, 
                         date_format='%Y-%m-%dT%H:%M:%S.%f')
-    def gamma2h3dd(self):
-        # order the event by date
-        gamma_reorder(self.gamma_events, self.gamma_order)
-        # split gamma_event into chunksize=4000 for running the h3dd
-        gamma_chunk_split(self.split_dir, self.gamma_order)
+    def gamma2h3dd(self, cut_off_dist=None, partition_size=4000, halo=None, max_halo=None):
+        """
+        Split the GaMMA catalog and write the h3dd input of every chunk.
+        :param cut_off_dist: When given, partition by hypocenter with a halo of
+            this D-D cut off distance (km) instead of 4000-event time chunks
+        :param partition_size: Largest number of core events in a spatial partition
+        :param halo: Halo width (km) of a spatial partition, defaults to cut_off_dist
+        :param max_halo: Largest number of halo events in a spatial partition
+        """
+        # catalogs of an earlier split, the chunk count may have dropped since
+        for old in self.for_h3dd.glob('gamma_events_*.dat_ch'):
+            if old.stem.split('_')[-1].isdigit():
+                old.unlink()
+        members_csv = self.output_base_dir / 'GaMMA' / 'partition_members.csv'
+        if cut_off_dist is None:
+            # time chunks do not overlap, a members table of an earlier spatial split would drop events
+            members_csv.unlink(missing_ok=True)
+            # order the event by date and split it into chunksize=4000 for running the h3dd
+            chunk_num = gamma_sort_split(self.split_dir, self.gamma_events)
+        else:
+            chunk_num = gamma_spatial_split(self.split_dir, self.gamma_events, cut_off_dist, partition_size, halo,
+                                max_halo=max_halo, members_csv=members_csv)
 
         # transform the format
-        chunk_num = len(os.listdir(str(self.split_dir))) # Path object needs to transform in string.
         index_list = np.arange(0, chunk_num)
-        args = [(index, self.gamma_picks, self.split_dir, self.for_h3dd) for index in index_list]
-        cores = min(chunk_num, 10)
-        with mp.Pool(processes=cores) as pool:
-            pool.map(transform, args)
+        picks_by_event = load_picks_by_event(self.gamma_picks)
+        tasks = []
+        for index in index_list:
+            split_csv = self.split_dir / f'gamma_events_{index}.csv'
+            tasks.append((index, (index, self.split_dir, self.for_h3dd), split_csv.stat().st_size if split_csv.exists() else 0))
+        run_tasks(transform, tasks, min(chunk_num, 10), initializer=init_transform, initargs=(picks_by_event,))
         
\ No newline at end of file
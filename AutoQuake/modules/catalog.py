@@ -0,0 +1,264 @@
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import h5py
+from scipy.spatial import cKDTree
+from core.initializer import Initializer
+from core.metrics import add_items
+from core.station_registry import DEFAULT_CENTER, station_proj
+from modules.aso_gamma import h3dd_event_line, h3dd_pick_line
+from modules.h3dd import parse_h3dd_event_line
+
+CATALOG_NAME = 'catalog.h5'
+EVENT_COLUMNS = {
+    'event_index': np.int64,
+    'time_ns': np.int64,
+    'longitude': np.float64,
+    'latitude': np.float64,
+    'depth_km': np.float64,
+    'x_km': np.float64,
+    'y_km': np.float64,
+    'magnitude': np.float64,
+    'relocated': np.int8,
+    'gamma_time_ns': np.int64,
+    'gamma_longitude': np.float64,
+    'gamma_latitude': np.float64,
+    'gamma_depth_km': np.float64,
+    'gamma_score': np.float64,
+    'num_picks': np.int32,
+    'pick_start': np.int64,
+}
+PICK_COLUMNS = {
+    'station_code': np.int32,
+    'phase_time_ns': np.int64,
+    'phase_score': np.float32,
+    'phase_type': np.int8,
+}
+PHASES = ['p', 's']
+
+def to_ns(times):
+    return pd.to_datetime(pd.Series(times)).to_numpy(dtype='datetime64[ns]').astype(np.int64)
+
+def read_h3dd_events(path):
+    """
+    Event lines of an h3dd catalog, in the layout of h3dd_event_line; phase
+    lines and lines that do not parse are skipped.
+    :return: DataFrame with time_ns, longitude, latitude, depth_km
+    """
+    rows = []
+    with open(path, 'r') as f:
+        for line in f:
+            parsed = parse_h3dd_event_line(line)
+            if parsed is not None:
+                rows.append(parsed)
+    return pd.DataFrame(rows, columns=['time_ns', 'longitude', 'latitude', 'depth_km'])
+
+def match_events(reference_ns, reference_xy, ns, xy, tolerance_ns, vp=6.0, neighbours=3):
+    """
+    Row of the reference events (sorted by time) matching every event: of
+    the reference events within tolerance_ns, the one with the least origin
+    time difference plus epicentral distance / vp, so that dense sequences
+    are not matched to a neighbour in time. -1 when none is within
+    tolerance_ns or when another event matches the same row better.
+    :param reference_xy, xy: (n, 2) x/y in km
+    """
+    if len(reference_ns) == 0 or len(ns) == 0:
+        return np.full(len(ns), -1, dtype=np.int64)
+    start = np.searchsorted(reference_ns, ns)
+    candidates = start[:, None] + np.arange(-neighbours, neighbours)
+    inside = (candidates >= 0) & (candidates < len(reference_ns))
+    candidates = np.clip(candidates, 0, len(reference_ns) - 1)
+    dt = np.abs(reference_ns[candidates] - ns[:, None])
+    dist = np.linalg.norm(reference_xy[candidates] - xy[:, None, :], axis=2)
+    cost = np.where(inside & (dt <= tolerance_ns), dt / 1e9 + dist / vp, np.inf)
+    best = np.argmin(cost, axis=1)
+    rows = np.arange(len(ns))
+    match = np.where(np.isfinite(cost[rows, best]), candidates[rows, best], -1)
+    cost = cost[rows, best]
+    # one relocation per reference event, the best one
+    order = np.lexsort((cost, match))
+    taken = np.zeros(len(ns), dtype=bool)
+    taken[order[np.r_[True, match[order][1:] != match[order][:-1]]]] = True
+    return np.where(taken, match, -1)
+
+def write_catalog(path, events, picks, stations, center):
+    """
+    Write the columnar catalog file: one dataset per column under /events,
+    sorted by time_ns, and the picks of every event under /picks in event
+    order (rows pick_start .. pick_start + num_picks).
+    """
+    tmp = Path(path).with_suffix(f'.{os.getpid()}.h5')
+    with h5py.File(tmp, 'w') as h5:
+        group = h5.create_group('events')
+        for name, dtype in EVENT_COLUMNS.items():
+            group.create_dataset(name, data=np.asarray(events[name], dtype=dtype))
+        group = h5.create_group('picks')
+        for name, dtype in PICK_COLUMNS.items():
+            group.create_dataset(name, data=np.asarray(picks[name], dtype=dtype))
+        h5.create_dataset('stations', data=list(stations), dtype=h5py.string_dtype())
+        h5.attrs['center'] = center
+    os.replace(tmp, path)
+
+class EventCatalog:
+    """
+    Read-only view of Catelog/catalog.h5 with a sorted time index and a
+    KD-tree over the projected epicentres, built on the first spatial query.
+    Queries return row numbers, frame() turns rows into a DataFrame.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        with h5py.File(self.path, 'r') as h5:
+            self.columns = {name: h5['events'][name][:] for name in EVENT_COLUMNS}
+            self.picks = {name: h5['picks'][name][:] for name in PICK_COLUMNS}
+            self.stations = np.asarray(h5['stations'].asstr()[:], dtype=object)
+            self.center = tuple(h5.attrs['center'])
+        self.proj = station_proj(self.center)
+        self.tree = None
+    def __len__(self):
+        return len(self.columns['time_ns'])
+    def time_range(self, starttime=None, endtime=None):
+        """
+        Rows with origin time in [starttime, endtime), a contiguous slice of the time index.
+        """
+        t = self.columns['time_ns']
+        i0 = 0 if starttime is None else int(np.searchsorted(t, pd.Timestamp(starttime).value, side='left'))
+        i1 = len(t) if endtime is None else int(np.searchsorted(t, pd.Timestamp(endtime).value, side='left'))
+        return np.arange(i0, i1)
+    def query(self, starttime=None, endtime=None, lon=None, lat=None, depth=None, magnitude=None):
+        """
+        Rows inside every given range; lon, lat, depth and magnitude are (min, max) pairs, bounds included.
+        """
+        rows = self.time_range(starttime, endtime)
+        for name, bounds in [('longitude', lon), ('latitude', lat), ('depth_km', depth), ('magnitude', magnitude)]:
+            if bounds is None or len(rows) == 0:
+                continue
+            values = self.columns[name][rows]
+            rows = rows[(values >= bounds[0]) & (values <= bounds[1])]
+        return rows
+    def spatial_index(self):
+        if self.tree is None:
+            self.tree = cKDTree(np.column_stack([self.columns['x_km'], self.columns['y_km']]))
+        return self.tree
+    def within(self, lon, lat, radius_km, starttime=None, endtime=None):
+        """
+        Rows with epicentre within radius_km of (lon, lat), in time order.
+        """
+        x, y = self.proj(longitude=lon, latitude=lat)
+        rows = np.sort(np.asarray(self.spatial_index().query_ball_point([x, y], radius_km), dtype=np.int64))
+        if starttime is not None or endtime is not None:
+            span = self.time_range(starttime, endtime)
+            rows = rows[(rows >= span[0]) & (rows <= span[-1])] if len(span) else rows[:0]
+        return rows
+    def nearest(self, lon, lat, k=1):
+        """
+        Distances (km) and rows of the k events with the nearest epicentres.
+        """
+        x, y = self.proj(longitude=lon, latitude=lat)
+        dist, rows = self.spatial_index().query([x, y], k=min(k, len(self)))
+        return np.atleast_1d(dist), np.atleast_1d(rows)
+    def frame(self, rows=None):
+        """
+        Events of the given rows (every event when None) as a DataFrame with a datetime time column.
+        """
+        rows = slice(None) if rows is None else rows
+        df = pd.DataFrame({name: col[rows] for name, col in self.columns.items() if name != 'pick_start'})
+        df.insert(1, 'time', df.pop('time_ns').to_numpy().astype('datetime64[ns]'))
+        df['gamma_time'] = df.pop('gamma_time_ns').to_numpy().astype('datetime64[ns]')
+        return df
+    def to_csv(self, path, rows=None):
+        self.frame(rows).to_csv(path, index=False, float_format='%.4f', date_format='%Y-%m-%dT%H:%M:%S.%f')
+    def to_h3dd(self, path, rows=None):
+        """
+        Write events and their picks in the h3dd input format.
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        times = pd.to_datetime(self.columns['time_ns'][rows])
+        lon, lat, depth = (self.columns[name][rows] for name in ['longitude', 'latitude', 'depth_km'])
+        count = self.columns['num_picks'][rows]
+        # pick rows of the selected events, in event order
+        first = np.repeat(self.columns['pick_start'][rows] - np.concatenate([[0], np.cumsum(count)[:-1]]), count)
+        index = first + np.arange(count.sum())
+        pick_times = pd.to_datetime(self.picks['phase_time_ns'][index])
+        minute = pick_times.minute.to_numpy()
+        second = np.round(pick_times.second.to_numpy() + pick_times.microsecond.to_numpy() / 1e6, 2)
+        station = self.stations[self.picks['station_code'][index]]
+        phase = np.asarray(PHASES, dtype=object)[self.picks['phase_type'][index]]
+        lines = []
+        i = 0
+        for k in range(len(rows)):
+            utc_time = times[k]
+            lines.append(h3dd_event_line(utc_time, float(lon[k]), float(lat[k]), float(depth[k])))
+            for j in range(i, i + count[k]):
+                lines.append(h3dd_pick_line(station[j], phase[j], int(minute[j]), float(second[j]), utc_time.minute))
+            i += count[k]
+        with open(path, 'w') as f:
+            f.write(''.join(lines))
+
+class Catalog(Initializer):
+    """
+    Merge GaMMA events, their picks, local magnitudes and h3dd relocations
+    into Catelog/catalog.h5, see EventCatalog for queries.
+    """
+    def __init__(self, config):
+        super().__init__(config)
+        self.gamma_events = self.output_base_dir / 'GaMMA' / 'gamma_events.csv'
+        self.gamma_picks = self.output_base_dir / 'GaMMA' / 'gamma_picks.csv'
+        self.magnitude_csv = self.output_base_dir / 'Magnitude' / 'magnitude.csv'
+        self.h3dd_catalog = self.output_base_dir / 'h3dd' / f"h3dd_all{config.get('h3dd_output_suffix', '.hout')}"
+        self.catalog_dir = self.output_base_dir / 'Catelog'
+        self.catalog_dir.mkdir(parents=True, exist_ok=True)
+        self.catalog_path = self.catalog_dir / CATALOG_NAME
+        self.match_tolerance = config.get('catalog_match_s', 3.0)
+    def build_catalog(self, center=DEFAULT_CENTER):
+        """
+        One row per GaMMA event, located by h3dd when a relocated event lies
+        within catalog_match_s of its origin time (see match_events), by GaMMA
+        otherwise.
+        :return: EventCatalog of the written file
+        """
+        events = pd.read_csv(self.gamma_events)
+        events = events.assign(gamma_time_ns=to_ns(events['time'])).sort_values('gamma_time_ns', kind='stable').reset_index(drop=True)
+        events['gamma_longitude'], events['gamma_latitude'] = events['longitude'], events['latitude']
+        events['gamma_depth_km'] = events['depth_km']
+        events['time_ns'] = events['gamma_time_ns']
+        events['relocated'] = 0
+        proj = station_proj(center)
+        if self.h3dd_catalog.is_file():
+            relocated = read_h3dd_events(self.h3dd_catalog)
+            gamma_xy = np.column_stack(proj(longitude=events['longitude'].to_numpy(), latitude=events['latitude'].to_numpy()))
+            h3dd_xy = np.column_stack(proj(longitude=relocated['longitude'].to_numpy(), latitude=relocated['latitude'].to_numpy()))
+            match = match_events(events['gamma_time_ns'].to_numpy(), gamma_xy, relocated['time_ns'].to_numpy(), h3dd_xy,
+                                 int(self.match_tolerance * 1e9))
+            found = match >= 0
+            rows = match[found]
+            for name in ['time_ns', 'longitude', 'latitude', 'depth_km']:
+                events.loc[rows, name] = relocated[name].to_numpy()[found]
+            events.loc[rows, 'relocated'] = 1
+            print(f"catalog: {found.sum()} of {len(relocated)} h3dd events matched")
+            # relocated origin times may reorder the events
+            events = events.sort_values('time_ns', kind='stable').reset_index(drop=True)
+        events['magnitude'] = np.nan
+        if self.magnitude_csv.is_file():
+            ml = pd.read_csv(self.magnitude_csv, usecols=['event_index', 'ml']).set_index('event_index')['ml']
+            events['magnitude'] = events['event_index'].map(ml).to_numpy(dtype=np.float64)
+        x, y = proj(longitude=events['longitude'].to_numpy(), latitude=events['latitude'].to_numpy())
+        events['x_km'], events['y_km'] = x, y
+
+        picks = pd.read_csv(self.gamma_picks, usecols=['station_id', 'phase_time', 'phase_score', 'phase_type', 'event_index'])
+        picks = picks[picks['event_index'] >= 0]
+        row_of = pd.Series(np.arange(len(events)), index=events['event_index'])
+        picks = picks.assign(row=picks['event_index'].map(row_of)).dropna(subset=['row'])
+        picks = picks.assign(phase_time_ns=to_ns(picks['phase_time'])).sort_values(['row', 'phase_time_ns'], kind='stable')
+        station_code, stations = pd.factorize(picks['station_id'])
+        picks['station_code'] = station_code
+        picks['phase_type'] = picks['phase_type'].str.lower().map({p: i for i, p in enumerate(PHASES)}).fillna(0)
+        events['num_picks'] = np.bincount(picks['row'].to_numpy(dtype=np.int64), minlength=len(events))
+        events['pick_start'] = np.concatenate([[0], np.cumsum(events['num_picks'].to_numpy())[:-1]])
+        if 'gamma_score' not in events:
+            events['gamma_score'] = np.nan
+
+        write_catalog(self.catalog_path, events, picks, stations, center)
+        add_items(len(events))
+        print(f"catalog: {len(events)} events ({int(events['relocated'].sum())} relocated), {len(picks)} picks in {self.catalog_path}")
+        return EventCatalog(self.catalog_path)
@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from pathlib import Path
+import numpy as np
+
+TABLES = ['up', 'us', 'grad_up', 'grad_us', 'rgrid', 'zgrid']
+
+def eikonal_key(eikonal):
+    """
+    Hash the velocity model contents, the grid spacing and the region limits.
+    """
+    sha = hashlib.sha256()
+    for phase in ['z', 'p', 's']:
+        sha.update(np.ascontiguousarray(eikonal['vel'][phase], dtype=np.float64).tobytes())
+    limits = [eikonal['h'], *eikonal['xlim'], *eikonal['ylim'], *eikonal['zlim']]
+    sha.update(np.asarray(limits, dtype=np.float64).tobytes())
+    return sha.hexdigest()[:16]
+
+def dir_size(path):
+    return sum(f.stat().st_size for f in Path(path).iterdir() if f.is_file())
+
+def evict(cache_dir, max_bytes, keep=None):
+    """
+    Remove the least recently used tables until the cache fits in max_bytes.
+    """
+    entries = [d for d in Path(cache_dir).iterdir() if d.is_dir() and not d.name.startswith('.')]
+    total = sum(dir_size(d) for d in entries)
+    entries = sorted((d for d in entries if d.name != keep), key=lambda d: d.stat().st_mtime)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        total -= dir_size(entry)
+        shutil.rmtree(entry, ignore_errors=True)
+        print(f"eikonal cache: evicted {entry.name}")
+
+def load_eikonal(eikonal, cache_dir, max_bytes=2 * 1024**3):
+    """
+    Return the GaMMA eikonal config with the travel-time tables filled in.
+    Tables are read memory-mapped from cache_dir when the same velocity model,
+    grid spacing and limits were solved before, otherwise they are solved by
+    GaMMA and stored.
+    :param eikonal: Config holding vel, h, xlim, ylim and zlim
+    :param cache_dir: Directory holding one sub-directory per cached table set
+    :param max_bytes: Size budget of cache_dir
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    key = eikonal_key(eikonal)
+    entry = cache_dir / key
+    if (entry / 'meta.json').is_file():
+        with open(entry / 'meta.json', 'r') as f:
+            meta = json.load(f)
+        eikonal = dict(eikonal)
+        for table in TABLES:
+            eikonal[table] = np.load(entry / f'{table}.npy', mmap_mode='r')
+        eikonal.update(meta)
+        os.utime(entry)
+        print(f"eikonal cache: hit {key}")
+        return eikonal
+
+    print(f"eikonal cache: miss {key}, solving travel-time tables")
+    from gamma.seismic_ops import initialize_eikonal
+    t0 = time.perf_counter()
+    eikonal = initialize_eikonal(dict(eikonal))
+    tmp = cache_dir / f'.{key}.{os.getpid()}'
+    tmp.mkdir(parents=True, exist_ok=True)
+    for table in TABLES:
+        np.save(tmp / f'{table}.npy', eikonal[table])
+    with open(tmp / 'meta.json', 'w') as f:
+        json.dump({'nr': int(eikonal['nr']), 'nz': int(eikonal['nz']), 'h': float(eikonal['h'])}, f)
+    try:
+        tmp.rename(entry)
+    except OSError:
+        # another run stored the same key meanwhile
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(f"eikonal cache: stored {key} in {time.perf_counter() - t0:.1f} s")
+    evict(cache_dir, max_bytes, keep=key)
+    return eikonal
+
+def skip_initialized(initialize):
+    """
+    Wrap gamma's initialize_eikonal so configs already holding the tables
+    (e.g. from load_eikonal) are passed through instead of solved again.
+    """
+    def wrapper(config):
+        if 'up' in config:
+            return config
+        return initialize(config)
+    wrapper.skips_initialized = True
+    return wrapper
+
+def gamma_utils():
+    """
+    Import gamma.utils with initialize_eikonal wrapped by skip_initialized,
+    association() solves config["eikonal"] on every call otherwise.
+    """
+    import gamma.utils
+    if not getattr(gamma.utils.initialize_eikonal, 'skips_initialized', False):
+        gamma.utils.initialize_eikonal = skip_initialized(gamma.utils.initialize_eikonal)
+    return gamma.utils
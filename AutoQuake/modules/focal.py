@@ -0,0 +1,145 @@
+import logging
+import numpy as np
+import pandas as pd
+from core.initializer import Initializer
+from core.scheduler import run_tasks, write_timings
+from core.metrics import add_items
+from core.waveform_windows import data_final_dirs, read_station, cut_windows
+
+POLARITY_COLUMNS = ['event_index', 'station', 'channel', 'phase_time', 'azimuth', 'takeoff', 'distance_km',
+                    'polarity', 'quality', 'snr']
+
+def first_motion(windows, i_pick, tolerance, snr_min=3.0, snr_impulsive=10.0):
+    """
+    First-motion polarity of a batch of vertical windows, all rows at once.
+    The noise level is taken before the pick, the first motion is the first
+    sample after (pick - tolerance) leaving snr_min times the noise, and its
+    size is the first peak that follows.
+    :param windows: (n, npts) samples with the pick at column i_pick
+    :param tolerance: Samples the onset may precede the pick by
+    :return: polarity (+1 up, -1 down, 0 unknown), quality ('I' impulsive,
+        'E' emergent, '' unknown), snr of the first peak
+    """
+    start = max(i_pick - tolerance, 2)
+    noise = windows[:, :start]
+    x = windows - noise.mean(axis=1, keepdims=True)
+    sigma = np.maximum(noise.std(axis=1), np.finfo(np.float64).tiny)
+    after = x[:, start:]
+    exceed = np.abs(after) > snr_min * sigma[:, None]
+    found = exceed.any(axis=1)
+    onset = np.argmax(exceed, axis=1)
+    rows = np.arange(len(after))
+    sign = np.sign(after[rows, onset])
+    # first sample past the onset where the motion turns back
+    turning = (np.diff(after, axis=1, append=after[:, -1:]) * sign[:, None] <= 0) & (np.arange(after.shape[1]) >= onset[:, None])
+    peak = np.where(turning.any(axis=1), np.argmax(turning, axis=1), after.shape[1] - 1)
+    snr = np.abs(after[rows, peak]) / sigma
+    polarity = np.where(found, sign, 0).astype(np.int8)
+    quality = np.where(~found, '', np.where(snr >= snr_impulsive, 'I', 'E'))
+    return polarity, quality, np.where(found, snr, 0.0)
+
+def init_focal(settings):
+    global shared_settings
+    shared_settings = settings
+
+def station_polarities(args):
+    """
+    Polarities of all P picks of one station-day: the station's traces are
+    read once and every pick window is cut from them in one gather.
+    :return: DataFrame with pick_row, channel, polarity, quality, snr
+    """
+    station, day, data_dirs, merge_format, pick_row, pick_t, log_file = args
+    logging.basicConfig(filename=log_file, level=logging.INFO, filemode='a')
+    traces = read_station(data_dirs, station, merge_format, components='Z')
+    out = []
+    for channel, (starttime, sampling_rate, data) in sorted(traces.items()):
+        if channel[-1] != 'Z':
+            continue
+        i_pick = int(round(shared_settings['pre'] * sampling_rate))
+        npts = i_pick + int(round(shared_settings['post'] * sampling_rate))
+        windows, valid = cut_windows(data, starttime, sampling_rate, pick_t - shared_settings['pre'], npts)
+        if not valid.any():
+            continue
+        polarity, quality, snr = first_motion(windows[valid], i_pick, int(round(shared_settings['tolerance'] * sampling_rate)),
+                                              shared_settings['snr_min'], shared_settings['snr_impulsive'])
+        out.append(pd.DataFrame({'pick_row': pick_row[valid], 'channel': channel, 'polarity': polarity,
+                                 'quality': quality, 'snr': snr}))
+        add_items(int(valid.sum()))
+        # one vertical channel per station
+        break
+    logging.info(f"{day} {station}: {sum(len(df) for df in out)} of {len(pick_row)} P picks")
+    if not out:
+        return pd.DataFrame(columns=['pick_row', 'channel', 'polarity', 'quality', 'snr'])
+    return pd.concat(out, ignore_index=True)
+
+class Focal(Initializer):
+    """
+    First-motion polarities of the associated P picks, written to
+    Focal/polarity.csv with the station azimuth and takeoff angle of every
+    event as input for a focal-mechanism inversion.
+    """
+    def __init__(self, config):
+        super().__init__(config)
+        self.gamma_events = self.output_base_dir / 'GaMMA' / 'gamma_events.csv'
+        self.gamma_picks = self.output_base_dir / 'GaMMA' / 'gamma_picks.csv'
+        self.focal_dir = self.output_base_dir / 'Focal'
+        self.focal_dir.mkdir(parents=True, exist_ok=True)
+        self.polarity_csv = self.focal_dir / 'polarity.csv'
+        self.settings = {
+            'pre': config.get('focal_pre', 0.5),
+            'post': config.get('focal_post', 0.5),
+            'tolerance': config.get('focal_tolerance', 0.05),
+            'snr_min': config.get('focal_snr', 3.0),
+            'snr_impulsive': config.get('focal_snr_impulsive', 10.0),
+        }
+    def p_picks(self):
+        """
+        Associated P picks with the event geometry: azimuth from the event
+        to the station, epicentral distance and straight-ray takeoff angle
+        (degrees from down).
+        """
+        events = pd.read_csv(self.gamma_events, usecols=['event_index', 'longitude', 'latitude', 'depth_km'])
+        picks = pd.read_csv(self.gamma_picks, usecols=['station_id', 'phase_time', 'phase_type', 'event_index'])
+        picks = picks[(picks['event_index'] >= 0) & (picks['phase_type'].str.lower() == 'p')]
+        picks = picks.merge(events, on='event_index').rename(columns={'station_id': 'station'})
+        registry = self.load_stations()
+        rows = registry.indices(picks['station'])
+        picks = picks[rows >= 0].reset_index(drop=True)
+        rows = rows[rows >= 0]
+        x, y = registry.project(picks['longitude'], picks['latitude'])
+        dx, dy = registry.x[rows] - x, registry.y[rows] - y
+        picks['azimuth'] = np.degrees(np.arctan2(dx, dy)) % 360
+        picks['distance_km'] = np.hypot(dx, dy)
+        picks['takeoff'] = np.degrees(np.arctan2(picks['distance_km'], picks['depth_km'] - registry.z[rows]))
+        picks['t'] = (pd.to_datetime(picks['phase_time']) - pd.Timestamp(0)) / pd.Timedelta(seconds=1)
+        picks['day'] = pd.to_datetime(picks['t'] - self.settings['pre'], unit='s').dt.strftime('%Y%m%d')
+        return picks
+    def run_polarity(self, processes=None):
+        """
+        Polarities with one task per station-day across the process pool.
+        :return: Path of Focal/polarity.csv
+        """
+        picks = self.p_picks()
+        picks = picks[picks['day'].isin(self.date_list)]
+        log_file = self.output_base_dir / 'log' / 'focal.log'
+        tasks = []
+        for (day, station), group in picks.groupby(['day', 'station']):
+            data_dirs = data_final_dirs(self.output_base_dir, self.date_list, day, group['t'].max() + self.settings['post'])
+            args = (station, day, data_dirs, self.merge_format, group.index.to_numpy(), group['t'].to_numpy(), log_file)
+            tasks.append(((day, station), args, len(group)))
+        results, timings, wall = run_tasks(station_polarities, tasks, processes or self.n_workers,
+                                           initializer=init_focal, initargs=(self.settings,))
+        write_timings(timings, wall, self.focal_dir / 'focal_timings.csv', 'focal')
+        found = [results[key] for key in sorted(results) if len(results[key])]
+        if found:
+            found = pd.concat(found, ignore_index=True).set_index('pick_row')
+            picks = picks.join(found)
+        else:
+            picks = picks.assign(channel='', polarity=0, quality='', snr=0.0)
+        picks['polarity'] = picks['polarity'].fillna(0).astype(np.int8)
+        picks['quality'] = picks['quality'].fillna('')
+        picks = picks.sort_values(['event_index', 'distance_km'])
+        picks[POLARITY_COLUMNS].to_csv(self.polarity_csv, index=False, float_format='%.2f')
+        n_known = int((picks['polarity'] != 0).sum())
+        print(f"focal: {n_known} polarities of {len(picks)} P picks, {picks.loc[picks['polarity'] != 0, 'event_index'].nunique()} events")
+        return self.polarity_csv
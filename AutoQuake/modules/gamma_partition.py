@@ -0,0 +1,179 @@
+import multiprocessing as mp
+from collections import Counter
+import numpy as np
+import pandas as pd
+from modules.eikonal_cache import gamma_utils
+from core.metrics import add_items
+from core.scheduler import run_tasks
+
+def to_seconds(times):
+    """
+    Seconds since epoch of naive UTC datetimes or ISO strings.
+    """
+    return ((pd.to_datetime(pd.Series(times)) - pd.Timestamp(0)) / pd.Timedelta(seconds=1)).to_numpy()
+
+def split_windows(t_min, t_max, window, overlap):
+    """
+    Cut [t_min, t_max] into windows of `window` seconds.
+    :return: list of (core_start, core_end, read_start, read_end); an event is
+        owned by the window whose core span holds its origin time, the read span
+        pads the core with `overlap` seconds so that all picks of such an event
+        are seen by that window. Windows also report the events just outside
+        their core (see associate_window), as two windows may place the origin
+        of an event near their border on different sides of it.
+    """
+    windows = []
+    t = np.floor(t_min)
+    while t <= t_max:
+        windows.append([t, t + window, t - overlap, t + window + overlap])
+        t += window
+    # origin times precede the first pick, keep the outer cores open
+    windows[0][0] = -np.inf
+    windows[-1][1] = np.inf
+    return [tuple(w) for w in windows]
+
+def init_partition(stations, config, method):
+    global shared_inputs
+    shared_inputs = (stations, config, method)
+
+def associate_window(args):
+    k, picks, core_start, core_end, margin = args
+    stations, config, method = shared_inputs
+    config = dict(config)
+    add_items(len(picks))
+    # one process per window, no nested pool inside gamma
+    config["ncpu"] = 1
+    if len(picks) < config["min_picks_per_eq"]:
+        return k, [], []
+    events, assignments = gamma_utils().association(picks, stations, config, 0, method)
+    if not events:
+        return k, [], []
+    origin = to_seconds([event["time"] for event in events])
+    # the margin catches border events, stitch settles the ones found twice
+    kept = {event["event_index"] for event, t in zip(events, origin) if core_start - margin <= t < core_end + margin}
+    events = [event for event in events if event["event_index"] in kept]
+    assignments = [a for a in assignments if a[1] in kept]
+    return k, events, assignments
+
+def same_events(assignments, min_shared=0.5):
+    """
+    Events of different windows sharing at least min_shared of the picks of
+    the smaller one.
+    :param assignments: DataFrame of pick_index, key (window, event_index), gamma_score
+    :return: {key: key of the event it is merged into}
+    """
+    size = assignments["key"].value_counts()
+    pairs = assignments.merge(assignments, on="pick_index")
+    pairs = pairs[[a[0] < b[0] for a, b in zip(pairs["key_x"], pairs["key_y"])]]
+    merged = {}
+    def find(key):
+        while key in merged:
+            key = merged[key]
+        return key
+    for (a, b), shared in pairs.groupby(["key_x", "key_y"], sort=True).size().items():
+        if shared < min_shared * min(size[a], size[b]):
+            continue
+        a, b = find(a), find(b)
+        if a == b:
+            continue
+        # the event holding more picks stays, the earlier window on a tie
+        keep, drop = (a, b) if (-size[a], a) <= (-size[b], b) else (b, a)
+        merged[drop] = keep
+    return {key: find(key) for key in merged}
+
+def stitch(results, picks, config, event_idx0=0):
+    """
+    Merge the per-window results into one catalog.
+    Events of two windows that share most of their picks are the same
+    earthquake found on both sides of a window border and are settled into
+    the one with more picks. A pick claimed by events of two windows stays
+    with the higher gamma score, events left with too few picks are dropped
+    and event_index is renumbered in origin time order starting from event_idx0.
+    """
+    events, assignments = [], []
+    for k, events_, assignments_ in results:
+        for event in events_:
+            events.append(dict(event, key=(k, event["event_index"])))
+        assignments.extend((pick_index, (k, event_index), score) for pick_index, event_index, score in assignments_)
+    if not events:
+        return [], []
+
+    assignments = pd.DataFrame(assignments, columns=["pick_index", "key", "gamma_score"])
+    same = same_events(assignments)
+    events = [event for event in events if event["key"] not in same]
+    assignments["key"] = [same.get(key, key) for key in assignments["key"]]
+    assignments = assignments.sort_values("gamma_score", ascending=False, kind="stable").drop_duplicates("pick_index")
+    phase = picks.loc[assignments["pick_index"], "type"].str.lower().to_numpy()
+    num_picks = Counter(assignments["key"])
+    num_p = Counter(assignments["key"][phase == "p"])
+    num_s = Counter(assignments["key"][phase == "s"])
+
+    kept = []
+    for event in events:
+        key = event["key"]
+        if num_picks[key] < config["min_picks_per_eq"]:
+            continue
+        if num_p[key] < config.get("min_p_picks_per_eq", 0) or num_s[key] < config.get("min_s_picks_per_eq", 0):
+            continue
+        event["num_picks"], event["num_p_picks"], event["num_s_picks"] = num_picks[key], num_p[key], num_s[key]
+        kept.append(event)
+    kept.sort(key=lambda event: event["time"])
+
+    new_index = {}
+    for i, event in enumerate(kept):
+        new_index[event.pop("key")] = event_idx0 + i
+        event["event_index"] = event_idx0 + i
+    assignments = assignments[assignments["key"].isin(new_index)]
+    assignments = [(pick_index, new_index[key], score) for pick_index, key, score in assignments.itertuples(index=False)]
+    return kept, assignments
+
+def associate_partitioned(picks, stations, config, method="BGMM", window=3600, overlap=120, processes=None, event_idx0=0):
+    """
+    Drop-in replacement of gamma.utils.association that associates
+    overlapping time windows in parallel.
+    :param window: Core length of a window in seconds
+    :param overlap: Padding in seconds, should exceed the longest travel time plus the cluster duration
+    :param processes: Size of the process pool
+    :return: events, assignments in the same layout as association
+    """
+    if len(picks) == 0:
+        return [], []
+    t = to_seconds(picks["timestamp"])
+    tasks = []
+    for k, (core_start, core_end, read_start, read_end) in enumerate(split_windows(t.min(), t.max(), window, overlap)):
+        mask = (t >= read_start) & (t < read_end)
+        if mask.any():
+            tasks.append((k, (k, picks[mask], core_start, core_end, overlap / 2), int(mask.sum())))
+    processes = min(processes or mp.cpu_count(), len(tasks))
+    print(f"Associating {len(picks)} picks in {len(tasks)} windows with {processes} processes")
+    results, _, _ = run_tasks(associate_window, tasks, processes, initializer=init_partition, initargs=(stations, config, method))
+    return stitch([results[k] for k in sorted(results)], picks, config, event_idx0)
+
+def compare_associations(reference, candidate, n_picks):
+    """
+    Agreement between two association results on the same picks.
+    Each reference event is matched to the candidate event sharing most of
+    its picks; a pick agrees when both leave it unassigned or put it in
+    matched events.
+    :param reference: assignments of the reference run, (pick_index, event_index, score)
+    :param candidate: assignments of the run to check
+    :param n_picks: Number of picks given to both runs
+    """
+    ref = {pick_index: event_index for pick_index, event_index, _ in reference}
+    cand = {pick_index: event_index for pick_index, event_index, _ in candidate}
+    shared = Counter((ref[p], cand[p]) for p in ref.keys() & cand.keys())
+    match, used = {}, set()
+    for (ref_event, cand_event), n in sorted(shared.items(), key=lambda item: -item[1]):
+        if ref_event not in match and cand_event not in used:
+            match[ref_event] = cand_event
+            used.add(cand_event)
+    agree = n_picks - len(ref.keys() | cand.keys())
+    agree += sum(1 for p, e in ref.items() if p in cand and match.get(e) == cand[p])
+    n_ref, n_cand = len(set(ref.values())), len(set(cand.values()))
+    return {
+        "reference_events": n_ref,
+        "candidate_events": n_cand,
+        "matched_events": len(match),
+        "event_agreement": len(match) / max(n_ref, n_cand, 1),
+        "pick_agreement": agree / max(n_picks, 1),
+    }
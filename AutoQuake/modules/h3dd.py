@@ -1,5 +1,83 @@
+import os
+import re
+import time
 import subprocess
+import multiprocessing as mp
+from pathlib import Path
+import numpy as np
+import pandas as pd
 from core.initializer import Initializer
+from core.waveform_index import link_file
+from core.scheduler import run_tasks
+from core.metrics import add_items
+
+def chunk_number(path):
+    found = re.findall(r'\d+', Path(path).name)
+    return int(found[-1]) if found else -1
+
+def parse_h3dd_event_line(line):
+    """
+    Origin time (ns since epoch), longitude, latitude and depth of an event
+    line in the layout of h3dd_event_line, None for any other line.
+    """
+    if len(line) < 40 or not line[1:9].strip().isdigit():
+        return None
+    try:
+        ymd, hh, mm, ss = line[0:9].strip(), int(line[9:11]), int(line[11:13]), float(line[13:19])
+        lat = int(line[19:21]) + float(line[21:26]) / 60
+        lon = int(line[26:29]) + float(line[29:34]) / 60
+        depth = float(line[34:40])
+    except ValueError:
+        return None
+    t = np.datetime64(f'{ymd[:4]}-{ymd[4:6]}-{ymd[6:8]}', 'ns') + np.timedelta64(int(round((hh * 3600 + mm * 60 + ss) * 1e6)), 'us')
+    return int(t.astype(np.int64)), lon, lat, depth
+
+def core_events(text, members):
+    """
+    Drop the halo events of one partition from an h3dd output. Every event
+    line starts a block that runs to the next one; blocks are taken in the
+    order of the partition catalog when the counts agree, and matched to the
+    member with the closest origin time otherwise.
+    :param members: partition_members rows of the partition in catalog order, with core and time_ns
+    :return: text with the blocks of core events only, None when no event line parses
+    """
+    preamble, blocks, times = [], [], []
+    for line in text.splitlines(keepends=True):
+        parsed = parse_h3dd_event_line(line)
+        if parsed is not None:
+            blocks.append([line])
+            times.append(parsed[0])
+        elif blocks:
+            blocks[-1].append(line)
+        else:
+            preamble.append(line)
+    if not blocks:
+        return None
+    core = members['core'].to_numpy(dtype=bool)
+    if len(blocks) == len(members):
+        keep = core
+    else:
+        reference = members['time_ns'].to_numpy()
+        order = np.argsort(reference, kind='stable')
+        i = np.clip(np.searchsorted(reference[order], times), 1, len(order) - 1) if len(order) > 1 else np.zeros(len(times), dtype=int)
+        left = order[np.maximum(i - 1, 0)]
+        right = order[i]
+        nearest = np.where(np.abs(reference[left] - times) <= np.abs(reference[right] - times), left, right)
+        keep = core[nearest]
+    return ''.join(preamble) + ''.join(''.join(block) for block, k in zip(blocks, keep) if k)
+
+def run_h3dd_chunk(args):
+    """
+    Run h3dd inside one chunk workspace, stdout/stderr go to files in that workspace.
+    """
+    index, executable, workdir = args
+    t0 = time.perf_counter()
+    with open(workdir / 'h3dd.inp', 'r') as stdin, \
+         open(workdir / 'h3dd.stdout.log', 'w') as stdout, \
+         open(workdir / 'h3dd.stderr.log', 'w') as stderr:
+        proc = subprocess.run([str(executable)], stdin=stdin, stdout=stdout, stderr=stderr, cwd=workdir)
+    add_items(1)
+    return index, proc.returncode, time.perf_counter() - t0
 
 class H3dd(Initializer):
     def __init__(self, config):
@@ -7,14 +85,24 @@ class H3dd(Initializer):
         self.for_h3dd_dir = self.output_base_dir / 'GaMMA' / 'for_h3dd'
         self.h3dd_dir = self.output_base_dir / 'h3dd'
         self.h3dd_station = self.output_base_dir / 'h3dd_station_format'
-    def h3dd_inp(self, index, cut_off_dist):
-        with open(self.current_dir / 'h3dd.inp', 'w') as f:
+        self.members_csv = self.output_base_dir / 'GaMMA' / 'partition_members.csv'
+    def h3dd_inp(self, index, cut_off_dist, workdir=None, catalog=None):
+        """
+        Write h3dd.inp into the current directory, or into workdir for a chunk
+        workspace where the catalog has been placed under its own name.
+        """
+        inp_dir = self.current_dir if workdir is None else Path(workdir)
+        with open(inp_dir / 'h3dd.inp', 'w') as f:
             f.write("*1. input catalog data\n")
-            f.write(f"{str(self.for_h3dd_dir)}/gamma_new_{index}.dat_ch | awk -F/ '{{print $NF}}'\n")
+            if catalog is None:
+                f.write(f"{str(self.for_h3dd_dir)}/gamma_new_{index}.dat_ch | awk -F/ '{{print $NF}}'\n")
+            else:
+                f.write(f"{Path(catalog).name}\n")
             f.write("*2. station information file\n")
             f.write(f"{self.h3dd_station}\n")
             f.write("*3. 3d velocity model\n")
-            f.write(f"{self.vel_model_3d}\n")
+            # chunks run inside their workspace, a relative path would resolve there
+            f.write(f"{os.path.abspath(self.vel_model_3d) if self.vel_model_3d else ''}\n")
             f.write("*4. weighting for p wave, s wave, and single event data\n")
             f.write("*   wp  ws  wsingle\n")
             f.write("    1.  1.   0.1\n")
@@ -42,4 +130,78 @@ class H3dd(Initializer):
     def run_h3dd(self):
         with open(self.current_dir / 'h3dd.inp', 'r') as file:
             subprocess.run(['./h3dd'], stdin=file, text=True, capture_output=True)
-    
\ No newline at end of file
+    def run_h3dd_parallel(self, cut_off_dist, processes=None, executable=None, pattern='*.dat_ch'):
+        """
+        Relocate every catalog chunk of for_h3dd in its own workspace
+        h3dd/chunks/chunk_<i> and gather the outputs into h3dd/.
+        :param cut_off_dist: Cut off distance for the D-D method (km)
+        :param processes: Size of the process pool, defaults to the number of cores
+        :param executable: h3dd binary or a stand-in with the same stdin interface
+        :param pattern: Glob of the chunk catalogs in for_h3dd
+        :return: {suffix: merged output path} for every output h3dd wrote next to the catalogs
+        :raises RuntimeError: When h3dd failed on a chunk, after the outputs of
+            the other chunks have been gathered
+        """
+        executable = Path(executable or self.config.get('h3dd_executable', self.current_dir / 'h3dd')).resolve()
+        catalogs = sorted(self.for_h3dd_dir.glob(pattern), key=chunk_number)
+        tasks = []
+        for catalog in catalogs:
+            index = chunk_number(catalog)
+            workdir = self.h3dd_dir / 'chunks' / f'chunk_{index}'
+            workdir.mkdir(parents=True, exist_ok=True)
+            # outputs of an earlier run would be collected as this run's
+            for old in workdir.glob(f'{catalog.name}?*'):
+                old.unlink()
+            link_file(catalog, workdir, 'symlink')
+            self.h3dd_inp(index, cut_off_dist, workdir=workdir, catalog=catalog)
+            tasks.append((index, (index, executable, workdir), catalog.stat().st_size))
+        if not tasks:
+            print(f"No catalog matching {pattern} in {self.for_h3dd_dir}")
+            return {}
+        processes = processes or self.config.get('h3dd_processes', mp.cpu_count())
+        results, _, _ = run_tasks(run_h3dd_chunk, tasks, processes)
+        failed = []
+        for index, returncode, elapsed in (results[index] for index in sorted(results)):
+            status = 'ok' if returncode == 0 else f'failed ({returncode})'
+            print(f"h3dd chunk {index}: {status} in {elapsed:.1f} s")
+            if returncode != 0:
+                failed.append(index)
+        # partial outputs of a failed chunk are left in its workspace, not merged
+        merged = self.collect_h3dd_outputs([catalog for catalog in catalogs if chunk_number(catalog) not in failed])
+        if failed:
+            raise RuntimeError(f"h3dd failed on chunks {failed}, see h3dd/chunks/chunk_<i>/h3dd.stderr.log")
+        return merged
+    def collect_h3dd_outputs(self, catalogs):
+        """
+        Concatenate, in chunk order, the files h3dd named after each chunk
+        catalog (<catalog><suffix>) into h3dd/h3dd_all<suffix>. After a
+        spatial split the halo copies are dropped (see core_events), so that
+        every event is taken from the partition it is a core event of.
+        """
+        members = {}
+        if self.members_csv.is_file():
+            table = pd.read_csv(self.members_csv)
+            table['time_ns'] = pd.to_datetime(table['time']).to_numpy(dtype='datetime64[ns]').astype(np.int64)
+            members = {partition: rows for partition, rows in table.groupby('partition', sort=False)}
+        merged = {}
+        for old in self.h3dd_dir.glob('h3dd_all*'):
+            old.unlink()
+        for catalog in catalogs:
+            workdir = self.h3dd_dir / 'chunks' / f'chunk_{chunk_number(catalog)}'
+            for output in sorted(workdir.glob(f'{catalog.name}?*')):
+                suffix = output.name[len(catalog.name):]
+                if suffix not in merged:
+                    merged[suffix] = self.h3dd_dir / f'h3dd_all{suffix}'
+                    merged[suffix].write_bytes(b'')
+                index = chunk_number(catalog)
+                if index in members:
+                    text = core_events(output.read_text(), members[index])
+                    if text is None:
+                        print(f"{output.name}: no event lines, halo events of partition {index} kept")
+                        text = output.read_text()
+                    with open(merged[suffix], 'a') as f:
+                        f.write(text)
+                    continue
+                with open(merged[suffix], 'ab') as f:
+                    f.write(output.read_bytes())
+        return merged
@@ -0,0 +1,269 @@
+import logging
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy.fft import next_fast_len, rfft, irfft, rfftfreq
+from core.initializer import Initializer
+from core.scheduler import run_tasks, write_timings
+from core.metrics import add_items
+from core.waveform_windows import data_final_dirs, read_station, cut_windows, detrend
+
+# Wood-Anderson seismograph (Uhrhammer & Collins, 1990), displacement in m to trace amplitude in m
+WOOD_ANDERSON = {'zeros': [0j, 0j], 'poles': [-6.283 + 4.7124j, -6.283 - 4.7124j], 'gain': 2080.0}
+HORIZONTAL = ('N', 'E', '1', '2')
+BATCH_WINDOWS = 512
+
+def read_pz(path):
+    """
+    Parse a SAC pole-zero file.
+    :return: dict with network, station, location, channel, input unit, zeros, poles and constant;
+        zeros not listed under ZEROS are at the origin as in SAC
+    """
+    pz = {'network': '', 'station': '', 'location': '', 'channel': '', 'unit': 'M', 'zeros': [], 'poles': [], 'constant': 1.0}
+    header = {'NETWORK': 'network', 'STATION': 'station', 'LOCATION': 'location', 'CHANNEL': 'channel', 'INPUT UNIT': 'unit'}
+    section, count = None, 0
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith('*'):
+                if ':' in line:
+                    key, value = line[1:].split(':', 1)
+                    key = key.split('(')[0].strip().upper()
+                    if key in header:
+                        pz[header[key]] = value.strip()
+                continue
+            parts = line.split()
+            if not parts:
+                continue
+            keyword = parts[0].upper()
+            if keyword in ('ZEROS', 'POLES'):
+                section, count = keyword.lower(), int(parts[1])
+                pz[f'n_{section}'] = count
+            elif keyword == 'CONSTANT':
+                pz['constant'] = float(parts[1])
+                section = None
+            elif section is not None and len(parts) >= 2:
+                pz[section].append(complex(float(parts[0]), float(parts[1])))
+    pz['zeros'] += [0j] * (pz.get('n_zeros', len(pz['zeros'])) - len(pz['zeros']))
+    pz['poles'] += [0j] * (pz.get('n_poles', len(pz['poles'])) - len(pz['poles']))
+    # responses to velocity or acceleration become responses to displacement
+    unit = pz['unit'].split()[0].upper() if pz['unit'] else 'M'
+    pz['zeros'] += [0j] * {'M/S': 1, 'M/S**2': 2, 'M/S/S': 2}.get(unit, 0)
+    return pz
+
+def pz_table(pz_dir):
+    """
+    Parse every pole-zero file of pz_dir once.
+    :return: {(station, channel): pz}; the station and channel come from the
+        file header, or from a NET.STA.LOC.CHA or SAC_PZs_NET_STA_CHA file name
+    """
+    table = {}
+    for path in sorted(Path(pz_dir).iterdir()):
+        if not path.is_file():
+            continue
+        try:
+            pz = read_pz(path)
+        except (ValueError, IndexError, UnicodeDecodeError):
+            logging.info(f"skip unreadable pole-zero file {path.name}")
+            continue
+        if not (pz['station'] and pz['channel']):
+            parts = path.name.replace('SAC_PZs_', '').replace('_', '.').split('.')
+            parts = [p for p in parts if p]
+            if len(parts) < 3:
+                continue
+            pz['station'], pz['channel'] = parts[1], next((p for p in parts[2:] if len(p) == 3 and p.isalpha()), '')
+        table[(pz['station'], pz['channel'])] = pz
+    return table
+
+def paz_response(zeros, poles, gain, freqs):
+    s = 2j * np.pi * freqs
+    h = np.full(freqs.shape, gain, dtype=np.complex128)
+    for z in zeros:
+        h *= s - z
+    for p in poles:
+        h /= s - p
+    return h
+
+def pre_filter(freqs, corners):
+    """
+    Cosine taper of the spectrum, one between corners[0] and corners[1] and
+    zero outside corners[0]..corners[3], as obspy's pre_filt.
+    """
+    f1, f2, f3, f4 = corners
+    taper = np.zeros(freqs.shape)
+    taper[(freqs >= f2) & (freqs <= f3)] = 1.0
+    rise = (freqs > f1) & (freqs < f2)
+    taper[rise] = 0.5 * (1 - np.cos(np.pi * (freqs[rise] - f1) / (f2 - f1)))
+    fall = (freqs > f3) & (freqs < f4)
+    taper[fall] = 0.5 * (1 + np.cos(np.pi * (freqs[fall] - f3) / (f4 - f3)))
+    return taper
+
+def wood_anderson_filter(pz, sampling_rate, nfft, water_level=60.0):
+    """
+    Spectrum multiplier from counts to Wood-Anderson trace amplitude in mm:
+    the instrument response removed with a water level (dB below its
+    maximum) and a pre-filter, the Wood-Anderson response applied.
+    """
+    freqs = rfftfreq(nfft, 1.0 / sampling_rate)
+    instrument = paz_response(pz['zeros'], pz['poles'], pz['constant'], freqs)
+    level = np.abs(instrument).max() * 10.0 ** (-water_level / 20.0)
+    small = np.abs(instrument) < level
+    instrument[small] = level * np.exp(1j * np.angle(instrument[small]))
+    instrument[freqs == 0] = np.inf
+    nyquist = sampling_rate / 2
+    taper = pre_filter(freqs, (0.05, 0.1, 0.8 * nyquist, 0.9 * nyquist))
+    wood_anderson = paz_response(WOOD_ANDERSON['zeros'], WOOD_ANDERSON['poles'], WOOD_ANDERSON['gain'], freqs)
+    return taper * wood_anderson / instrument * 1000.0
+
+def init_magnitude(pz, settings):
+    # pole-zeros are parsed once in the parent, responses are evaluated once per worker
+    global shared_pz, shared_settings, responses
+    shared_pz = pz
+    shared_settings = settings
+    responses = {}
+
+def response_for(station, channel, sampling_rate, nfft):
+    key = (station, channel, sampling_rate, nfft)
+    if key not in responses:
+        pz = shared_pz.get((station, channel))
+        responses[key] = None if pz is None else wood_anderson_filter(pz, sampling_rate, nfft, shared_settings['water_level'])
+    return responses[key]
+
+def wood_anderson_peaks(windows, response, nfft):
+    """
+    Peak Wood-Anderson amplitude (mm) of every row of a window batch.
+    """
+    n = windows.shape[1]
+    taper = np.ones(n)
+    m = max(int(0.05 * n), 1)
+    taper[:m] = taper[-m:][::-1] = 0.5 * (1 - np.cos(np.pi * np.arange(m) / m))
+    spectrum = rfft(detrend(windows) * taper, n=nfft, axis=1)
+    return np.abs(irfft(spectrum * response, n=nfft, axis=1)[:, :n]).max(axis=1)
+
+def station_amplitudes(args):
+    """
+    Wood-Anderson amplitudes of all windows of one station-day: the station's
+    day traces are read once, windows are cut and filtered in batches.
+    :return: DataFrame with event_index, station, channel, amp_mm
+    """
+    station, day, data_dirs, merge_format, event_index, starts, log_file = args
+    logging.basicConfig(filename=log_file, level=logging.INFO, filemode='a')
+    traces = read_station(data_dirs, station, merge_format, components=HORIZONTAL)
+    window_len = shared_settings['window']
+    out = []
+    for channel, (starttime, sampling_rate, data) in sorted(traces.items()):
+        if channel[-1] not in HORIZONTAL:
+            continue
+        npts = int(round(window_len * sampling_rate))
+        nfft = next_fast_len(2 * npts)
+        response = response_for(station, channel, sampling_rate, nfft)
+        if response is None:
+            logging.info(f"{day} {station}.{channel}: no pole-zero file, skip")
+            continue
+        for b in range(0, len(starts), BATCH_WINDOWS):
+            windows, valid = cut_windows(data, starttime, sampling_rate, starts[b:b + BATCH_WINDOWS], npts)
+            if not valid.any():
+                continue
+            amp = wood_anderson_peaks(windows[valid], response, nfft)
+            out.append(pd.DataFrame({'event_index': event_index[b:b + BATCH_WINDOWS][valid], 'station': station,
+                                     'channel': channel, 'amp_mm': amp}))
+            add_items(int(valid.sum()))
+    logging.info(f"{day} {station}: {sum(len(df) for df in out)} amplitudes")
+    if not out:
+        return pd.DataFrame(columns=['event_index', 'station', 'channel', 'amp_mm'])
+    return pd.concat(out, ignore_index=True)
+
+def attenuation(dist_km, depth_km, formula='iaspei'):
+    """
+    -log10 A0 of the local magnitude, for amplitudes in mm on a Wood-Anderson
+    seismograph with magnification 2080.
+    :param dist_km: Hypocentral distance
+    :param formula: 'iaspei' (IASPEI 2013 standard, Hutton & Boore 1987), or
+        'shin1993' for the Central Weather Bureau relation of Taiwan
+    """
+    r = np.maximum(np.asarray(dist_km, dtype=np.float64), 1.0)
+    if formula == 'shin1993':
+        depth = np.asarray(depth_km, dtype=np.float64)
+        shallow_near = np.log10(r) + 0.00716 * r + 0.39
+        shallow_far = 0.83 * np.log10(r) + 0.00261 * r + 0.94
+        deep = 0.83 * np.log10(r) + 0.00326 * r + 1.01
+        return np.where(depth > 35, deep, np.where(r <= 80, shallow_near, shallow_far))
+    # the standard takes nm at unit magnification
+    return 1.11 * np.log10(r) + 0.00189 * r - 2.09 + 6.0 - np.log10(WOOD_ANDERSON['gain'])
+
+class Magnitude(Initializer):
+    """
+    Local magnitude of every associated event from the Wood-Anderson
+    amplitudes of its picked stations, written to Magnitude/.
+    """
+    def __init__(self, config):
+        super().__init__(config)
+        self.gamma_events = self.output_base_dir / 'GaMMA' / 'gamma_events.csv'
+        self.gamma_picks = self.output_base_dir / 'GaMMA' / 'gamma_picks.csv'
+        self.magnitude_dir = self.output_base_dir / 'Magnitude'
+        self.magnitude_dir.mkdir(parents=True, exist_ok=True)
+        self.magnitude_csv = self.magnitude_dir / 'magnitude.csv'
+        self.amplitude_csv = self.magnitude_dir / 'station_amplitudes.csv'
+        self.settings = {
+            'window': config.get('mag_window', 60),
+            'pre': config.get('mag_pre', 5),
+            'water_level': config.get('mag_water_level', 60.0),
+        }
+        self.ml_formula = config.get('ml_formula', 'iaspei')
+        self.mag_max_dist = config.get('mag_max_dist', 300)
+    def magnitude_windows(self):
+        """
+        One window per event and picked station, starting mag_pre seconds
+        before the first pick of the station, with its hypocentral distance.
+        """
+        events = pd.read_csv(self.gamma_events, usecols=['event_index', 'time', 'longitude', 'latitude', 'depth_km'])
+        picks = pd.read_csv(self.gamma_picks, usecols=['station_id', 'phase_time', 'event_index'])
+        picks = picks[picks['event_index'] >= 0]
+        picks['t'] = (pd.to_datetime(picks['phase_time']) - pd.Timestamp(0)) / pd.Timedelta(seconds=1)
+        windows = picks.groupby(['event_index', 'station_id'], as_index=False)['t'].min()
+        windows = windows.merge(events, on='event_index')
+        registry = self.load_stations()
+        rows = registry.indices(windows['station_id'])
+        windows = windows[rows >= 0].copy()
+        rows = rows[rows >= 0]
+        x, y = registry.project(windows['longitude'], windows['latitude'])
+        windows['dist_km'] = np.sqrt((x - registry.x[rows])**2 + (y - registry.y[rows])**2
+                                     + (windows['depth_km'].to_numpy() - registry.z[rows])**2)
+        windows = windows[windows['dist_km'] <= self.mag_max_dist]
+        windows['start'] = windows['t'] - self.settings['pre']
+        windows['day'] = pd.to_datetime(windows['start'], unit='s').dt.strftime('%Y%m%d')
+        return windows.rename(columns={'station_id': 'station'})
+    def run_magnitude(self, processes=None):
+        """
+        Wood-Anderson amplitudes with one task per station-day across the
+        process pool, then ML per component (horizontal), station (mean) and
+        event (median).
+        :return: Path of Magnitude/magnitude.csv
+        """
+        pz = pz_table(self.pz_path)
+        windows = self.magnitude_windows()
+        windows = windows[windows['day'].isin(self.date_list)]
+        log_file = self.output_base_dir / 'log' / 'magnitude.log'
+        tasks = []
+        for (day, station), group in windows.groupby(['day', 'station']):
+            data_dirs = data_final_dirs(self.output_base_dir, self.date_list, day, group['start'].max() + self.settings['window'])
+            args = (station, day, data_dirs, self.merge_format, group['event_index'].to_numpy(), group['start'].to_numpy(), log_file)
+            tasks.append(((day, station), args, len(group)))
+        results, timings, wall = run_tasks(station_amplitudes, tasks, processes or self.n_workers,
+                                           initializer=init_magnitude, initargs=(pz, self.settings))
+        write_timings(timings, wall, self.magnitude_dir / 'magnitude_timings.csv', 'magnitude')
+        amps = [results[key] for key in sorted(results) if len(results[key])]
+        columns = ['event_index', 'station', 'channel', 'amp_mm', 'dist_km', 'ml']
+        amps = pd.concat(amps, ignore_index=True) if amps else pd.DataFrame(columns=columns[:4])
+        amps = amps.merge(windows[['event_index', 'station', 'dist_km', 'depth_km']], on=['event_index', 'station'])
+        amps = amps[amps['amp_mm'] > 0]
+        amps['ml'] = np.log10(amps['amp_mm'].to_numpy(dtype=np.float64)) + attenuation(amps['dist_km'], amps['depth_km'], self.ml_formula)
+        amps[columns].to_csv(self.amplitude_csv, index=False, float_format='%.4g')
+
+        station_ml = amps.groupby(['event_index', 'station'])['ml'].mean()
+        event_ml = station_ml.groupby('event_index').agg(ml='median', ml_std='std', n_stations='count').reset_index()
+        events = pd.read_csv(self.gamma_events, usecols=['event_index', 'time', 'longitude', 'latitude', 'depth_km'])
+        events = events.merge(event_ml, on='event_index', how='left')
+        events['n_stations'] = events['n_stations'].fillna(0).astype(int)
+        events.to_csv(self.magnitude_csv, index=False, float_format='%.3f')
+        print(f"magnitude: {event_ml['ml'].notna().sum()} of {len(events)} events, {len(amps)} amplitudes from {len(tasks)} station-days")
+        return self.magnitude_csv
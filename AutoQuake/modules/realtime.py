@@ -0,0 +1,294 @@
+import os
+import json
+import time
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from obspy import read, UTCDateTime
+from obspy.core.stream import Stream
+from core.waveform_index import scan_day_dir, select_channels, link_file
+from core.merge_engine import plan_day, merge_group
+from core.manifest import fingerprint
+from core.pick_store import empty_picks, picks_frame
+from modules.aso_gamma import Aso_gamma, store_pick_table, h3dd_event_line, h3dd_pick_line
+from modules.eikonal_cache import load_eikonal, gamma_utils
+from modules.gamma_partition import to_seconds
+
+def epoch(utc):
+    return UTCDateTime(utc).timestamp
+
+class RealtimeWatcher(Aso_gamma):
+    """
+    Near-real-time mode: poll waveform_dir for new or grown files and run
+    channel selection, merge, picking and association on the new time span
+    only. Picks wait in a sliding buffer until their events are complete;
+    complete events are appended to GaMMA/gamma_events.csv,
+    GaMMA/gamma_picks.csv and GaMMA/for_h3dd/gamma_events_realtime.dat_ch.
+
+    New files are copied into data_single (never linked: feeds may rewrite
+    their files) and the changed station-days are merged into data_final
+    with merge_group every watch_merge_interval seconds and when watching
+    stops, so that the batch stages reuse what was ingested. Picking reads
+    the new span from the raw files directly and does not wait for that
+    merge. With merge_format 'hdf5' data_final is still written as SAC and
+    the batch merge rebuilds the archive.
+
+    The horizon is the data time up to which picking is done. Every cycle
+    picks [horizon, end - overlap) where end is the latest data end minus
+    watch_max_lag, and an event is complete once the horizon has passed its
+    origin time by max_travel_time.
+    :param picker: Object with classify(stream, batch_size), the PhaseNet picker of load_picker when None
+    """
+    def __init__(self, config, picker=None):
+        super().__init__(config, picks=[])
+        self.realtime_dir = self.output_base_dir / 'realtime'
+        self.realtime_dir.mkdir(parents=True, exist_ok=True)
+        self.interval = config.get('watch_interval', 30)
+        self.max_lag = config.get('watch_max_lag', 60)
+        self.overlap = config.get('pick_overlap', 60)
+        self.buffer_len = config.get('pick_buffer', 600)
+        self.max_travel = config.get('max_travel_time', 60)
+        self.merge_interval = config.get('watch_merge_interval', 300)
+        self.pending = defaultdict(set)
+        self.last_merge = time.time()
+        self.station_list = self.load_stations().stations
+        self.picker = picker
+        self.seen = {}
+        self.spans = {}
+        self.arrivals = defaultdict(list)
+        self.buffer = empty_picks()
+        self.horizon = None
+        self.next_event = 0
+        self.gamma = None
+        self.state_file = self.realtime_dir / 'state.json'
+        if self.state_file.is_file():
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            self.horizon, self.next_event = state['horizon'], state['next_event']
+        elif self.gamma_events.is_file():
+            self.next_event = int(pd.read_csv(self.gamma_events, usecols=['event_index'])['event_index'].max()) + 1
+    def save_state(self):
+        tmp = self.state_file.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'horizon': self.horizon, 'next_event': self.next_event}, f)
+        os.replace(tmp, self.state_file)
+    def poll(self):
+        """
+        List the day directories once and pick the channels of every day.
+        :return: selected files (select_channels layout) that are new or grew since the last poll
+        """
+        first_day = self.date_list[0]
+        changed = []
+        with os.scandir(self.data_path) as entries:
+            days = sorted(entry.name for entry in entries if entry.is_dir() and entry.name.isdigit() and entry.name >= first_day)
+        for day in days:
+            index = scan_day_dir(os.path.join(self.data_path, day))
+            chosen = select_channels(index, self.station_list, self.channel_priority)
+            chosen = chosen.assign(day=day)
+            grew = [self.seen.get(path) != size for path, size in zip(chosen['path'], chosen['size'])]
+            changed.append(chosen[grew])
+            self.seen.update(zip(chosen['path'], chosen['size']))
+        return pd.concat(changed, ignore_index=True) if changed else pd.DataFrame()
+    def register(self, files):
+        """
+        Copy changed files into data_single and note which data span arrived when.
+        """
+        for row in files.itertuples(index=False):
+            process_dir_path = self.output_base_dir / 'data' / row.day / 'data_single'
+            process_dir_path.mkdir(parents=True, exist_ok=True)
+            try:
+                st = read(row.path, headonly=True)
+                mtime = os.stat(row.path).st_mtime
+                link_file(row.path, process_dir_path, 'copy')
+            except FileNotFoundError:
+                # renamed or removed by its writer after the scan
+                self.seen.pop(row.path, None)
+                continue
+            self.pending[row.day].add(row.station)
+            start = min(epoch(tr.stats.starttime) for tr in st)
+            end = max(epoch(tr.stats.endtime) for tr in st)
+            # a grown file only brings the data after its previous end
+            new_start = self.spans[row.path][1] if row.path in self.spans else start
+            self.spans[row.path] = (start, end, row.station)
+            self.arrivals[row.station].append((new_start, end, mtime))
+    def merge_pending(self):
+        """
+        Merge the station-days that got new files into data_final, as the
+        merge stage would, and record the merge of those days in the manifest.
+        """
+        for day, stations in sorted(self.pending.items()):
+            ori_data_dir = self.output_base_dir / 'data' / day / 'data_single'
+            output_data_dir = self.output_base_dir / 'data' / day / 'data_final'
+            output_data_dir.mkdir(parents=True, exist_ok=True)
+            for groups in plan_day(ori_data_dir, sorted(stations)).values():
+                for group, paths, _ in groups:
+                    merge_group(group, paths, output_data_dir, self.link_mode)
+            if self.merge_format == 'sac':
+                digest = fingerprint(files=[self.station_path], dirs=[ori_data_dir], params=[self.merge_format])
+                self.manifest.record(f'merge/{day}', digest, [output_data_dir])
+        if self.pending:
+            print(f"realtime: merged {sum(len(s) for s in self.pending.values())} station-days into data_final")
+        self.pending.clear()
+        self.last_merge = time.time()
+    def read_span(self, t0, t1):
+        stream = Stream()
+        for path, (start, end, _) in self.spans.items():
+            if end >= t0 and start <= t1:
+                stream += read(path, starttime=UTCDateTime(t0), endtime=UTCDateTime(t1))
+        try:
+            stream.merge(fill_value='interpolate')
+        except Exception as e:
+            print(f"realtime: {e} while merging {t0} - {t1}")
+        if getattr(self.picker, 'sampling_rate', None):
+            from seisbench.models import WaveformModel
+            WaveformModel.resample(stream, self.picker.sampling_rate)
+        return stream
+    def arrival(self, station, t):
+        """
+        Wall time at which the data of station at data time t first arrived.
+        """
+        times = [arrived for start, end, arrived in self.arrivals[station] if start <= t <= end]
+        return min(times) if times else np.nan
+    def init_gamma(self):
+        self.picks = empty_picks()
+        _, stations, config, proj = self.gamma_inputs()
+        config["eikonal"] = load_eikonal(config["eikonal"], self.eikonal_cache_dir, self.eikonal_cache_size)
+        # the buffer is small, a process pool inside gamma costs more than it saves
+        config["ncpu"] = 1
+        self.gamma = (stations, config, proj)
+    def associate(self):
+        """
+        Associate the pick buffer and return the complete events with their picks.
+        """
+        if self.gamma is None:
+            self.init_gamma()
+        stations, config, proj = self.gamma
+        pick_df = store_pick_table(self.buffer)
+        if len(pick_df) < config["min_picks_per_eq"]:
+            return pd.DataFrame(), pd.DataFrame()
+        events, assignments = gamma_utils().association(pick_df, stations, config, 0, config["method"])
+        events = pd.DataFrame(events)
+        if events.empty:
+            return events, pd.DataFrame()
+        origin = to_seconds(events["time"])
+        events = events[origin + self.max_travel <= self.horizon].copy()
+        if events.empty:
+            return events, pd.DataFrame()
+        events = events.iloc[np.argsort(to_seconds(events["time"]), kind='stable')]
+        new_index = {old: self.next_event + i for i, old in enumerate(events["event_index"])}
+        self.next_event += len(events)
+        events["event_index"] = events["event_index"].map(new_index)
+        events["longitude"], events["latitude"] = proj(longitude=events["x(km)"].to_numpy(), latitude=events["y(km)"].to_numpy(), inverse=True)
+        events["depth_km"] = events["z(km)"]
+        assignments = pd.DataFrame(assignments, columns=["pick_index", "event_index", "gamma_score"])
+        assignments = assignments[assignments["event_index"].isin(new_index)]
+        assignments["event_index"] = assignments["event_index"].map(new_index)
+        picks = pick_df.loc[assignments["pick_index"]].assign(event_index=assignments["event_index"].to_numpy(),
+                                                               gamma_score=assignments["gamma_score"].to_numpy())
+        return events, picks
+    def append_outputs(self, events, picks):
+        """
+        Append complete events to gamma_events.csv, gamma_picks.csv and the h3dd input.
+        """
+        if self.gamma_events.is_file():
+            events = events.reindex(columns=pd.read_csv(self.gamma_events, nrows=0).columns)
+        events.to_csv(self.gamma_events, mode='a', header=not self.gamma_events.is_file(), index=False,
+                      float_format="%.3f", date_format='%Y-%m-%dT%H:%M:%S.%f')
+        out = picks.rename(columns={"id": "station_id", "timestamp": "phase_time", "type": "phase_type", "prob": "phase_score"})
+        out.to_csv(self.gamma_picks, mode='a', header=not self.gamma_picks.is_file(), index=False,
+                   date_format='%Y-%m-%dT%H:%M:%S.%f')
+        lines = []
+        for event in events.itertuples(index=False):
+            utc_time = pd.Timestamp(event.time)
+            lines.append(h3dd_event_line(utc_time, float(event.longitude), float(event.latitude), float(event.depth_km)))
+            for pick in picks[picks["event_index"] == event.event_index].itertuples(index=False):
+                wss = round(pick.timestamp.second + pick.timestamp.microsecond / 1000000, 2)
+                lines.append(h3dd_pick_line(pick.id, pick.type, pick.timestamp.minute, wss, utc_time.minute))
+        with open(self.for_h3dd / 'gamma_events_realtime.dat_ch', 'a') as f:
+            f.write(''.join(lines))
+    def record_latency(self, events, picks, emitted):
+        rows = []
+        for event in events.itertuples(index=False):
+            event_picks = picks[picks["event_index"] == event.event_index]
+            t = to_seconds(event_picks["timestamp"])
+            arrived = np.nanmax([self.arrival(sta, ti) for sta, ti in zip(event_picks["id"], t)])
+            rows.append({'event_index': event.event_index, 'time': event.time, 'last_pick': UTCDateTime(t.max()).isoformat(),
+                         'arrived': arrived, 'emitted': emitted, 'latency_s': emitted - arrived})
+        latency_csv = self.realtime_dir / 'latency.csv'
+        rows = pd.DataFrame(rows)
+        rows.to_csv(latency_csv, mode='a', header=not latency_csv.is_file(), index=False)
+        return rows
+    def cycle(self):
+        """
+        One poll: pick the new span, associate the buffer and append the complete events.
+        :return: latency records of the events appended in this cycle
+        """
+        files = self.poll()
+        if files.empty:
+            return pd.DataFrame()
+        self.register(files)
+        end = max(end for _, end, _ in self.spans.values()) - self.max_lag
+        if self.horizon is None:
+            self.horizon = min(start for start, _, _ in self.spans.values())
+        keep_end = end - self.overlap
+        if keep_end <= self.horizon:
+            return pd.DataFrame()
+        if self.picker is None:
+            self.picker = self.load_picker()
+        stream = self.read_span(self.horizon - self.overlap, end)
+        picks = picks_frame(self.picker.classify(stream, batch_size=self.pick_batch_size).picks) if len(stream) else empty_picks()
+        t = to_seconds(picks["peak_time"])
+        picks = picks[(t >= self.horizon) & (t < keep_end)]
+        self.buffer = pd.concat([self.buffer, picks], ignore_index=True)
+        self.horizon = keep_end
+        events, event_picks = self.associate()
+        latency = pd.DataFrame()
+        if not events.empty:
+            self.append_outputs(events, event_picks)
+            latency = self.record_latency(events, event_picks, time.time())
+            # the picks of complete events leave the buffer
+            self.buffer = self.buffer.drop(index=event_picks.index).reset_index(drop=True)
+        t = to_seconds(self.buffer["peak_time"])
+        self.buffer = self.buffer[t >= self.horizon - self.buffer_len].reset_index(drop=True)
+        self.prune()
+        self.save_state()
+        if time.time() - self.last_merge >= self.merge_interval:
+            self.merge_pending()
+        print(f"realtime: horizon {UTCDateTime(self.horizon)}, {len(picks)} new picks, {len(self.buffer)} buffered, "
+              f"{len(events)} events" + (f", latency {latency['latency_s'].median():.1f} s" if len(latency) else ''))
+        return latency
+    def prune(self):
+        # files and arrivals that end before anything still to be read or buffered
+        self.spans = {path: span for path, span in self.spans.items() if span[1] >= self.horizon - self.overlap}
+        for station, segments in self.arrivals.items():
+            self.arrivals[station] = [s for s in segments if s[1] >= self.horizon - self.buffer_len]
+    def start(self):
+        """
+        Mark the files already in waveform_dir as seen; without a saved state
+        the horizon starts at the end of that data, so only new data is picked.
+        The picker and the travel time tables are loaded here, not on the first event.
+        """
+        if self.picker is None:
+            self.picker = self.load_picker()
+        if self.gamma is None:
+            self.init_gamma()
+        self.register(self.poll())
+        if self.horizon is None and self.spans:
+            self.horizon = max(end for _, end, _ in self.spans.values()) - self.max_lag - self.overlap
+        if self.horizon is not None:
+            self.prune()
+    def watch(self, cycles=None):
+        """
+        Run a cycle every watch_interval seconds, forever or for the given
+        number of cycles, and merge what is pending when it stops.
+        """
+        self.start()
+        n = 0
+        try:
+            while cycles is None or n < cycles:
+                t0 = time.time()
+                self.cycle()
+                n += 1
+                time.sleep(max(0.0, self.interval - (time.time() - t0)))
+        finally:
+            self.merge_pending()
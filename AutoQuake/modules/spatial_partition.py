@@ -0,0 +1,87 @@
+from itertools import chain
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+def bisect_partitions(xyz, max_size):
+    """
+    Split the hypocenters by recursive median bisection along the widest
+    axis (a KD-tree build) until every partition holds at most max_size events.
+    :return: list of index arrays, partitions of equal size within a factor of two
+    """
+    parts = []
+    stack = [np.arange(len(xyz))]
+    while stack:
+        idx = stack.pop()
+        if len(idx) <= max_size:
+            parts.append(idx)
+            continue
+        pts = xyz[idx]
+        axis = np.argmax(np.ptp(pts, axis=0))
+        order = np.argsort(pts[:, axis], kind='stable')
+        half = len(idx) // 2
+        stack.append(idx[order[half:]])
+        stack.append(idx[order[:half]])
+    return parts
+
+def add_halo(xyz, parts, halo, max_halo):
+    """
+    Add to each partition the events lying within `halo` km of one of its
+    core events, so double-difference pairs across a cut stay together.
+    Only the max_halo closest of them are kept to bound the partition size.
+    :return: list of (members, is_core) arrays
+    """
+    tree = cKDTree(xyz)
+    out = []
+    for core in parts:
+        near = tree.query_ball_point(xyz[core], r=halo)
+        near = np.unique(np.fromiter(chain.from_iterable(near), dtype=np.int64))
+        outside = near[~np.isin(near, core)]
+        if len(outside) > max_halo:
+            dist, _ = cKDTree(xyz[core]).query(xyz[outside])
+            outside = outside[np.argsort(dist, kind='stable')[:max_halo]]
+        members = np.concatenate([core, outside])
+        is_core = np.zeros(len(members), dtype=bool)
+        is_core[:len(core)] = True
+        out.append((members, is_core))
+    return out
+
+def gamma_spatial_split(split_dir, events_csv, cut_off_dist, max_size=4000, halo=None, max_halo=None, members_csv=None):
+    """
+    Partition gamma_events.csv by hypocenter instead of by time.
+    Chunks are written as split_dir/gamma_events_<i>.csv, time sorted, in the
+    same layout as gamma_sort_split.
+    :param cut_off_dist: Cut off distance for the D-D method (km), the default halo width
+    :param max_size: Largest number of core events in a partition
+    :param halo: Halo width in km, 0 disables the overlap
+    :param max_halo: Largest number of halo events in a partition, defaults to max_size // 4
+    :param members_csv: Optional table of partition, event_index, core flag and
+        origin time in catalog order, read by H3dd.collect_h3dd_outputs to drop
+        the halo copies after relocation
+    :return: Number of partitions
+    """
+    split_dir.mkdir(parents=True, exist_ok=True)
+    for old in split_dir.glob('gamma_events_*.csv'):
+        old.unlink()
+    events = pd.read_csv(events_csv)
+    xyz = events[['x(km)', 'y(km)', 'z(km)']].to_numpy(dtype=np.float64)
+    halo = cut_off_dist if halo is None else halo
+    parts = bisect_partitions(xyz, max_size)
+    if halo > 0:
+        parts = add_halo(xyz, parts, halo, max_size // 4 if max_halo is None else max_halo)
+    else:
+        parts = [(core, np.ones(len(core), dtype=bool)) for core in parts]
+
+    time = pd.to_datetime(events['time']).to_numpy()
+    members_table = []
+    for i, (members, is_core) in enumerate(parts):
+        order = np.argsort(time[members], kind='stable')
+        members, is_core = members[order], is_core[order]
+        events.iloc[members].to_csv(split_dir / f'gamma_events_{i}.csv', index=False)
+        members_table.append(pd.DataFrame({'partition': i, 'event_index': events['event_index'].to_numpy()[members], 'core': is_core,
+                                           'time': events['time'].to_numpy()[members]}))
+    sizes = [len(members) for members, _ in parts]
+    print(f"{len(events)} events in {len(parts)} partitions, {min(sizes)}-{max(sizes)} events each with a {halo} km halo")
+    if members_csv is not None:
+        pd.concat(members_table).to_csv(members_csv, index=False)
+    return len(parts)
@@ -0,0 +1,266 @@
+import argparse
+import json
+from types import SimpleNamespace
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from obspy import Trace, UTCDateTime
+from core.pick_store import PickWriter, store_path
+from core.station_registry import DEFAULT_CENTER, station_proj
+
+# instrument codes of the synthetic stations and their sampling rates
+INSTRUMENTS = {'HH': 100.0, 'BH': 20.0, 'EH': 100.0, 'HN': 100.0}
+VP, VS = 6.0, 6.0 / 1.75
+STUB_H3DD = """#!/bin/sh
+# stand-in for h3dd: reads h3dd.inp from stdin and writes the input catalog
+# back as <catalog>.hout, the name h3dd gives its relocated catalog
+read header
+read catalog
+cp "$catalog" "$catalog.hout"
+echo "relocated $catalog"
+"""
+
+class SyntheticPick:
+    __slots__ = ('trace_id', 'peak_time', 'peak_value', 'phase', 'start_time', 'end_time')
+    def __init__(self, trace_id, peak_time, peak_value, phase, start_time=None, end_time=None):
+        self.trace_id = trace_id
+        self.peak_time = peak_time
+        self.peak_value = peak_value
+        self.phase = phase
+        self.start_time = start_time
+        self.end_time = end_time
+
+class ArrivalPicker:
+    """
+    Stand-in for PhaseNet that picks the known arrivals of the synthetic
+    events on the traces it is given.
+    """
+    sampling_rate = None
+    def __init__(self, arrivals):
+        self.arrivals = arrivals
+    def classify(self, stream, batch_size=None):
+        picks = []
+        for tr in stream.select(component='Z'):
+            trace_id = f"{tr.stats.network}.{tr.stats.station}.{tr.stats.location}"
+            for t, phase in self.arrivals.get(tr.stats.station, ()):
+                if tr.stats.starttime <= t <= tr.stats.endtime:
+                    picks.append(SyntheticPick(trace_id, UTCDateTime(t), 0.9, phase, UTCDateTime(t - 0.2), UTCDateTime(t + 0.2)))
+        return SimpleNamespace(picks=picks)
+
+def write_stations(path, n, rng, center=DEFAULT_CENTER, spread=0.4):
+    """
+    Station CSV (net, station, lon, lat, elevation_m) of n stations spread
+    uniformly within `spread` degrees of center.
+    """
+    stations = pd.DataFrame({'net': 'TW', 'station': [f'S{i:03d}' for i in range(n)],
+                             'lon': np.round(rng.uniform(center[0] - spread, center[0] + spread, n), 4),
+                             'lat': np.round(rng.uniform(center[1] - spread, center[1] + spread, n), 4),
+                             'elevation_m': np.round(rng.uniform(0, 1500, n), 1)})
+    stations.to_csv(path, index=False)
+    return stations
+
+def write_velocity_model(path):
+    """
+    Constant-ratio 1D model in the zz,vp,vs layout of 1D_velocity_model.
+    """
+    depth = np.arange(0, 70, 5)
+    vp = np.round(5.0 + depth * 0.03, 2)
+    pd.DataFrame({'zz': depth, 'vp': vp, 'vs': np.round(vp / 1.75, 2)}).to_csv(path, index=False, header=False)
+
+def station_instruments(stations, rng):
+    """
+    Instrument codes of every station: one of HH/BH/EH, a second one of them
+    on a third of the stations and a strong-motion HN on half of them, so
+    that the channel priority has to choose.
+    """
+    codes = ['HH', 'BH', 'EH']
+    instruments = {}
+    for sta in stations['station']:
+        chosen = list(rng.choice(codes, size=1 + (rng.random() < 0.3), replace=False))
+        if rng.random() < 0.5:
+            chosen.append('HN')
+        instruments[sta] = chosen
+    return instruments
+
+def segment_spans(seconds, segments, rng):
+    """
+    Split [0, seconds) into segments pieces of about equal length, each
+    boundary either contiguous, a gap of 1-5 s or an overlap of 1 s (both
+    at most a tenth of a piece).
+    :return: list of (start, end) in seconds
+    """
+    length = seconds / segments
+    cuts = (np.arange(1, segments) + rng.uniform(-0.3, 0.3, segments - 1)) * length
+    spans, start = [], 0.0
+    for cut in cuts:
+        kind = rng.integers(3)
+        spans.append((start, cut))
+        start = cut + (0.0 if kind == 0 else min(rng.uniform(1, 5), 0.1 * length) if kind == 1 else -min(1.0, 0.1 * length))
+    spans.append((start, float(seconds)))
+    return spans
+
+def write_day_files(day_dir, day, stations, instruments, seconds, segments, rng):
+    """
+    Raw SAC files of one day, every channel written as `segments` files
+    named <net>.<sta>.00.<cha>.D.<year>.<jday>.<k> holding noise.
+    :param seconds: Length of the data from the start of the day
+    :return: Number of files, bytes written
+    """
+    day_dir.mkdir(parents=True, exist_ok=True)
+    t0 = UTCDateTime(day)
+    n_files, n_bytes = 0, 0
+    for sta in stations['station']:
+        for equip in instruments[sta]:
+            sampling_rate = INSTRUMENTS[equip]
+            for comp in 'ZNE':
+                for k, (start, end) in enumerate(segment_spans(seconds, segments, rng)):
+                    npts = int(round((end - start) * sampling_rate))
+                    tr = Trace(rng.standard_normal(npts).astype(np.float32),
+                               header={'network': 'TW', 'station': sta, 'location': '00', 'channel': f'{equip}{comp}',
+                                       'sampling_rate': sampling_rate, 'starttime': t0 + round(start * sampling_rate) / sampling_rate})
+                    path = day_dir / f'{tr.id}.D.{t0.year}.{t0.julday:03d}.{k:02d}'
+                    tr.write(str(path), format='SAC')
+                    n_files += 1
+                    n_bytes += path.stat().st_size
+    return n_files, n_bytes
+
+def synthetic_events(n, days, seconds, rng, center=DEFAULT_CENTER, spread=0.3):
+    """
+    n events with uniform origin times in the first `seconds` of the days,
+    epicentres within `spread` degrees of center and depths of 2-30 km.
+    :return: DataFrame with origin (seconds since epoch), longitude, latitude, depth_km
+    """
+    starts = np.array([UTCDateTime(day).timestamp for day in days])
+    origin = np.sort(starts[rng.integers(len(days), size=n)] + rng.uniform(0, seconds, n))
+    return pd.DataFrame({'origin': origin,
+                         'longitude': rng.uniform(center[0] - spread, center[0] + spread, n),
+                         'latitude': rng.uniform(center[1] - spread, center[1] + spread, n),
+                         'depth_km': rng.uniform(2, 30, n)})
+
+def synthetic_picks(events, stations, rng, max_dist=80.0, noise=0.05, false_rate=0.1, center=DEFAULT_CENTER):
+    """
+    P and S picks of every event on the stations within max_dist km, with
+    straight-ray travel times, normal pick errors of `noise` seconds and
+    false_rate unassociated picks at random times.
+    :return: DataFrame with station, phase, peak time (seconds since epoch),
+        prob and the index of the event (-1 for false picks)
+    """
+    proj = station_proj(center)
+    sx, sy = proj(longitude=stations['lon'].to_numpy(), latitude=stations['lat'].to_numpy())
+    ex, ey = proj(longitude=events['longitude'].to_numpy(), latitude=events['latitude'].to_numpy())
+    epi = np.hypot(ex[:, None] - sx[None, :], ey[:, None] - sy[None, :])
+    event, sta = np.nonzero(epi <= max_dist)
+    dist = np.hypot(epi[event, sta], events['depth_km'].to_numpy()[event])
+    origin = events['origin'].to_numpy()[event]
+    n = len(event)
+    picks = pd.DataFrame({
+        'station': np.tile(stations['station'].to_numpy()[sta], 2),
+        'phase': np.repeat(['P', 'S'], n),
+        'time': np.concatenate([origin + dist / VP, origin + dist / VS]) + rng.normal(0, noise, 2 * n),
+        'prob': rng.uniform(0.3, 1.0, 2 * n),
+        'event_index': np.tile(event, 2),
+    })
+    n_false = int(len(picks) * false_rate)
+    false = pd.DataFrame({'station': rng.choice(stations['station'].to_numpy(), n_false),
+                          'phase': rng.choice(['P', 'S'], n_false),
+                          'time': rng.uniform(origin.min() if n else 0, origin.max() + 60 if n else 60, n_false),
+                          'prob': rng.uniform(0.3, 0.6, n_false), 'event_index': -1})
+    return pd.concat([picks, false], ignore_index=True).sort_values('time', kind='stable').reset_index(drop=True)
+
+def write_pick_store(store_dir, picks):
+    """
+    Write the picks into the day files of a pick store, see core.pick_store.
+    """
+    store_dir.mkdir(parents=True, exist_ok=True)
+    day = pd.to_datetime(picks['time'], unit='s').dt.strftime('%Y%m%d')
+    for d, group in picks.groupby(day):
+        with PickWriter(store_path(store_dir, d)) as writer:
+            writer.append([SyntheticPick(f'TW.{sta}.00.HH', UTCDateTime(t), prob, phase, UTCDateTime(t - 0.1), UTCDateTime(t + 0.1))
+                           for sta, t, prob, phase in zip(group['station'], group['time'], group['prob'], group['phase'])])
+
+def write_gamma_csvs(gamma_dir, events, picks, center=DEFAULT_CENTER):
+    """
+    gamma_events.csv and gamma_picks.csv in the layout run_gamma_association
+    writes, with the events and picks taken as associated as they are.
+    """
+    gamma_dir.mkdir(parents=True, exist_ok=True)
+    proj = station_proj(center)
+    x, y = proj(longitude=events['longitude'].to_numpy(), latitude=events['latitude'].to_numpy())
+    counts = picks[picks['event_index'] >= 0].groupby(['event_index', 'phase']).size().unstack(fill_value=0)
+    counts = counts.reindex(index=np.arange(len(events)), columns=['P', 'S'], fill_value=0)
+    time_format = '%Y-%m-%dT%H:%M:%S.%f'
+    pd.DataFrame({
+        'time': pd.to_datetime(events['origin'], unit='s').dt.strftime(time_format),
+        'magnitude': 999.0, 'sigma_time': 0.1, 'sigma_amp': 0.0, 'cov_time_amp': 0.0, 'gamma_score': 10.0,
+        'number_picks': (counts['P'] + counts['S']).to_numpy(), 'number_p_picks': counts['P'].to_numpy(),
+        'number_s_picks': counts['S'].to_numpy(), 'event_index': np.arange(len(events)),
+        'x(km)': x, 'y(km)': y, 'z(km)': events['depth_km'].to_numpy(), 'longitude': events['longitude'].to_numpy(),
+        'latitude': events['latitude'].to_numpy(), 'depth_km': events['depth_km'].to_numpy(),
+    }).to_csv(gamma_dir / 'gamma_events.csv', index=False, float_format='%.3f')
+    pd.DataFrame({
+        'station_id': picks['station'].to_numpy(),
+        'phase_time': pd.to_datetime(picks['time'], unit='s').dt.strftime(time_format).to_numpy(),
+        'phase_score': picks['prob'].round(3).to_numpy(), 'phase_type': picks['phase'].str.lower().to_numpy(),
+        'event_index': picks['event_index'].to_numpy(),
+        'gamma_score': np.where(picks['event_index'] >= 0, 1.0, -1.0),
+    }).to_csv(gamma_dir / 'gamma_picks.csv', index=False)
+
+def write_stub_h3dd(path):
+    path = Path(path)
+    path.write_text(STUB_H3DD)
+    path.chmod(0o755)
+    return path
+
+def write_dataset(root, n_stations=50, n_events=500, days=1, seconds=600, segments=3, seed=42):
+    """
+    Synthetic inputs of a whole pipeline run under root: stations.csv,
+    vel_1d.csv, raw/<day>/ SAC files, the picks and the GaMMA CSVs of the
+    events in truth/, a stub h3dd and config.json pointing at all of them.
+    :return: config, summary of the generated data
+    """
+    root = Path(root).resolve()
+    root.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    first = UTCDateTime(2024, 4, 2)
+    day_list = [(first + 86400 * d).strftime('%Y%m%d') for d in range(days)]
+    stations = write_stations(root / 'stations.csv', n_stations, rng)
+    write_velocity_model(root / 'vel_1d.csv')
+    instruments = station_instruments(stations, rng)
+    n_files, n_bytes = 0, 0
+    for day in day_list:
+        files, size = write_day_files(root / 'raw' / day, day, stations, instruments, seconds, segments, rng)
+        n_files += files
+        n_bytes += size
+    events = synthetic_events(n_events, day_list, seconds, rng)
+    picks = synthetic_picks(events, stations, rng)
+    write_pick_store(root / 'truth' / 'picks', picks)
+    write_gamma_csvs(root / 'truth' / 'GaMMA', events, picks)
+    write_stub_h3dd(root / 'h3dd_stub.sh')
+    config = {"station_path": str(root / 'stations.csv'), "name_of_eq_sequence": "synthetic",
+              "analyze_range": f"{day_list[0]}-{day_list[-1]}", "waveform_dir": str(root / 'raw'),
+              "1D_velocity_model": str(root / 'vel_1d.csv'), "3D_velocity_model": str(root / 'vel_3d'),
+              "association_method": "gamma", "h3dd_executable": str(root / 'h3dd_stub.sh'),
+              "eikonal_cache_dir": str(root / 'eikonal_cache'), "station_cache_dir": str(root / 'station_cache')}
+    with open(root / 'config.json', 'w') as f:
+        json.dump(config, f, indent=4)
+    summary = {"stations": n_stations, "channels": sum(3 * len(v) for v in instruments.values()), "days": days,
+               "seconds": seconds, "segments": segments, "sac_files": n_files, "sac_MB": n_bytes / 1e6,
+               "events": n_events, "picks": len(picks), "associated_picks": int((picks['event_index'] >= 0).sum())}
+    return config, summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic AutoQuake dataset and its config.json")
+    parser.add_argument('root', type=Path, help='Directory to write into')
+    parser.add_argument('--n-stations', type=int, default=50, help='Number of stations')
+    parser.add_argument('--n-events', type=int, default=500, help='Number of events')
+    parser.add_argument('--days', type=int, default=1, help='Number of days from 20240402')
+    parser.add_argument('--seconds', type=float, default=600, help='Seconds of waveforms from the start of every day')
+    parser.add_argument('--segments', type=int, default=3, help='Files every channel of a day is split into')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    args = parser.parse_args()
+    _, summary = write_dataset(args.root, args.n_stations, args.n_events, args.days, args.seconds, args.segments, args.seed)
+    print(json.dumps(summary, indent=2))
+    print(f"config: {args.root / 'config.json'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# modules import each other as core.* / modules.*, as when run from AutoQuake/
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
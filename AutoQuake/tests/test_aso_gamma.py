@@ -0,0 +1,147 @@
+import csv
+import random
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from obspy import UTCDateTime
+from core.pick_store import PickWriter, read_picks, store_path
+from modules.aso_gamma import (gamma_sort_split, load_picks_by_event, init_transform, transform, extract_substring,
+                               picks_to_arrays, pick_table, store_pick_table)
+from synthetic import SyntheticPick, write_stations, synthetic_events, synthetic_picks, write_gamma_csvs
+
+def baseline_sort_split(split_dir, events_csv, chunksize=4000):
+    """
+    gamma_reorder followed by gamma_chunk_split, as the catalog was split before gamma_sort_split.
+    """
+    with open(events_csv, 'r') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        data = list(reader)
+    data.sort(key=lambda row: datetime.strptime(row[0], '%Y-%m-%dT%H:%M:%S.%f'))
+    reorder_csv = split_dir.parent / 'gamma_events_order.csv'
+    with open(reorder_csv, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(data)
+    split_dir.mkdir(parents=True, exist_ok=True)
+    for i, chunk in enumerate(pd.read_csv(reorder_csv, chunksize=chunksize)):
+        chunk.to_csv(split_dir / f'gamma_events_{i}.csv', index=False)
+
+def baseline_transform(index, gamma_picks, split_dir, output_dir):
+    """
+    transform as it was before the picks were loaded once, with the phase
+    compared case-insensitively as h3dd_pick_line now does.
+    """
+    with open(split_dir / f'gamma_events_{index}.csv', 'r') as f:
+        for line in f.readlines():
+            if line[0] != 't':
+                item = line.split(',')
+                utc_time = datetime.strptime(item[0], '%Y-%m-%dT%H:%M:%S.%f')
+                ymd = utc_time.strftime('%Y%m%d')
+                hh = utc_time.hour
+                mm = utc_time.minute
+                ss = round(utc_time.second + utc_time.microsecond / 1000000, 2)
+                lon_int = int(float(item[-3]))
+                lon_deg = (float(item[-3]) - lon_int)*60
+                lat_int = int(float(item[-2]))
+                lat_deg = (float(item[-2]) - lat_int)*60
+                depth = round(float(item[-1]),2)
+                event_index = item[9]
+                output_file = output_dir / f'gamma_events_{index}.dat_ch'
+                with open(output_file,'a') as r:
+                    r.write(f"{ymd:>9}{hh:>2}{mm:>2}{ss:>6.2f}{lat_int:2}{lat_deg:0>5.2f}{lon_int:3}{lon_deg:0>5.2f}{depth:>6.2f}\n")
+                with open(gamma_picks,'r') as picks_read:
+                    for p_line in picks_read.readlines():
+                        if p_line[0] != 's':
+                            picks_index = p_line.split(',')[-2]
+                            if event_index == picks_index:
+                                part = p_line.split(',')
+                                wt = part[3]
+                                sta = part[0].split('.')[1]
+                                pick_time = datetime.strptime(part[1], '%Y-%m-%dT%H:%M:%S.%f')
+                                if mm == 59 and pick_time.minute == 0:
+                                    wmm = int(60)
+                                else:
+                                    wmm = pick_time.minute
+                                wss = round(pick_time.second + pick_time.microsecond / 1000000, 2)
+                                wei = '1.00'
+                                with open(output_file,'a') as r:
+                                    if wt.upper() == 'P':
+                                        r.write(f"{' ':1}{sta:<4}{'0.0':>6}{'0':>4}{'0':>4}{wmm:>4}{wss:>6.2f}{'0.01':>5}{wei:>5}{'0.00':>6}{'0.00':>5}{'0.00':>5}\n")
+                                    else:
+                                        r.write(f"{' ':1}{sta:<4}{'0.0':>6}{'0':>4}{'0':>4}{wmm:>4}{'0.00':>6}{'0.00':>5}{'0.00':>5}{wss:>6.2f}{'0.01':>5}{wei:>5}\n")
+
+def gamma_catalog(gamma_dir, n_events=40):
+    """
+    GaMMA CSVs of a synthetic catalog with the event rows shuffled, as
+    GaMMA writes them in cluster order rather than in time.
+    """
+    rng = np.random.default_rng(0)
+    stations = write_stations(gamma_dir / 'stations.csv', 10, rng)
+    events = synthetic_events(n_events, ['20240402', '20240403'], 3600, rng)
+    write_gamma_csvs(gamma_dir, events, synthetic_picks(events, stations, rng))
+    with open(gamma_dir / 'gamma_events.csv') as f:
+        header, *rows = f.readlines()
+    random.Random(0).shuffle(rows)
+    with open(gamma_dir / 'gamma_events.csv', 'w') as f:
+        f.writelines([header] + rows)
+    return gamma_dir / 'gamma_events.csv'
+
+def test_gamma_sort_split_matches_baseline(tmp_path):
+    events_csv = gamma_catalog(tmp_path)
+    for chunksize in [7, 4000]:
+        expected, got = tmp_path / f'baseline_{chunksize}' / 'split', tmp_path / f'split_{chunksize}'
+        expected.parent.mkdir()
+        baseline_sort_split(expected, events_csv, chunksize)
+        assert gamma_sort_split(got, events_csv, chunksize) == len(list(expected.iterdir()))
+        for path in expected.iterdir():
+            assert (got / path.name).read_bytes() == path.read_bytes()
+
+def test_transform_matches_baseline(tmp_path, monkeypatch):
+    # transform logs into trans.log of the working directory
+    monkeypatch.chdir(tmp_path)
+    events_csv = gamma_catalog(tmp_path)
+    # the baseline needs network-prefixed station ids
+    picks = pd.read_csv(tmp_path / 'gamma_picks.csv')
+    picks['station_id'] = 'TW.' + picks['station_id']
+    picks.to_csv(tmp_path / 'gamma_picks.csv', index=False)
+    chunk_num = gamma_sort_split(tmp_path / 'split', events_csv, 7)
+    (tmp_path / 'baseline').mkdir()
+    (tmp_path / 'for_h3dd').mkdir()
+    init_transform(load_picks_by_event(tmp_path / 'gamma_picks.csv'))
+    for index in range(chunk_num):
+        baseline_transform(index, tmp_path / 'gamma_picks.csv', tmp_path / 'split', tmp_path / 'baseline')
+        transform((index, tmp_path / 'split', tmp_path / 'for_h3dd'))
+        name = f'gamma_events_{index}.dat_ch'
+        assert (tmp_path / 'for_h3dd' / name).read_bytes() == (tmp_path / 'baseline' / name).read_bytes()
+
+def baseline_pick_table(picks):
+    """
+    Pick DataFrame of run_gamma_association before pick_table, built row by row.
+    """
+    pick_df = []
+    for p in picks:
+        pick_df.append({"id": p.trace_id, "timestamp": p.peak_time.datetime, "prob": p.peak_value, "type": p.phase.lower()})
+    pick_df = pd.DataFrame(pick_df)
+    pick_df['id'] = pick_df['id'].apply(extract_substring)
+    return pick_df
+
+def test_pick_tables_match_baseline(tmp_path):
+    """
+    pick_table on SeisBench-like picks and store_pick_table on the same
+    picks read back from the pick store give the baseline table. Peak times
+    fall on 100 Hz samples and probabilities are exact in float32, the
+    precision the pick store keeps.
+    """
+    rng = np.random.default_rng(0)
+    t0 = UTCDateTime(2024, 4, 2)
+    n = 500
+    picks = [SyntheticPick(f"TW.S{k:03d}.00.HH", t0 + float(dt), float(pv), phase, t0 + float(dt) - 0.5, t0 + float(dt) + 0.5)
+             for k, dt, pv, phase in zip(rng.integers(0, 20, n), np.sort(rng.integers(0, 8_640_000, n)) / 100,
+                                         rng.integers(300, 1024, n) / 1024, rng.choice(['P', 'S'], n))]
+    expected = baseline_pick_table(picks)
+    expected['timestamp'] = expected['timestamp'].astype('datetime64[ns]')
+    pd.testing.assert_frame_equal(pick_table(*picks_to_arrays(picks)), expected)
+    with PickWriter(store_path(tmp_path, '20240402')) as writer:
+        writer.append(picks)
+    pd.testing.assert_frame_equal(store_pick_table(read_picks(tmp_path)), expected)
@@ -0,0 +1,43 @@
+import numpy as np
+from modules.aso_gamma import Aso_gamma, h3dd_pick_line
+from modules.catalog import Catalog
+from synthetic import write_stations, synthetic_events, synthetic_picks, write_gamma_csvs
+
+def phases(path):
+    """
+    Phase of every pick line of an h3dd catalog, read from which weight column is filled.
+    """
+    with open(path) as f:
+        return ['P' if line.split()[6] == '0.01' else 'S' for line in f if not line[1:9].strip().isdigit()]
+
+def test_h3dd_pick_line_phase_case():
+    assert h3dd_pick_line('S001', 'p', 1, 2.5, 1) == h3dd_pick_line('S001', 'P', 1, 2.5, 1)
+    assert h3dd_pick_line('S001', 's', 1, 2.5, 1) == h3dd_pick_line('S001', 'S', 1, 2.5, 1)
+    assert h3dd_pick_line('S001', 'p', 1, 2.5, 1) != h3dd_pick_line('S001', 's', 1, 2.5, 1)
+
+def test_h3dd_exports_keep_p_picks(tmp_path, monkeypatch):
+    """
+    GaMMA writes lowercase phases; the h3dd catalogs of gamma2h3dd and
+    EventCatalog.to_h3dd still hold the P picks as P lines.
+    """
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+    stations = write_stations(tmp_path / 'stations.csv', 10, rng)
+    events = synthetic_events(5, ['20240402'], 600, rng)
+    picks = synthetic_picks(events, stations, rng, false_rate=0.0)
+    config = {"waveform_dir": str(tmp_path), "name_of_eq_sequence": "catalog", "analyze_range": "20240402-20240402",
+              "station_path": str(tmp_path / 'stations.csv'), "1D_velocity_model": "", "3D_velocity_model": "",
+              "association_method": "gamma"}
+    aso = Aso_gamma(config, picks=[])
+    aso.create_directory_structure()
+    write_gamma_csvs(aso.output_base_dir / 'GaMMA', events, picks)
+    n_p = int((picks['phase'] == 'P').sum())
+
+    aso.gamma2h3dd()
+    converted = [p for path in sorted(aso.output_base_dir.glob('**/gamma_events_*.dat_ch')) for p in phases(path)]
+    assert converted.count('P') == n_p and converted.count('S') == len(picks) - n_p
+
+    catalog = Catalog(config).build_catalog()
+    catalog.to_h3dd(tmp_path / 'catalog.dat_ch')
+    exported = phases(tmp_path / 'catalog.dat_ch')
+    assert exported.count('P') == n_p and exported.count('S') == len(picks) - n_p
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+from core.pick_store import read_picks
+from modules.aso_gamma import Aso_gamma
+from modules.eikonal_cache import gamma_utils
+from modules.gamma_partition import associate_partitioned, compare_associations
+from synthetic import write_stations, write_velocity_model, synthetic_events, synthetic_picks, write_pick_store
+
+def gamma_fixture(tmp_path, monkeypatch, n_events=20, seconds=300):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(8)
+    stations = write_stations(tmp_path / 'stations.csv', 12, rng, spread=0.25)
+    write_velocity_model(tmp_path / 'vel_1d.csv')
+    events = synthetic_events(n_events, ['20240402'], seconds, rng, spread=0.15)
+    write_pick_store(tmp_path / 'picks', synthetic_picks(events, stations, rng, false_rate=0.0))
+    config = {"waveform_dir": str(tmp_path), "name_of_eq_sequence": "gamma", "analyze_range": "20240402-20240402",
+              "station_path": str(tmp_path / 'stations.csv'), "1D_velocity_model": str(tmp_path / 'vel_1d.csv'),
+              "3D_velocity_model": "", "association_method": "gamma"}
+    aso = Aso_gamma(config, picks=read_picks(tmp_path / 'picks'))
+    picks, stations, gamma_config, _ = aso.gamma_inputs()
+    # homogeneous velocities, no eikonal tables to solve
+    gamma_config.update(eikonal=None, ncpu=1)
+    return picks, stations, gamma_config
+
+def test_partitioned_matches_single_call(tmp_path, monkeypatch):
+    """
+    Windows far shorter than the fixture put events next to the borders;
+    each of them comes out once, as in a single association call.
+    """
+    picks, stations, config = gamma_fixture(tmp_path, monkeypatch)
+    # gamma shuffles its clusters with the global numpy state
+    np.random.seed(42)
+    events, single = gamma_utils().association(picks.copy(), stations, dict(config), 0, config["method"])
+    partitioned_events, partitioned = associate_partitioned(picks.copy(), stations, dict(config), config["method"],
+                                                            window=40, overlap=30, processes=1)
+    assert len(partitioned_events) == len(events)
+    report = compare_associations(single, partitioned, len(picks))
+    assert report["event_agreement"] == 1.0
+    assert report["pick_agreement"] > 0.95
+    assert [event["event_index"] for event in partitioned_events] == list(range(len(events)))
+
+def test_partitioned_without_picks(tmp_path, monkeypatch):
+    picks, stations, config = gamma_fixture(tmp_path, monkeypatch)
+    assert associate_partitioned(picks.iloc[:0], stations, config, config["method"], window=40, overlap=30) == ([], [])
+
+def test_stitch_settles_event_found_by_two_windows():
+    """
+    Both windows of a border report the event with the same picks: it is
+    kept once, with the picks of both copies.
+    """
+    from modules.gamma_partition import stitch
+    picks = pd.DataFrame({"type": ["p"] * 8 + ["s"] * 4})
+    config = {"min_picks_per_eq": 8, "min_p_picks_per_eq": 6, "min_s_picks_per_eq": 2}
+    event = {"time": "2024-04-02T00:00:39.900", "event_index": 0}
+    results = [(0, [dict(event)], [(i, 0, 0.9) for i in range(11)]),
+               (1, [dict(event, time="2024-04-02T00:00:40.100")], [(i, 0, 0.8) for i in range(1, 12)])]
+    events, assignments = stitch(results, picks, config)
+    assert len(events) == 1
+    assert events[0]["time"] == event["time"] and events[0]["num_picks"] == 12
+    assert sorted(pick_index for pick_index, _, _ in assignments) == list(range(12))
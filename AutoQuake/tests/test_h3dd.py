@@ -0,0 +1,86 @@
+import pytest
+from modules.h3dd import H3dd
+from synthetic import write_stub_h3dd
+
+FAILING_H3DD = """#!/bin/sh
+# like the stub, but chunk 1 leaves a partial output and fails
+read header
+read catalog
+case "$catalog" in
+    gamma_events_1.dat_ch) echo "partial" > "$catalog.hout"; exit 3 ;;
+esac
+cp "$catalog" "$catalog.hout"
+"""
+
+def make_h3dd(tmp_path, monkeypatch, executable, n_chunks=3):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'stations.csv').write_text("net,station,lon,lat,elevation_m\nTW,S000,121.7,24.0,10.0\n")
+    config = {"waveform_dir": str(tmp_path), "name_of_eq_sequence": "h3dd", "analyze_range": "20240402-20240402",
+              "station_path": str(tmp_path / 'stations.csv'), "1D_velocity_model": "", "3D_velocity_model": "",
+              "h3dd_executable": str(executable)}
+    h3dd = H3dd(config)
+    h3dd.for_h3dd_dir.mkdir(parents=True)
+    h3dd.h3dd_dir.mkdir(parents=True)
+    for i in range(n_chunks):
+        (h3dd.for_h3dd_dir / f'gamma_events_{i}.dat_ch').write_text(f"event {i}\n")
+    return h3dd
+
+def test_chunks_relocated_and_gathered_in_order(tmp_path, monkeypatch):
+    h3dd = make_h3dd(tmp_path, monkeypatch, write_stub_h3dd(tmp_path / 'h3dd'))
+    merged = h3dd.run_h3dd_parallel(3, processes=2)
+    assert list(merged) == ['.hout']
+    assert merged['.hout'].read_text() == "event 0\nevent 1\nevent 2\n"
+    inp = (h3dd.h3dd_dir / 'chunks' / 'chunk_1' / 'h3dd.inp').read_text().splitlines()
+    assert inp[1] == 'gamma_events_1.dat_ch'
+    assert inp[3] == str(h3dd.h3dd_station)
+
+def test_failed_chunk_is_not_gathered(tmp_path, monkeypatch):
+    failing = tmp_path / 'h3dd_failing'
+    failing.write_text(FAILING_H3DD)
+    failing.chmod(0o755)
+    h3dd = make_h3dd(tmp_path, monkeypatch, failing)
+    with pytest.raises(RuntimeError, match=r'\[1\]'):
+        h3dd.run_h3dd_parallel(3, processes=2)
+    assert (h3dd.h3dd_dir / 'h3dd_all.hout').read_text() == "event 0\nevent 2\n"
+
+def test_stale_outputs_are_not_gathered(tmp_path, monkeypatch):
+    h3dd = make_h3dd(tmp_path, monkeypatch, write_stub_h3dd(tmp_path / 'h3dd'))
+    h3dd.run_h3dd_parallel(3, processes=1)
+    # a second run with one chunk less and an executable that writes nothing
+    (h3dd.for_h3dd_dir / 'gamma_events_2.dat_ch').unlink()
+    silent = tmp_path / 'h3dd_silent'
+    silent.write_text("#!/bin/sh\ncat > /dev/null\n")
+    silent.chmod(0o755)
+    assert h3dd.run_h3dd_parallel(3, processes=1, executable=silent) == {}
+    assert not list(h3dd.h3dd_dir.glob('h3dd_all*'))
+
+def test_halo_copies_dropped_after_spatial_split(tmp_path, monkeypatch):
+    import numpy as np
+    import pandas as pd
+    from modules.aso_gamma import Aso_gamma
+    from modules.h3dd import parse_h3dd_event_line
+    from synthetic import write_stations, synthetic_events, synthetic_picks, write_gamma_csvs
+
+    h3dd = make_h3dd(tmp_path, monkeypatch, write_stub_h3dd(tmp_path / 'h3dd'), n_chunks=0)
+    rng = np.random.default_rng(0)
+    stations = write_stations(tmp_path / 'stations.csv', 20, rng)
+    events = synthetic_events(300, ['20240402'], 3600, rng)
+    write_gamma_csvs(tmp_path / 'output' / 'h3dd' / 'GaMMA', events, synthetic_picks(events, stations, rng))
+    aso = Aso_gamma(h3dd.config, picks=[])
+    aso.gamma2h3dd(cut_off_dist=5, partition_size=60)
+    members = pd.read_csv(h3dd.members_csv)
+    assert (~members['core']).any()
+
+    merged = h3dd.run_h3dd_parallel(5, processes=1)
+    with open(merged['.hout']) as f:
+        times = [parsed[0] for parsed in map(parse_h3dd_event_line, f) if parsed is not None]
+    assert len(times) == len(events)
+    assert len(set(times)) == len(events)
+
+def test_relative_velocity_model_resolved_from_run_dir(tmp_path, monkeypatch):
+    h3dd = make_h3dd(tmp_path, monkeypatch, write_stub_h3dd(tmp_path / 'h3dd'))
+    (tmp_path / 'vel_3d.txt').write_text("model\n")
+    h3dd.vel_model_3d = 'vel_3d.txt'
+    h3dd.run_h3dd_parallel(3, processes=1)
+    inp = (h3dd.h3dd_dir / 'chunks' / 'chunk_0' / 'h3dd.inp').read_text().splitlines()
+    assert inp[5] == str(tmp_path / 'vel_3d.txt')
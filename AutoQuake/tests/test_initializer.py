@@ -0,0 +1,32 @@
+from core.initializer import Initializer
+from core.waveform_index import DEFAULT_CHANNEL_PRIORITY, scan_day_dir
+from synthetic import write_dataset
+
+def test_rerun_with_other_channel_priority(tmp_path, monkeypatch):
+    """
+    Filtering and merging again after channel_priority changed leaves one
+    instrument per station in data_single and data_final, as a fresh run would.
+    """
+    monkeypatch.chdir(tmp_path)
+    config, _ = write_dataset(tmp_path, n_stations=6, n_events=1, seconds=120, segments=2)
+    init = Initializer(config)
+    init.create_directory_structure()
+    init.filter_single_equip()
+    init.merge_waveform()
+
+    config['channel_priority'] = ['HN'] + [equip for equip in DEFAULT_CHANNEL_PRIORITY if equip != 'HN']
+    rerun = Initializer(config)
+    rerun.filter_single_equip()
+    rerun.merge_waveform()
+
+    fresh = Initializer(dict(config, name_of_eq_sequence='fresh'))
+    fresh.create_directory_structure()
+    fresh.filter_single_equip()
+    fresh.merge_waveform()
+    for day in init.date_list:
+        for stage in ['data_single', 'data_final']:
+            names = sorted(p.name for p in (rerun.output_base_dir / 'data' / day / stage).iterdir())
+            assert names == sorted(p.name for p in (fresh.output_base_dir / 'data' / day / stage).iterdir())
+        index = scan_day_dir(rerun.output_base_dir / 'data' / day / 'data_single')
+        assert (index.groupby('station')['equip'].nunique() == 1).all()
+        assert 'HN' in set(index['equip'])
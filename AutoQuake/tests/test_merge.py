@@ -0,0 +1,68 @@
+import os
+import numpy as np
+from obspy import Stream, Trace, UTCDateTime, read
+from core.waveform_index import write_sac
+from core.merge_engine import merge_group
+
+T0 = UTCDateTime(2024, 4, 2)
+
+def trace(station='S001', start=0.0, npts=200, sampling_rate=20.0):
+    return Trace(np.arange(npts, dtype=np.float32),
+                 header={'network': 'TW', 'station': station, 'location': '00', 'channel': 'HHZ',
+                         'sampling_rate': sampling_rate, 'starttime': T0 + start})
+
+def test_write_sac_two_traces(tmp_path):
+    """
+    A stream left with two traces is written one file per trace under the
+    numbered names of Stream.write, without temporary files left behind.
+    """
+    path = tmp_path / 'TW.S001.00.HHZ.D.2024.093'
+    paths = write_sac(Stream([trace(), trace(start=20.0, sampling_rate=10.0)]), path)
+    assert [p.name for p in paths] == ['TW.S001.00.HHZ.D.202401.093', 'TW.S001.00.HHZ.D.202402.093']
+    assert sorted(os.listdir(tmp_path)) == [p.name for p in paths]
+    assert [read(p)[0].stats.sampling_rate for p in paths] == [20.0, 10.0]
+
+def test_merge_group_mixed_sampling_rates(tmp_path):
+    """
+    Segments that Stream.merge refuses are kept as they were, one numbered
+    data_final file each, and the data_single files are left alone.
+    """
+    single = tmp_path / 'data_single'
+    final = tmp_path / 'data_final'
+    single.mkdir()
+    final.mkdir()
+    paths = [str(single / 'TW.S001.00.HHZ.D.2024.093.0000'), str(single / 'TW.S001.00.HHZ.D.2024.093.0001')]
+    trace().write(paths[0], format='SAC')
+    trace(start=10.0, sampling_rate=10.0).write(paths[1], format='SAC')
+    assert merge_group('S001.00.HHZ', paths, final, 'hardlink') == 'merge'
+    assert sorted(os.listdir(final)) == ['TW.S001.00.HHZ.D.2024.09301.0000', 'TW.S001.00.HHZ.D.2024.09302.0000']
+    assert [read(p)[0].stats.npts for p in paths] == [200, 200]
+
+def test_merge_group_reads_samples_only_to_merge(tmp_path, monkeypatch):
+    """
+    A file covering its group is linked from the headers alone, contiguous
+    segments are read and concatenated.
+    """
+    import core.merge_engine as merge_engine
+    reads = []
+    read_sac = merge_engine.read_sac
+    monkeypatch.setattr(merge_engine, 'read_sac', lambda path, headonly=False: reads.append(headonly) or read_sac(path, headonly))
+    single = tmp_path / 'data_single'
+    final = tmp_path / 'data_final'
+    single.mkdir()
+    final.mkdir()
+    covered = [str(single / 'TW.S001.00.HHZ.D.2024.093.0000'), str(single / 'TW.S001.00.HHZ.D.2024.093.0001')]
+    trace(npts=400).write(covered[0], format='SAC')
+    trace(start=5.0, npts=100).write(covered[1], format='SAC')
+    assert merge_group('S001.00.HHZ', covered, final, 'hardlink') == 'covered'
+    assert reads == [True, True]
+    assert os.path.samefile(final / 'TW.S001.00.HHZ.D.2024.093.0000', covered[0])
+
+    reads.clear()
+    contiguous = [str(single / 'TW.S002.00.HHZ.D.2024.093.0000'), str(single / 'TW.S002.00.HHZ.D.2024.093.0001')]
+    trace('S002').write(contiguous[0], format='SAC')
+    trace('S002', start=10.0).write(contiguous[1], format='SAC')
+    assert merge_group('S002.00.HHZ', contiguous, final, 'hardlink') == 'contiguous'
+    assert reads == [True, True, False, False]
+    merged = read(final / 'TW.S002.00.HHZ.D.2024.093.0000')[0]
+    assert merged.stats.npts == 400 and merged.stats.starttime == T0
@@ -0,0 +1,95 @@
+import os
+import time
+import threading
+import numpy as np
+import pandas as pd
+from obspy import Trace, UTCDateTime, read
+from core.station_registry import station_proj
+from modules.realtime import RealtimeWatcher
+from synthetic import ArrivalPicker, write_stations, write_velocity_model
+
+CHUNK, N_CHUNKS, SAMPLING_RATE = 60, 6, 20.0
+ORIGINS = [90.0, 200.0]
+
+def test_watch_with_file_dropper(tmp_path, monkeypatch):
+    """
+    A dropper thread writes a 60 s SAC chunk of every channel while the
+    watcher cycles; both events are emitted, the ingested data is merged
+    into data_final and the raw files are left as they were.
+    """
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(1)
+    t0 = UTCDateTime(2024, 4, 2)
+    day = t0.strftime('%Y%m%d')
+    stations = write_stations(tmp_path / 'stations.csv', 8, rng, spread=0.3)
+    write_velocity_model(tmp_path / 'vel_1d.csv')
+    sx, sy = station_proj((121.7, 24.0))(longitude=stations['lon'].to_numpy(), latitude=stations['lat'].to_numpy())
+    arrivals = {sta: [] for sta in stations['station']}
+    for origin in ORIGINS:
+        x, y, z = rng.uniform(-15, 15), rng.uniform(-15, 15), 10.0
+        dist = np.sqrt((sx - x)**2 + (sy - y)**2 + z**2)
+        for sta, d in zip(stations['station'], dist):
+            arrivals[sta] += [(t0.timestamp + origin + d / 6.0, 'P'), (t0.timestamp + origin + d / 3.43, 'S')]
+
+    day_dir = tmp_path / 'raw' / day
+    day_dir.mkdir(parents=True)
+    def drop(k):
+        for sta in stations['station']:
+            for comp in 'ZNE':
+                tr = Trace(rng.standard_normal(int(CHUNK * SAMPLING_RATE)).astype(np.float32),
+                           header={'network': 'TW', 'station': sta, 'location': '00', 'channel': f'HH{comp}',
+                                   'sampling_rate': SAMPLING_RATE, 'starttime': t0 + k * CHUNK})
+                path = day_dir / f'{tr.id}.D.2024.093.{k:04d}'
+                part = path.with_name(f'.{path.name}.tmp')
+                tr.write(str(part), format='SAC')
+                os.replace(part, path)
+
+    config = {"waveform_dir": str(tmp_path / 'raw'), "name_of_eq_sequence": "watch", "analyze_range": f"{day}-{day}",
+              "station_path": str(tmp_path / 'stations.csv'), "1D_velocity_model": str(tmp_path / 'vel_1d.csv'),
+              "3D_velocity_model": "", "association_method": "gamma", "watch_interval": 0.1, "watch_max_lag": 0,
+              "pick_overlap": 30, "max_travel_time": 60, "watch_merge_interval": 0,
+              "eikonal_cache_dir": str(tmp_path / 'eikonal_cache')}
+    drop(0)
+    watcher = RealtimeWatcher(config, picker=ArrivalPicker(arrivals))
+    watcher.create_directory_structure()
+    watcher.start()
+    watcher.horizon = t0.timestamp
+    stop = threading.Event()
+    def dropper():
+        for k in range(1, N_CHUNKS):
+            time.sleep(0.3)
+            drop(k)
+        stop.set()
+    thread = threading.Thread(target=dropper)
+    thread.start()
+    while True:
+        done = stop.is_set()
+        watcher.cycle()
+        if done:
+            break
+        time.sleep(watcher.interval)
+    thread.join()
+    watcher.merge_pending()
+
+    events = pd.read_csv(watcher.gamma_events)
+    emitted = np.array([UTCDateTime(t).timestamp - t0.timestamp for t in events['time']])
+    assert len(emitted) == len(ORIGINS)
+    assert np.allclose(np.sort(emitted), ORIGINS, atol=2.0)
+    latency = pd.read_csv(watcher.realtime_dir / 'latency.csv')
+    assert len(latency) == len(ORIGINS) and (latency['latency_s'] >= 0).all()
+    with open(watcher.for_h3dd / 'gamma_events_realtime.dat_ch') as f:
+        lines = f.readlines()
+    assert sum(line[1:9].strip().isdigit() for line in lines) == len(ORIGINS)
+    # a P line fills the P weight columns, an S line the S ones
+    phases = ['P' if line.split()[6] == '0.01' else 'S' for line in lines if not line[1:9].strip().isdigit()]
+    assert phases.count('P') == phases.count('S') > 0
+
+    data_final = watcher.output_base_dir / 'data' / day / 'data_final'
+    for sta in stations['station']:
+        merged = read(next(data_final.glob(f'TW.{sta}.00.HHZ.*')))
+        assert len(merged) == 1 and merged[0].stats.npts == int(N_CHUNKS * CHUNK * SAMPLING_RATE)
+    assert f'merge/{day}' in watcher.manifest.stages
+    # data_single holds copies, nothing written downstream reaches the raw files
+    for path in (watcher.output_base_dir / 'data' / day / 'data_single').iterdir():
+        assert not os.path.samefile(path, day_dir / path.name)
+    assert all(read(path)[0].stats.npts == int(CHUNK * SAMPLING_RATE) for path in day_dir.iterdir())
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from obspy import Trace, UTCDateTime, read
+from obspy.io.sac import SACTrace
+from core.waveform_index import read_sac_window
+
+T0 = UTCDateTime(2024, 4, 2)
+
+@pytest.mark.parametrize('byteorder', ['little', 'big'])
+def test_read_sac_window_matches_obspy_read(tmp_path, byteorder):
+    """
+    The memory-mapped slice holds the same samples and start time as
+    obspy.read with starttime/endtime, for windows inside, across the edges
+    of and outside the file.
+    """
+    path = str(tmp_path / 'TW.S001.00.HHZ.D.2024.093')
+    tr = Trace(np.random.default_rng(0).standard_normal(6000).astype(np.float32),
+               header={'network': 'TW', 'station': 'S001', 'location': '00', 'channel': 'HHZ',
+                       'sampling_rate': 20.0, 'starttime': T0 + 0.013})
+    SACTrace.from_obspy_trace(tr).write(path, byteorder=byteorder)
+    for start, end in [(60, 120), (-30, 30.02), (290.31, 400), (0.013, 300), (10.026, 10.074), (400, 500)]:
+        expected = read(path, starttime=T0 + start, endtime=T0 + end)
+        got = read_sac_window(path, T0 + start, T0 + end)
+        assert len(got) == len(expected)
+        if not expected:
+            continue
+        assert got[0].stats.starttime == expected[0].stats.starttime
+        assert got[0].id == expected[0].id
+        np.testing.assert_array_equal(got[0].data, expected[0].data)